@@ -0,0 +1,251 @@
+"""End-to-end benchmark of `Karmabot` against a fake Slack.
+
+Drives `_handle_app_mention`, `_handle_command` and `process_expired_votings`
+through `FakeWebClient` and reports the throughput and the latency percentiles
+of each operation for every DB. The DB must be a scratch one: the karmabot
+tables are emptied before a run.
+
+Run with `python -m benchmarks.bench_e2e --db sqlite:///bench.db --db postgresql://...`.
+"""
+
+import datetime
+import importlib.metadata
+import itertools
+import json
+import pathlib
+import platform
+import random
+import statistics
+import tempfile
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy as sa
+
+from karmabot.config import KarmabotConfig
+from karmabot.karmabot import Karmabot
+from karmabot.orm import Karma, KarmaLedger, Voting, create_session_maker
+from tests.fake_slack import FakeWebClient
+
+USERS = 200
+# Mentions handled between two sweeps of expired votings
+SWEEP_EVERY = 50
+COMMANDS = ["get <@U{0:04d}|user{0}>", "top", "top 25", "rank <@U{0:04d}|user{0}>"]
+
+
+def _config(db: str) -> dict:
+    return {
+        "db": db,
+        "log_level": "warning",
+        "lang": "en",
+        "slack_bot_token": "xoxb-fake",
+        "slack_app_token": "xapp-fake",
+        "admins": [],
+        "digest": {"day": 1, "hour": 1, "minute": 1, "channel": "C1"},
+        "karma": {
+            "initial_value": 0,
+            "max_diff": 5,
+            "self_karma": False,
+            # Votings expire as soon as they are created
+            "vote_timeout": 0,
+            "keep_history": "P90D",
+            "upvote_emoji": ["+1"],
+            "downvote_emoji": ["-1"],
+        },
+    }
+
+
+def _client(latency: float, ratelimited_share: float, rate_limits: bool) -> FakeWebClient:
+    post_ts = itertools.count(1_000_000_000)
+    rnd = random.Random(1)
+    return FakeWebClient(
+        {
+            "users.info": lambda args: {
+                "user": {"id": args["user"], "name": f"user{args['user']}", "profile": {}}
+            },
+            "users.list": lambda args: {
+                "members": [
+                    {"id": f"U{i:04d}", "name": f"user{i}", "profile": {}} for i in range(USERS)
+                ],
+            },
+            "chat.postMessage": lambda args: {"ts": f"{next(post_ts)}.000100"},
+            "chat.update": lambda args: {"ts": args["ts"]},
+            "reactions.get": lambda args: {
+                "message": {"reactions": [{"name": "+1", "count": rnd.randint(0, 3)}]}
+            },
+        },
+        latency=latency,
+        ratelimited_share=ratelimited_share,
+        rate_limits=rate_limits,
+    )
+
+
+def _timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _stats(samples: list[float], seconds: float) -> dict:
+    if len(samples) > 1:
+        q = statistics.quantiles(samples, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = samples[0] if samples else 0.0
+    return {
+        "count": len(samples),
+        "seconds": round(seconds, 6),
+        "throughput": round(len(samples) / seconds, 2) if seconds else None,
+        "p50_ms": round(p50 * 1e3, 3),
+        "p95_ms": round(p95 * 1e3, 3),
+        "p99_ms": round(p99 * 1e3, 3),
+    }
+
+
+def _run(samples: list[Callable[[], object]], workers: int) -> dict:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = list(pool.map(_timed, samples))
+    return _stats(latencies, time.perf_counter() - start)
+
+
+def _drain(bot: Karmabot) -> None:
+    while bot.drain_outbox():
+        pass
+
+
+def _sweep(bot: Karmabot) -> None:
+    # Votings expire once their message is posted, results are sent from the outbox too
+    _drain(bot)
+    bot.process_expired_votings()
+    _drain(bot)
+
+
+def bench(db: str, mentions: int, commands: int, workers: int, client: FakeWebClient) -> dict:
+    config = KarmabotConfig.model_validate(_config(db))
+    with create_session_maker(config.db).begin() as session:
+        for model in (Voting, KarmaLedger, Karma):
+            session.execute(sa.delete(model))
+    bot = Karmabot(config, client=client)
+
+    def mention(i: int) -> Callable[[], object]:
+        event = {
+            "type": "app_mention",
+            "user": "UINIT",
+            "channel": "C1",
+            "ts": f"{1_700_000_000 + i}.000100",
+            "text": f"<@UBOT> <@U{i % USERS:04d}> ++ for the release",
+        }
+        return lambda: bot._handle_app_mention(client, event)
+
+    def command(i: int) -> Callable[[], object]:
+        text = COMMANDS[i % len(COMMANDS)].format(i % USERS)
+        payload = {"user_name": "user", "text": text}
+        return lambda: bot._handle_command(lambda *args, **kwargs: None, payload)
+
+    results = {}
+    mention_samples: list[float] = []
+    sweep_samples: list[float] = []
+    mention_seconds = sweep_seconds = 0.0
+    closed = 0
+    for first in range(0, mentions, SWEEP_EVERY):
+        batch = [mention(i) for i in range(first, min(first + SWEEP_EVERY, mentions))]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            mention_samples.extend(pool.map(_timed, batch))
+        mention_seconds += time.perf_counter() - start
+        pending = len(bot._manager.pending())
+        sweep_samples.append(_timed(lambda: _sweep(bot)))
+        sweep_seconds += sweep_samples[-1]
+        closed += pending - len(bot._manager.pending())
+    results["app_mention"] = _stats(mention_samples, mention_seconds)
+    results["process_expired_votings"] = _stats(sweep_samples, sweep_seconds)
+    results["process_expired_votings"]["votings_per_second"] = (
+        round(closed / sweep_seconds, 2) if sweep_seconds else None
+    )
+    results["command"] = _run([command(i) for i in range(commands)], workers)
+    return results
+
+
+@click.command(help="Benchmark Karmabot end to end against a fake Slack.")
+@click.option(
+    "--db",
+    "dbs",
+    multiple=True,
+    help="Scratch DB URL, repeat to compare DBs [default: a temporary SQLite DB]",
+)
+@click.option("--mentions", default=500, show_default=True, help="Number of app mentions")
+@click.option("--commands", default=500, show_default=True, help="Number of slash commands")
+@click.option("--workers", default=1, show_default=True, help="Events handled concurrently")
+@click.option("--latency", default=0.0, show_default=True, help="Slack API latency, ms")
+@click.option(
+    "--ratelimited",
+    default=0.0,
+    show_default=True,
+    type=click.FloatRange(0, 1),
+    help="Share of Slack API calls rejected with HTTP 429",
+)
+@click.option(
+    "--rate-limits/--no-rate-limits",
+    default=False,
+    show_default=True,
+    help="Keep API calls within Slack rate limit tiers",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default="bench_e2e.json",
+    show_default=True,
+    help="Results file",
+)
+def main(
+    dbs: tuple[str, ...],
+    mentions: int,
+    commands: int,
+    workers: int,
+    latency: float,
+    ratelimited: float,
+    rate_limits: bool,
+    output: pathlib.Path,
+) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        urls = dbs or (f"sqlite:///{tmp}/bench.db",)
+        results = {}
+        for url in urls:
+            name = sa.make_url(url).render_as_string(hide_password=True)
+            click.echo(f"Benchmarking {name}")
+            client = _client(latency / 1e3, ratelimited, rate_limits)
+            results[name] = bench(url, mentions, commands, workers, client)
+            for operation, stats in results[name].items():
+                click.echo(
+                    f"  {operation:<24} {stats['throughput']:>10} ops/s"
+                    f"  p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms"
+                    f"  p99 {stats['p99_ms']:>8} ms"
+                )
+    try:
+        version = importlib.metadata.version("karmabot")
+    except importlib.metadata.PackageNotFoundError:
+        version = "unknown"
+    report = {
+        "karmabot": version,
+        "python": platform.python_version(),
+        "created": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "params": {
+            "mentions": mentions,
+            "commands": commands,
+            "workers": workers,
+            "latency_ms": latency,
+            "ratelimited": ratelimited,
+            "rate_limits": rate_limits,
+        },
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    click.echo(f"Results are written to {output}")
+
+
+if __name__ == "__main__":
+    main()
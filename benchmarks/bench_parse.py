@@ -0,0 +1,45 @@
+"""Microbenchmarks of `Parse` on messages as they come from Slack.
+
+Run with `python -m benchmarks.bench_parse`.
+"""
+
+import functools
+import timeit
+
+from karmabot.karmabot import Karmabot
+from karmabot.parse import Parse
+
+MESSAGES = {
+    "karma_change": "<@U0BOT1234> <@U01ABCDEF> ++ for the release",
+    "karma_change_team": "<@U0BOT1234> <@U01ABCDEF> <@U02GHIJKL> <@U03MNOPQR> +++ for the release",
+    "karma_change_miss": "<@U0BOT1234> could you remind me how the voting works?",
+    "cmd_get": "get <@U01ABCDEF|alice>",
+    "cmd_set": "set <@U01ABCDEF|alice> -15",
+    "cmd_top": "top 25",
+    "cmd_rank": "rank <@U01ABCDEF|alice>",
+}
+COMMANDS = [MESSAGES[name] for name in ("cmd_get", "cmd_set", "cmd_top", "cmd_rank")] + [
+    "digest",
+    "pending",
+    "help",
+    "unknown command",
+]
+NUMBER = 100_000
+
+
+def _report(name: str, seconds: float, number: int) -> None:
+    print(f"{name:<20} {number / seconds:>12,.0f} ops/s {seconds / number * 1e9:>8.0f} ns/op")
+
+
+def main() -> None:
+    for name, text in MESSAGES.items():
+        method = getattr(Parse, name.removesuffix("_team").removesuffix("_miss"))
+        _report(name, timeit.timeit(functools.partial(method, text), number=NUMBER), NUMBER)
+
+    resolve = Karmabot.commands.resolve
+    seconds = timeit.timeit(lambda: [resolve(text) for text in COMMANDS], number=NUMBER // 10)
+    _report("router.resolve", seconds, NUMBER // 10 * len(COMMANDS))
+
+
+if __name__ == "__main__":
+    main()
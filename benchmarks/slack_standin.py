@@ -0,0 +1,576 @@
+"""A local stand-in for the Slack Web API and Socket Mode for load and soak tests.
+
+It serves the Web API methods karmabot uses from a synthetic workspace, keeps
+their calls within Slack-like rate limit tiers and streams synthetic
+`app_mention` and reaction events to the bots connected over Socket Mode.
+
+Run it with `python -m benchmarks.slack_standin` and point the bot at it with
+`slack.api_url: http://127.0.0.1:8765/api/` in the bot's config; the Socket
+Mode URL is handed out by `apps.connections.open`. No network access is needed.
+"""
+
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import math
+import random
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+from karmabot.slack_utils import DEFAULT_RATE_LIMIT, METHOD_RATE_LIMITS
+
+logger = logging.getLogger("slack-standin")
+
+BOT_USER_ID = "UBOT"
+TEAM_ID = "T0STANDIN"
+APP_ID = "A0STANDIN"
+# Messages kept for `reactions.get` and `chat.update`, older ones are "deleted"
+MAX_MESSAGES = 100_000
+# Recent messages that synthetic reactions are added to
+REACTION_TARGETS = 1000
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class Workspace:
+    "Users, channels and messages of the synthetic workspace."
+
+    def __init__(self, users: int, channels: int) -> None:
+        self.users = [_user(f"U{i:05d}", f"user{i}") for i in range(users)]
+        self.users.append(_user(BOT_USER_ID, "karmabot", is_bot=True))
+        self.users_by_id = {u["id"]: u for u in self.users}
+        self.channels: list[dict] = [
+            {"id": f"C{i:05d}", "name": f"channel{i}", "is_channel": True} for i in range(channels)
+        ]
+        self.channels_by_id = {c["id"]: c for c in self.channels}
+        self.messages: collections.OrderedDict[tuple[str, str], dict] = collections.OrderedDict()
+        self.recent: collections.deque[tuple[str, str]] = collections.deque(
+            maxlen=REACTION_TARGETS
+        )
+        self.lock = threading.Lock()
+        self._last_ts = 0
+
+    def post(self, channel: str, user: str, text: str, **fields) -> str:
+        with self.lock:
+            # Message timestamps are unique within the workspace
+            self._last_ts = max(self._last_ts + 1, int(time.time() * 1e6))
+            ts = f"{self._last_ts // 10**6}.{self._last_ts % 10**6:06d}"
+            message = {"type": "message", "user": user, "text": text, "ts": ts, **fields}
+            self.messages[(channel, ts)] = {"message": message, "reactions": {}}
+            self.recent.append((channel, ts))
+            while len(self.messages) > MAX_MESSAGES:
+                self.messages.popitem(last=False)
+            return ts
+
+    def react(self, rnd: random.Random, reaction: str) -> tuple[str, str, str, int] | None:
+        "Adds or removes a reaction of a random user to a recent message."
+        with self.lock:
+            if not self.recent:
+                return None
+            channel, ts = rnd.choice(self.recent)
+            stored = self.messages.get((channel, ts))
+            if stored is None:
+                return None
+            users = stored["reactions"].setdefault(reaction, set())
+            user = rnd.choice(self.users[:-1])["id"]
+            if user in users:
+                users.discard(user)
+                return channel, ts, user, -1
+            users.add(user)
+            return channel, ts, user, 1
+
+
+class TierLimiter:
+    """Calls per minute of a method in fixed one minute windows, sized to its tier.
+
+    `chat.postMessage` is limited per channel.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._windows: dict[tuple[str, str], tuple[float, int]] = {}
+
+    def retry_after(self, method: str, args: dict) -> int:
+        "Counts a call and returns 0 or the seconds to wait if the call is over the limit."
+        key = (method, args.get("channel", "") if method == "chat.postMessage" else "")
+        limit = METHOD_RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT)
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._windows.get(key, (now, 0))
+            if now - start >= 60:
+                start, count = now, 0
+            self._windows[key] = (start, count + 1)
+        if count < limit:
+            return 0
+        return max(1, math.ceil(start + 60 - now))
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: collections.Counter[str] = collections.Counter()
+        self.ratelimited: collections.Counter[str] = collections.Counter()
+        self.events: collections.Counter[str] = collections.Counter()
+        self.acks = 0
+        self.ack_seconds = 0.0
+        self.ack_max = 0.0
+        self.dropped = 0
+
+    def report(self) -> str:
+        with self.lock:
+            ack_mean = self.ack_seconds / self.acks * 1e3 if self.acks else 0.0
+            text = (
+                f"events {dict(self.events)} acked {self.acks} dropped {self.dropped}"
+                f" ack mean {ack_mean:.1f} ms max {self.ack_max * 1e3:.1f} ms |"
+                f" calls {dict(self.calls)} 429 {dict(self.ratelimited)}"
+            )
+            self.ack_max = 0.0
+        return text
+
+
+class SocketHub:
+    "Socket Mode connections, events are sent to them in turns."
+
+    def __init__(self, stats: Stats) -> None:
+        self._stats = stats
+        self._lock = threading.Lock()
+        self._connections: list[WebSocket] = []
+        self._turn = itertools.count()
+        self._sent: dict[str, float] = {}
+
+    def add(self, ws: "WebSocket") -> None:
+        with self._lock:
+            self._connections.append(ws)
+
+    def remove(self, ws: "WebSocket") -> None:
+        with self._lock:
+            self._connections.remove(ws)
+
+    def send_event(self, event: dict) -> bool:
+        with self._lock:
+            if not self._connections:
+                return False
+            ws = self._connections[next(self._turn) % len(self._connections)]
+        envelope_id = str(uuid.uuid4())
+        envelope = {
+            "envelope_id": envelope_id,
+            "type": "events_api",
+            "accepts_response_payload": False,
+            "retry_attempt": 0,
+            "retry_reason": "",
+            "payload": {
+                "token": "standin",
+                "team_id": TEAM_ID,
+                "api_app_id": APP_ID,
+                "event": event,
+                "type": "event_callback",
+                "event_id": f"Ev{envelope_id[:8].upper()}",
+                "event_time": int(time.time()),
+                "authorizations": [{"team_id": TEAM_ID, "user_id": BOT_USER_ID, "is_bot": True}],
+            },
+        }
+        with self._lock:
+            self._sent[envelope_id] = time.monotonic()
+        try:
+            ws.send_text(json.dumps(envelope))
+        except OSError:
+            with self._lock:
+                self._sent.pop(envelope_id, None)
+            return False
+        return True
+
+    def ack(self, envelope_id: str) -> None:
+        with self._lock:
+            sent = self._sent.pop(envelope_id, None)
+        if sent is None:
+            return
+        elapsed = time.monotonic() - sent
+        with self._stats.lock:
+            self._stats.acks += 1
+            self._stats.ack_seconds += elapsed
+            self._stats.ack_max = max(self._stats.ack_max, elapsed)
+
+
+class WebSocket:
+    "Server side of a WebSocket connection (RFC 6455), enough for Socket Mode."
+
+    def __init__(self, handler: BaseHTTPRequestHandler) -> None:
+        self._rfile = handler.rfile
+        self._sock = handler.connection
+        self._send_lock = threading.Lock()
+
+    def send_text(self, text: str) -> None:
+        self._send(0x1, text.encode())
+
+    def _send(self, opcode: int, payload: bytes) -> None:
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self._send_lock:
+            self._sock.sendall(header + payload)
+
+    def receive(self) -> str | None:
+        "Returns the next text message, None once the connection is closed."
+        while True:
+            head = self._rfile.read(2)
+            if len(head) < 2:
+                return None
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if length == 126:
+                (length,) = struct.unpack("!H", self._rfile.read(2))
+            elif length == 127:
+                (length,) = struct.unpack("!Q", self._rfile.read(8))
+            mask = self._rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+            data = bytes(b ^ mask[i % 4] for i, b in enumerate(self._rfile.read(length)))
+            if opcode == 0x8:
+                self._send(0x8, data[:2])
+                return None
+            if opcode == 0x9:
+                self._send(0xA, data)
+            elif opcode == 0x1:
+                return data.decode()
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    server: "StandinServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+    def do_GET(self) -> None:
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            self._socket_mode()
+        else:
+            self._api(self._query())
+
+    def do_POST(self) -> None:
+        args = self._query()
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            args.update(json.loads(body or "{}"))
+        else:
+            args.update({k: v[-1] for k, v in urllib.parse.parse_qs(body).items()})
+        self._api(args)
+
+    def _query(self) -> dict:
+        query = urllib.parse.urlsplit(self.path).query
+        return {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+
+    def _api(self, args: dict) -> None:
+        path = urllib.parse.urlsplit(self.path).path
+        method = path.rsplit("/", 1)[-1]
+        server = self.server
+        with server.stats.lock:
+            server.stats.calls[method] += 1
+        retry_after = server.limiter.retry_after(method, args) if server.rate_limits else 0
+        if retry_after:
+            with server.stats.lock:
+                server.stats.ratelimited[method] += 1
+            self._reply(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": retry_after})
+            return
+        handler = getattr(server, "api_" + method.replace(".", "_"), None)
+        if handler is None:
+            self._reply(404, {"ok": False, "error": "unknown_method"})
+            return
+        self._reply(200, handler(args))
+
+    def _reply(self, status: int, data: dict, headers: dict | None = None) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _socket_mode(self) -> None:
+        key = self.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        ws = WebSocket(self)
+        hub = self.server.hub
+        hub.add(ws)
+        logger.info("Socket Mode client connected: %s", self.client_address)
+        try:
+            hello = {
+                "type": "hello",
+                "num_connections": 1,
+                "debug_info": {"host": "slack-standin"},
+                "connection_info": {"app_id": APP_ID},
+            }
+            ws.send_text(json.dumps(hello))
+            while (text := ws.receive()) is not None:
+                envelope_id = json.loads(text).get("envelope_id")
+                if envelope_id:
+                    hub.ack(envelope_id)
+        except (OSError, ValueError) as e:
+            logger.info("Socket Mode client failed: %s", e)
+        finally:
+            hub.remove(ws)
+            logger.info("Socket Mode client disconnected: %s", self.client_address)
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], workspace: Workspace, rate_limits: bool):
+        super().__init__(address, SlackHandler)
+        self.workspace = workspace
+        self.rate_limits = rate_limits
+        self.limiter = TierLimiter()
+        self.stats = Stats()
+        self.hub = SocketHub(self.stats)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.socket.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def api_auth_test(self, args: dict) -> dict:
+        return {
+            "ok": True,
+            "url": self.base_url,
+            "team": "standin",
+            "user": "karmabot",
+            "team_id": TEAM_ID,
+            "user_id": BOT_USER_ID,
+            "bot_id": "B0STANDIN",
+        }
+
+    def api_apps_connections_open(self, args: dict) -> dict:
+        host, port = self.socket.getsockname()[:2]
+        return {"ok": True, "url": f"ws://{host}:{port}/link"}
+
+    def api_users_info(self, args: dict) -> dict:
+        user = self.workspace.users_by_id.get(args.get("user", ""))
+        if user is None:
+            return {"ok": False, "error": "user_not_found"}
+        return {"ok": True, "user": user}
+
+    def api_users_list(self, args: dict) -> dict:
+        return _page(self.workspace.users, "members", args)
+
+    def api_conversations_info(self, args: dict) -> dict:
+        channel = self.workspace.channels_by_id.get(args.get("channel", ""))
+        if channel is None:
+            return {"ok": False, "error": "channel_not_found"}
+        return {"ok": True, "channel": channel}
+
+    def api_conversations_list(self, args: dict) -> dict:
+        return _page(self.workspace.channels, "channels", args)
+
+    def api_im_open(self, args: dict) -> dict:
+        return {"ok": True, "channel": {"id": "D" + args.get("user", "")[1:]}}
+
+    api_conversations_open = api_im_open
+
+    def api_reactions_get(self, args: dict) -> dict:
+        with self.workspace.lock:
+            key = (args.get("channel", ""), args.get("timestamp", ""))
+            stored = self.workspace.messages.get(key)
+            if stored is None:
+                return {"ok": False, "error": "message_not_found"}
+            reactions = [
+                {"name": name, "count": len(users), "users": sorted(users)}
+                for name, users in stored["reactions"].items()
+                if users
+            ]
+            message = {**stored["message"], "reactions": reactions}
+        return {"ok": True, "type": "message", "channel": args["channel"], "message": message}
+
+    def api_chat_postMessage(self, args: dict) -> dict:
+        channel = args.get("channel", "")
+        fields = {k: args[k] for k in ("attachments", "thread_ts") if args.get(k)}
+        ts = self.workspace.post(channel, BOT_USER_ID, args.get("text", ""), **fields)
+        message = self.workspace.messages[(channel, ts)]["message"]
+        return {"ok": True, "channel": channel, "ts": ts, "message": message}
+
+    def api_chat_update(self, args: dict) -> dict:
+        channel, ts = args.get("channel", ""), args.get("ts", "")
+        with self.workspace.lock:
+            stored = self.workspace.messages.get((channel, ts))
+            if stored is None:
+                return {"ok": False, "error": "message_not_found"}
+            stored["message"].update(
+                {k: args[k] for k in ("text", "attachments") if args.get(k) is not None}
+            )
+        return {"ok": True, "channel": channel, "ts": ts, "text": args.get("text", "")}
+
+
+def _user(user_id: str, name: str, is_bot: bool = False) -> dict:
+    return {
+        "id": user_id,
+        "team_id": TEAM_ID,
+        "name": name,
+        "deleted": False,
+        "is_bot": is_bot,
+        "profile": {"display_name": name, "real_name": name.title()},
+    }
+
+
+def _page(items: list[dict], key: str, args: dict) -> dict:
+    start = int(args.get("cursor") or 0)
+    limit = int(args.get("limit") or 100)
+    end = start + limit
+    next_cursor = str(end) if end < len(items) else ""
+    return {"ok": True, key: items[start:end], "response_metadata": {"next_cursor": next_cursor}}
+
+
+class EventStream(threading.Thread):
+    """Sends `app_mention` and reaction events at their rates per second.
+
+    Mentions vote for one or more random users; reactions are added to, or removed
+    from, the recent mentions and the bot's replies.
+    """
+
+    def __init__(
+        self,
+        server: StandinServer,
+        mention_rate: float,
+        reaction_rate: float,
+        emoji: list[str],
+        seed: int,
+    ) -> None:
+        super().__init__(name="event-stream", daemon=True)
+        self._server = server
+        self._rates = {"app_mention": mention_rate, "reaction": reaction_rate}
+        self._emoji = emoji
+        self._random = random.Random(seed)
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self) -> None:
+        total = sum(self._rates.values())
+        if total <= 0:
+            return
+        kinds = list(self._rates)
+        weights = [self._rates[k] for k in kinds]
+        due = time.monotonic()
+        while not self._stop.is_set():
+            # Poisson arrivals at the total rate
+            due += self._random.expovariate(total)
+            self._stop.wait(max(0.0, due - time.monotonic()))
+            (kind,) = self._random.choices(kinds, weights)
+            event = self._mention() if kind == "app_mention" else self._reaction()
+            if event is None:
+                continue
+            stats = self._server.stats
+            sent = self._server.hub.send_event(event)
+            with stats.lock:
+                if sent:
+                    stats.events[event["type"]] += 1
+                else:
+                    stats.dropped += 1
+
+    def _mention(self) -> dict:
+        workspace = self._server.workspace
+        rnd = self._random
+        channel = rnd.choice(workspace.channels)["id"]
+        initiator, *targets = rnd.sample(workspace.users[:-1], 1 + rnd.choice((1, 1, 1, 2, 3)))
+        mentions = " ".join(f"<@{t['id']}>" for t in targets)
+        vote = rnd.choice(("++", "+++", "--"))
+        text = f"<@{BOT_USER_ID}> {mentions} {vote} for the release"
+        ts = workspace.post(channel, initiator["id"], text)
+        return {
+            "type": "app_mention",
+            "user": initiator["id"],
+            "text": text,
+            "ts": ts,
+            "channel": channel,
+            "event_ts": ts,
+        }
+
+    def _reaction(self) -> dict | None:
+        reaction = self._random.choice(self._emoji)
+        result = self._server.workspace.react(self._random, reaction)
+        if result is None:
+            return None
+        channel, ts, user, count = result
+        return {
+            "type": "reaction_added" if count > 0 else "reaction_removed",
+            "user": user,
+            "reaction": reaction,
+            "item": {"type": "message", "channel": channel, "ts": ts},
+            "event_ts": f"{time.time():.6f}",
+        }
+
+
+@click.command(help="Serve a local stand-in for the Slack Web API and Socket Mode.")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8765, show_default=True)
+@click.option("--users", default=1000, show_default=True, help="Users in the workspace")
+@click.option("--channels", default=20, show_default=True, help="Channels in the workspace")
+@click.option("--mention-rate", default=1.0, show_default=True, help="app_mention events/s")
+@click.option("--reaction-rate", default=5.0, show_default=True, help="Reaction events/s")
+@click.option(
+    "--emoji",
+    multiple=True,
+    default=["+1", "-1", "+1::skin-tone-2", "tada"],
+    show_default=True,
+    help="Reactions to send, repeat for several",
+)
+@click.option(
+    "--rate-limits/--no-rate-limits",
+    default=True,
+    show_default=True,
+    help="Reject calls over the method's rate limit tier with HTTP 429",
+)
+@click.option("--report-interval", default=60.0, show_default=True, help="Seconds between stats")
+@click.option("--seed", default=0, show_default=True, help="Seed of the synthetic events")
+def main(
+    host: str,
+    port: int,
+    users: int,
+    channels: int,
+    mention_rate: float,
+    reaction_rate: float,
+    emoji: tuple[str, ...],
+    rate_limits: bool,
+    report_interval: float,
+    seed: int,
+) -> None:
+    logger.setLevel(logging.INFO)
+    server = StandinServer((host, port), Workspace(users, channels), rate_limits)
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    logger.info("Set `slack.api_url: %s/api/` in the bot's config", server.base_url)
+    events = EventStream(server, mention_rate, reaction_rate, list(emoji), seed)
+    events.start()
+    try:
+        while True:
+            time.sleep(report_interval)
+            logger.info(server.stats.report())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.stop()
+        server.shutdown()
+        logger.info(server.stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,113 @@
+"""Command line entry points.
+
+The bot's modules, and Slack, SQLAlchemy, APScheduler and pydantic with them,
+are imported by the commands that use them, so that `--help` and the light
+commands start fast.
+"""
+
 import importlib
 import importlib.resources
 import logging
 import pathlib
+import signal
+import time
+from collections.abc import Sequence
 
 import click
 
-from .karmabot import Karmabot
-from .scheduler import KarmabotScheduler
+from .defaults import PURGE_BATCH_SIZE, REBUILD_BATCH_SIZE
+from .logging import logger
 
 CONFIG_FILE_NAME = "config.yml"
 DEFAULT_CONFIG_PATH = str(pathlib.Path.home() / ".config" / "karmabot" / CONFIG_FILE_NAME)
+# Modules loaded by `karmabot`, in the order they are reported by `--import-profile`
+BOT_MODULES = (
+    "karmabot.config",
+    "karmabot.orm",
+    "karmabot.karma_manager",
+    "karmabot.karmabot",
+    "karmabot.scheduler",
+)
+ASYNC_BOT_MODULES = ("karmabot.async_karmabot",)
+
+
+def report_import_profile(modules: Sequence[str], config_path: pathlib.Path) -> None:
+    "Reports the time each module adds to the startup on top of the ones before it."
+    total = 0.0
+    for name in modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        seconds = time.perf_counter() - start
+        total += seconds
+        click.echo(f"{seconds * 1e3:9.1f} ms  import {name}")
+    if config_path.exists():
+        from .config import load_config
+
+        start = time.perf_counter()
+        load_config(config_path)
+        seconds = time.perf_counter() - start
+        total += seconds
+        click.echo(f"{seconds * 1e3:9.1f} ms  load {config_path}")
+    click.echo(f"{total * 1e3:9.1f} ms  total, see `python -X importtime` for the details")
 
 
 @click.command(help="karmabot is a Slack bot that manages karma.")
 @click.option("-c", "--config", default=DEFAULT_CONFIG_PATH, help="Path to config")
-def cli_app(config: str):
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Run the asyncio based bot (requires the `async` extra)",
+)
+@click.option(
+    "--import-profile",
+    is_flag=True,
+    help="Report how long the startup takes by module and exit",
+)
+def cli_app(config: str, use_async: bool, import_profile: bool):
     config_path = pathlib.Path(config)
+    if import_profile:
+        report_import_profile(
+            BOT_MODULES + ASYNC_BOT_MODULES if use_async else BOT_MODULES, config_path
+        )
+        return
     if not config_path.exists():
         raise click.FileError(config, "Can't locate a config file")
-    scheduler = KarmabotScheduler(config_path)
+
+    import sqlalchemy as sa
+
+    from . import metrics
+    from .config import load_config
+    from .orm import ASYNC_DRIVERS
+    from .profiling import PROFILER
+    from .scheduler import KarmabotScheduler
+
+    # Loaded once and shared by the scheduler and the bot
+    karmabot_config = load_config(config_path)
+    if use_async:
+        backend = sa.make_url(karmabot_config.db.url).get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            supported = ", ".join(ASYNC_DRIVERS)
+            raise click.UsageError(f"--async supports {supported} databases, not {backend}")
+    if karmabot_config.metrics.port is not None:
+        metrics.serve(karmabot_config.metrics.host, karmabot_config.metrics.port)
+    if karmabot_config.profiling.enabled and hasattr(signal, "SIGUSR1"):
+        # `kill -USR1 <pid>` logs the query profile
+        signal.signal(signal.SIGUSR1, lambda signum, frame: logger.warning(PROFILER.summary()))
+    scheduler = KarmabotScheduler(config_path, karmabot_config)
     scheduler.start()
-    bot = Karmabot(config_path)
-    bot.run()
+    if use_async:
+        import asyncio
+
+        # Depends on the optional packages
+        from .async_karmabot import AsyncKarmabot
+
+        asyncio.run(AsyncKarmabot(karmabot_config).run())
+    else:
+        from .karmabot import Karmabot
+
+        bot = Karmabot(karmabot_config)
+        bot.run()
 
 
 @click.command(help="Create a default config.")
@@ -37,3 +123,51 @@ def cli_init(config: str):
     config_path.parent.mkdir(exist_ok=True, parents=True)
     config_path.write_text(text)
     logging.info("Inited with config: %s", text)
+
+
+@click.command(help="Remove closed votings older than `karma.keep_history`.")
+@click.option("-c", "--config", default=DEFAULT_CONFIG_PATH, help="Path to config")
+@click.option(
+    "-b",
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=PURGE_BATCH_SIZE,
+    show_default=True,
+    help="Max number of votings deleted in one transaction",
+)
+def cli_purge(config: str, batch_size: int):
+    config_path = pathlib.Path(config)
+    if not config_path.exists():
+        raise click.FileError(config, "Can't locate a config file")
+
+    from .config import load_config
+    from .karma_manager import KarmaManager
+
+    karmabot_config = load_config(config_path)
+    logger.setLevel(karmabot_config.log_level.upper())
+    removed = KarmaManager(karmabot_config).remove_old_votings(batch_size)
+    click.echo(f"Removed {removed} votings")
+
+
+@click.command(help="Recompute karma balances from the karma ledger.")
+@click.option("-c", "--config", default=DEFAULT_CONFIG_PATH, help="Path to config")
+@click.option(
+    "-b",
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=REBUILD_BATCH_SIZE,
+    show_default=True,
+    help="Max number of users recomputed in one transaction",
+)
+def cli_rebuild(config: str, batch_size: int):
+    config_path = pathlib.Path(config)
+    if not config_path.exists():
+        raise click.FileError(config, "Can't locate a config file")
+
+    from .config import load_config
+    from .karma_manager import KarmaManager
+
+    karmabot_config = load_config(config_path)
+    logger.setLevel(karmabot_config.log_level.upper())
+    corrected = KarmaManager(karmabot_config).rebuild_balances(batch_size)
+    click.echo(f"Corrected {corrected} balances")
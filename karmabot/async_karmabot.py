@@ -0,0 +1,371 @@
+"""An asyncio based bot built on `AsyncApp`, async Socket Mode and async SQLAlchemy.
+
+It behaves the same as `Karmabot` but handles events without blocking a thread
+per request. Requires the `async` extra: aiohttp and an async DB driver
+(asyncpg for PostgreSQL, aiosqlite for SQLite).
+"""
+
+import asyncio
+import functools
+from collections import Counter
+from collections.abc import Callable, Iterable
+
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+from slack_sdk.errors import SlackApiError
+
+from .async_slack_utils import (
+    AsyncSlackDirectory,
+    LimitedAsyncWebClient,
+    message_post,
+    message_update,
+    post_im,
+    reactions_get,
+)
+from .config import KarmabotConfig
+from .expiry import ExpiryTimer
+from .karma_manager import AsyncKarmaManager
+from .karmabot import (
+    BULK_LOOKUP_THRESHOLD,
+    CLAIM_BATCH_SIZE,
+    CLAIM_LEASE,
+    DIGEST_CHUNK_SIZE,
+    DIGEST_EMPTY,
+    DIGEST_HEADER,
+    RANK_NEIGHBOURS,
+    TOP_MAX,
+    KarmabotBase,
+    TextChunks,
+    handling,
+)
+from .logging import logger
+from .metrics import OPEN_VOTINGS
+from .orm import Voting
+from .parse import Parse, SetArgs, UserArgs
+from .router import CommandRouter
+from .slack_utils import format_ts
+from .words import Color
+
+# Seconds to wait for the event loop to collect a metric
+METRICS_TIMEOUT = 5
+
+
+class AsyncKarmabot(KarmabotBase):
+    # Built once when the class is defined, handlers register with `@commands.command`
+    commands = CommandRouter()
+
+    def __init__(self, config: KarmabotConfig) -> None:
+        super().__init__(config)
+        client = LimitedAsyncWebClient(
+            token=self._config.slack_bot_token,
+            base_url=self._config.slack.api_url,
+            logger=logger,
+        )
+        self.slack_app = AsyncApp(client=client, logger=logger)
+        self._manager = AsyncKarmaManager(config=self._config)
+        self._expiry = ExpiryTimer(self._close_expired_votings_from_thread)
+        self._directory = AsyncSlackDirectory(
+            self.slack_app.client,
+            maxsize=self._config.slack.directory_size,
+            ttl=self._config.slack.directory_ttl.total_seconds(),
+        )
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        @self.slack_app.event("team_join")
+        async def _team_join_callback(event):
+            logger.debug("[team_join] %s", event)
+            with handling("team_join"):
+                await self._handle_team_join(event)
+
+        @self.slack_app.event("user_change")
+        async def _user_change_callback(event):
+            logger.debug("[user_change] %s", event)
+            self._directory.update_user(event["user"])
+
+        @self.slack_app.event("app_mention")
+        async def _app_mention_callback(event):
+            logger.debug("[app_mention] %s", event)
+            with handling("app_mention"):
+                await self._handle_app_mention(event)
+
+        if self._config.karma.live_tally:
+
+            @self.slack_app.event("reaction_added")
+            async def _reaction_added_callback(event):
+                logger.debug("[reaction_added] %s", event)
+                await self._handle_reaction(event, 1)
+
+            @self.slack_app.event("reaction_removed")
+            async def _reaction_removed_callback(event):
+                logger.debug("[reaction_removed] %s", event)
+                await self._handle_reaction(event, -1)
+
+        @self.slack_app.command("/karmabot")
+        async def _command_callback(ack: Callable, respond: Callable, command: dict):
+            await ack()
+            logger.debug("[command] %s", command)
+            await self._handle_command(respond, command)
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self._manager.upgrade_schema()
+            self._watch_expiry(await self._manager.pending())
+            self._expiry.start()
+            OPEN_VOTINGS.set_function(self._count_pending_from_thread)
+            handler = AsyncSocketModeHandler(self.slack_app, self._config.slack_app_token)
+            await handler.start_async()
+        finally:
+            OPEN_VOTINGS.set_function(None)
+            await self._manager.close()
+
+    def _count_pending_from_thread(self) -> int:
+        # Metrics are collected by the HTTP server thread, the DB engine belongs to the loop
+        assert self._loop is not None
+        future = asyncio.run_coroutine_threadsafe(self._manager.count_pending(), self._loop)
+        return future.result(timeout=METRICS_TIMEOUT)
+
+    async def report_digest(self, reply_callback: Callable | None = None) -> None:
+        thread_ts = None
+
+        async def post(text: str) -> None:
+            nonlocal thread_ts
+            message = self._format.message(Color.INFO, text)
+            if reply_callback is not None:
+                await reply_callback(message)
+                return
+            response = await message_post(
+                self.slack_app.client, self._config.digest.channel, message, ts=thread_ts
+            )
+            thread_ts = thread_ts or response["ts"]
+
+        chunks = TextChunks(DIGEST_CHUNK_SIZE, DIGEST_HEADER)
+        first = True
+        async for page in self._manager.digest():
+            if first and len(page) > BULK_LOOKUP_THRESHOLD:
+                await self._directory.warm_users()
+            first = False
+            usernames = await asyncio.gather(*(self._directory.username(u) for u, _ in page))
+            for username, (_, karma) in zip(usernames, page, strict=True):
+                if (text := chunks.add(self._digest_line(username, karma))) is not None:
+                    await post(text)
+        await post(chunks.flush() or DIGEST_EMPTY)
+
+    async def close_expired_votings(self) -> None:
+        "See `Karmabot.close_expired_votings`."
+        logger.info("Looking for expired votings.")
+        unresolved: list[int] = []
+        while True:
+            claimed = await self._manager.claim_expired_votings(CLAIM_BATCH_SIZE, CLAIM_LEASE)
+            if claimed:
+                unresolved.extend(await self._close_claimed_votings(claimed))
+            if len(claimed) < CLAIM_BATCH_SIZE:
+                break
+        if unresolved:
+            await self._manager.release_votings(unresolved)
+
+    async def _close_claimed_votings(self, claimed: list[Voting]) -> list[int]:
+        # `LimitedAsyncWebClient` keeps the calls per minute of each method
+        # within its rate limit tier
+        # Votings of one message are fetched and reported together.
+        groups = self._group_by_message(claimed)
+        fetched = await asyncio.gather(*map(self._get_voting_reactions, groups))
+        closed = await self._manager.close_votings(r for results in fetched for r in results)
+        results = [[(v, closed[v.id]) for v in group if v.id in closed] for group in groups]
+        await asyncio.gather(*map(self._report_voting_result, filter(None, results)))
+        return [v.id for v in claimed if v.id not in closed]
+
+    def _close_expired_votings_from_thread(self) -> None:
+        # Called by the expiry timer from its own thread
+        assert self._loop is not None
+        # The task copies the context of this thread, so the queries are profiled too
+        with handling("expiry"):
+            future = asyncio.run_coroutine_threadsafe(self.close_expired_votings(), self._loop)
+            future.result()
+
+    def _watch_expiry(self, votings: Iterable[Voting]) -> None:
+        for voting in votings:
+            deadline = self._manager.expires_at(voting)
+            if deadline is not None:
+                self._expiry.push(deadline, voting.id)
+
+    async def _get_voting_reactions(
+        self, votings: list[Voting]
+    ) -> list[tuple[Voting, Counter[str] | None]]:
+        voting = votings[0]
+        if voting.live_tally:
+            # Decided by the tally, no need to ask Slack
+            return [(v, None) for v in votings]
+        assert voting.bot_message_ts is not None, "expired votings have a bot message"
+        initial_msg_ts = format_ts(voting.message_ts)
+        bot_msg_ts = format_ts(voting.bot_message_ts)
+        logger.info("Expired voting: %s [%s] [%s]", voting, initial_msg_ts, bot_msg_ts)
+        try:
+            reactions = await reactions_get(
+                client=self.slack_app.client,
+                channel=voting.channel,
+                initial_msg_ts=initial_msg_ts,
+                bot_msg_ts=bot_msg_ts,
+            )
+        except SlackApiError as e:
+            error = e.response.get("error")
+            if error == "message_not_found":
+                # Removed as votings without reactions
+                return [(v, None) for v in votings]
+            logger.warning("Failed to get reactions for %s: %s", voting, error)
+            return []
+        return [(v, reactions) for v in votings]
+
+    async def _report_voting_result(self, results: list[tuple[Voting, bool]]) -> None:
+        voting, success = results[0]
+        assert voting.bot_message_ts is not None, "expired votings have a bot message"
+        bot_msg_ts = format_ts(voting.bot_message_ts)
+        try:
+            usernames = await asyncio.gather(
+                *(self._directory.username(v.target_id) for v, _ in results)
+            )
+            msg = self._format.voting_result(
+                self._join_usernames(usernames), voting.karma, success
+            )
+            await message_update(self.slack_app.client, voting.channel, msg, ts=bot_msg_ts)
+        except SlackApiError as e:
+            logger.warning("Failed to report a result of %s: %s", voting, e.response.get("error"))
+
+    async def _handle_team_join(self, event: dict) -> None:
+        logger.info("Processing event: %s", event)
+        user_id = event["user"]["id"]
+        self._directory.update_user(event["user"])
+        await post_im(self.slack_app.client, user_id, self._format.hello())
+        logger.info("Team joined by user_id=%s", user_id)
+
+    async def _handle_reaction(self, event: dict, count: int) -> None:
+        item = event["item"]
+        if item.get("type") != "message":
+            return
+        await self._manager.tally_reaction(item["channel"], item["ts"], event["reaction"], count)
+
+    async def _handle_app_mention(self, event: dict) -> None:
+        result = self._check_app_mention(event)
+        if result is None:
+            return
+        channel = event["channel"]
+        ts = event["ts"]
+        if isinstance(result, dict):
+            await message_post(self.slack_app.client, channel, result, ts=ts)
+            return
+
+        user_ids, karma = result
+        usernames = await asyncio.gather(*map(self._directory.username, user_ids))
+        msg = self._format.new_voting(self._join_usernames(usernames), karma)
+        response = await message_post(self.slack_app.client, channel, msg, ts=ts)
+        bot_message_ts = response["ts"]
+        reactions = None
+        if self._config.karma.live_tally:
+            reactions = await self._get_initial_reactions(channel, ts, bot_message_ts)
+        votings = await self._manager.create(
+            initiator_id=event["user"],
+            target_ids=user_ids,
+            channel=channel,
+            text=event["text"],
+            ts=ts,
+            bot_message_ts=bot_message_ts,
+            karma=karma,
+            reactions=reactions,
+        )
+        self._watch_expiry(votings)
+
+    async def _get_initial_reactions(
+        self, channel: str, ts: str, bot_message_ts: str
+    ) -> Counter[str] | None:
+        # Reactions made before the voting exists are missed by the live tally
+        try:
+            return await reactions_get(
+                client=self.slack_app.client,
+                channel=channel,
+                initial_msg_ts=ts,
+                bot_msg_ts=bot_message_ts,
+            )
+        except SlackApiError as e:
+            logger.warning("Failed to get initial reactions: %s", e.response.get("error"))
+            return None
+
+    async def _handle_command(self, respond: Callable, command: dict) -> None:
+        respond = functools.partial(respond, response_type="ephemeral")
+        route = self.commands.resolve(command["text"])
+        if route is None:
+            # A default behavior is to error
+            logger.info("Unknown command: %s", command["text"])
+            await respond(self._format.cmd_error())
+            return
+        logger.info("Handling command '%s'", route.name)
+        with handling(f"command:{route.name}"):
+            await route.handler(self, respond, command, route.args)
+
+    @commands.command("get", Parse.cmd_get)
+    async def _cmd_get(self, respond: Callable, command: dict, args: UserArgs) -> None:
+        if not args.user_name:
+            logger.warning("Failed to parse 'get' command args")
+            return
+        karma = await self._manager.get(args.user_id)
+        await respond(self._format.report_karma(args.user_name, karma))
+
+    @commands.command("set", Parse.cmd_set)
+    async def _cmd_set(self, respond: Callable, command: dict, args: SetArgs) -> None:
+        if command["user_name"] not in self._admins:
+            logger.warning("Only admins can set the karma")
+            return
+        if not args.user_name:
+            logger.warning("Failed to parse 'set' command args")
+            return
+        await self._manager.set(user_id=args.user_id, karma=args.karma)
+        await respond(self._format.report_karma(args.user_name, args.karma))
+
+    @commands.command("top", Parse.cmd_top)
+    async def _cmd_top(self, respond: Callable, command: dict, size: int) -> None:
+        top = await self._manager.top(min(size, TOP_MAX))
+        if len(top) > BULK_LOOKUP_THRESHOLD:
+            await self._directory.warm_users()
+        usernames = await asyncio.gather(*(self._directory.username(u) for u, _ in top))
+        message = self._top_message(
+            [(name, k) for name, (_, k) in zip(usernames, top, strict=True)]
+        )
+        await respond(self._format.message(Color.INFO, message))
+
+    @commands.command("rank", Parse.cmd_rank)
+    async def _cmd_rank(self, respond: Callable, command: dict, args: UserArgs) -> None:
+        user_id = args.user_id
+        user_name = args.user_name or await self._directory.username(user_id)
+        rank = await self._manager.rank(user_id)
+        neighbours = await self._manager.neighbours(user_id, RANK_NEIGHBOURS)
+        names = [
+            user_name if u == user_id else await self._directory.username(u) for u, _ in neighbours
+        ]
+        message = self._rank_message(
+            user_name, rank, [(n, k) for n, (_, k) in zip(names, neighbours, strict=True)]
+        )
+        await respond(self._format.message(Color.INFO, message))
+
+    @commands.command("digest")
+    async def _cmd_digest(self, respond: Callable, command: dict, args: None) -> None:
+        await self.report_digest(reply_callback=respond)
+
+    @commands.command("pending")
+    async def _cmd_pending(self, respond: Callable, command: dict, args: None) -> None:
+        pending = await self._manager.pending()
+        if len(pending) > BULK_LOOKUP_THRESHOLD:
+            await self._directory.warm_users()
+            await self._directory.warm_channels()
+        items = [
+            (
+                voting,
+                await self._directory.username(voting.initiator_id),
+                await self._directory.username(voting.target_id),
+                await self._directory.channel_name(voting.channel),
+            )
+            for voting in pending
+        ]
+        await respond(self._format.message(Color.INFO, self._pending_message(items)))
+
+    @commands.command("help")
+    async def _cmd_help(self, respond: Callable, command: dict, args: None) -> None:
+        await respond(self._format.hello())
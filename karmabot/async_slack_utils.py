@@ -0,0 +1,149 @@
+"""Asyncio counterparts of `slack_utils` used by `AsyncKarmabot`."""
+
+import asyncio
+from collections import Counter
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncSlackResponse, AsyncWebClient
+
+from .logging import logger
+from .metrics import SLACK_CALLS, SLACK_ERRORS
+from .slack_utils import (
+    PAGE_SIZE,
+    RATE_LIMIT_RETRIES,
+    DirectoryCache,
+    RateLimiter,
+    add_reactions,
+    api_error,
+    next_cursor,
+    user_display_name,
+)
+
+
+class LimitedAsyncWebClient(AsyncWebClient):
+    """`LimitedWebClient` counterpart for asyncio."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.retry_handlers.append(
+            AsyncRateLimitErrorRetryHandler(max_retry_count=RATE_LIMIT_RETRIES)
+        )
+        self._limiter = RateLimiter()
+
+    async def api_call(self, api_method: str, **kwargs) -> AsyncSlackResponse:
+        delay = self._limiter.reserve(api_method)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        SLACK_CALLS.inc(method=api_method)
+        try:
+            return await super().api_call(api_method, **kwargs)
+        except Exception as e:
+            SLACK_ERRORS.inc(method=api_method, error=api_error(e))
+            raise
+
+
+async def paginate(
+    method: Callable[..., Awaitable[AsyncSlackResponse]], key: str, **kwargs
+) -> AsyncIterator[dict]:
+    cursor = None
+    while True:
+        page = await method(limit=PAGE_SIZE, cursor=cursor, **kwargs)
+        for item in page.get(key) or []:
+            yield item
+        cursor = next_cursor(page)
+        if not cursor:
+            return
+
+
+async def lookup_username(client: AsyncWebClient, user_id: str) -> str:
+    user = user_id.strip("<>@")
+    userinfo = await client.users_info(user=user)
+    return user_display_name(userinfo["user"])
+
+
+async def lookup_channel_name(client: AsyncWebClient, channel_id: str) -> str:
+    channel_id = channel_id.strip("<>@")
+    channel_info = await client.conversations_info(channel=channel_id)
+    return channel_info["channel"]["name"]
+
+
+async def reactions_get(
+    client: AsyncWebClient, channel: str, initial_msg_ts: str, bot_msg_ts: str
+) -> Counter[str] | None:
+    r: Counter[str] = Counter()
+    for ts in (initial_msg_ts, bot_msg_ts):
+        result = await client.reactions_get(channel=channel, timestamp=ts)
+        logger.info(f"Getting reactions: {result}")
+        message = result.get("message")
+        if message is None:
+            return None
+        add_reactions(r, message)
+    return r
+
+
+async def message_post(
+    client: AsyncWebClient, channel: str, msg: dict, ts: str | None = None
+) -> AsyncSlackResponse:
+    logger.info(f"Sending message to {channel}: {msg}")
+    return await client.chat_postMessage(
+        channel=channel, link_names=True, as_user=True, thread_ts=ts, **msg
+    )
+
+
+async def message_update(
+    client: AsyncWebClient, channel: str, msg: dict, ts: str
+) -> AsyncSlackResponse:
+    logger.info(f"Sending update to {channel}: {msg}")
+    return await client.chat_update(channel=channel, link_names=True, as_user=True, ts=ts, **msg)
+
+
+async def post_im(client: AsyncWebClient, user_id: str, msg: dict) -> AsyncSlackResponse:
+    new_dm = await client.im_open(user=user_id)
+    return await message_post(client, new_dm["channel"]["id"], msg)
+
+
+class AsyncSlackDirectory(DirectoryCache):
+    """`SlackDirectory` counterpart for `AsyncWebClient`."""
+
+    def __init__(self, client: AsyncWebClient, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self._client = client
+        self._lock = asyncio.Lock()
+
+    async def username(self, user_id: str) -> str:
+        user_id = user_id.strip("<>@")
+        name = self._users.get(user_id)
+        if name is None:
+            name = await lookup_username(self._client, user_id)
+            self._users.set(user_id, name)
+        return name
+
+    async def channel_name(self, channel_id: str) -> str:
+        channel_id = channel_id.strip("<>@")
+        name = self._channels.get(channel_id)
+        if name is None:
+            name = await lookup_channel_name(self._client, channel_id)
+            self._channels.set(channel_id, name)
+        return name
+
+    async def warm_users(self) -> None:
+        async with self._lock:
+            if self._is_warm("users"):
+                return
+            loaded = 0
+            async for user in paginate(self._client.users_list, "members"):
+                self._store_user(user)
+                loaded += 1
+            self._set_warm("users", loaded)
+
+    async def warm_channels(self) -> None:
+        async with self._lock:
+            if self._is_warm("channels"):
+                return
+            loaded = 0
+            channels = paginate(self._client.conversations_list, "channels", exclude_archived=True)
+            async for channel in channels:
+                self._store_channel(channel)
+                loaded += 1
+            self._set_warm("channels", loaded)
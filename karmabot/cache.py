@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Generic, TypeVar
+
+from .metrics import CACHE_REQUESTS
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """Thread-safe LRU cache which entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float, name: str | None = None) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # Caches with a name report their hits and misses to `CACHE_REQUESTS`
+        self._name = name
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                value = None
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[1]
+        if self._name is not None:
+            CACHE_REQUESTS.inc(cache=self._name, result="miss" if value is None else "hit")
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
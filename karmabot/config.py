@@ -1,8 +1,17 @@
 from __future__ import annotations
 
 import datetime
+import pathlib
 
+import pydantic
 import pydantic_settings
+import yaml
+
+
+def load_config(config_path: pathlib.Path) -> KarmabotConfig:
+    with config_path.open("r") as f:
+        config_dict = yaml.safe_load(f)
+    return KarmabotConfig.model_validate(config_dict)
 
 
 class KarmabotConfig(pydantic_settings.BaseSettings):
@@ -10,10 +19,36 @@ class KarmabotConfig(pydantic_settings.BaseSettings):
     lang: str
     slack_bot_token: str
     slack_app_token: str
-    db: str
+    db: KarmabotDbConfig
     admins: list[str]
     digest: KarmabotDigestConfig
     karma: KarmabotKarmaConfig
+    slack: KarmabotSlackConfig = pydantic.Field(default_factory=lambda: KarmabotSlackConfig())
+    metrics: KarmabotMetricsConfig = pydantic.Field(
+        default_factory=lambda: KarmabotMetricsConfig()
+    )
+    profiling: KarmabotProfilingConfig = pydantic.Field(
+        default_factory=lambda: KarmabotProfilingConfig()
+    )
+
+    @pydantic.field_validator("db", mode="before")
+    @classmethod
+    def _db_from_url(cls, value):
+        # `db` may be set just as a URL
+        if isinstance(value, str):
+            return {"url": value}
+        return value
+
+
+class KarmabotDbConfig(pydantic_settings.BaseSettings):
+    url: str
+    pool_size: int = 2
+    max_overflow: int = 3
+    pool_timeout: datetime.timedelta = datetime.timedelta(seconds=30)
+    pool_recycle: datetime.timedelta | None = None
+    pool_pre_ping: bool = True
+    sqlite_busy_timeout: datetime.timedelta = datetime.timedelta(seconds=5)
+    sqlite_mmap_size: int = 64 * 1024 * 1024
 
 
 class KarmabotDigestConfig(pydantic_settings.BaseSettings):
@@ -29,5 +64,35 @@ class KarmabotKarmaConfig(pydantic_settings.BaseSettings):
     self_karma: bool
     vote_timeout: datetime.timedelta
     keep_history: datetime.timedelta
+    sweep_interval: datetime.timedelta = datetime.timedelta(minutes=10)
     upvote_emoji: list[str]
     downvote_emoji: list[str]
+    live_tally: bool = False
+    # Cached balances are refreshed from the DB after the TTL, which bounds how long
+    # the changes made by other processes sharing the DB may be missed
+    balance_cache_ttl: datetime.timedelta = datetime.timedelta(seconds=30)
+    balance_cache_size: int = 10000
+
+
+class KarmabotSlackConfig(pydantic_settings.BaseSettings):
+    directory_ttl: datetime.timedelta = datetime.timedelta(hours=1)
+    directory_size: int = 10000
+    max_workers: int = 8
+    # Web API base URL, e.g. of a local stand-in for load tests
+    api_url: str = "https://slack.com/api/"
+    # How often the outbox is checked for messages saved by other processes or retried
+    outbox_interval: datetime.timedelta = datetime.timedelta(seconds=5)
+
+
+class KarmabotMetricsConfig(pydantic_settings.BaseSettings):
+    # Port of the Prometheus endpoint, metrics are not served without it
+    port: int | None = None
+    host: str = "127.0.0.1"
+
+
+class KarmabotProfilingConfig(pydantic_settings.BaseSettings):
+    enabled: bool = False
+    # Queries that take longer are logged with their parameters
+    slow_query: datetime.timedelta = datetime.timedelta(milliseconds=100)
+    # A statement executed this many times while handling one event is flagged
+    repeated_queries: int = 5
@@ -0,0 +1,7 @@
+"""Defaults shared by the CLI and the modules it imports on demand.
+
+Kept free of dependencies, so that `--help` doesn't load the bot.
+"""
+
+PURGE_BATCH_SIZE = 1000
+REBUILD_BATCH_SIZE = 1000
@@ -0,0 +1,52 @@
+import heapq
+import threading
+from collections.abc import Callable
+from datetime import datetime, timezone
+
+from .logging import logger
+
+
+class ExpiryTimer:
+    """Runs a callback as soon as a voting deadline is reached.
+
+    Deadlines are kept in a min-heap. The timer thread sleeps until the earliest
+    deadline, or until an earlier one is pushed, and then calls `callback` once
+    for all the deadlines that are due.
+    """
+
+    def __init__(self, callback: Callable[[], None]) -> None:
+        self._callback = callback
+        self._heap: list[tuple[datetime, int]] = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="expiry-timer", daemon=True)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def push(self, deadline: datetime, voting_id: int) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, voting_id))
+            if self._heap[0] == (deadline, voting_id):
+                self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                timeout = (self._heap[0][0] - datetime.now(tz=timezone.utc)).total_seconds()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                now = datetime.now(tz=timezone.utc)
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[1])
+            logger.info("Votings expired: %s", due)
+            try:
+                self._callback()
+            except Exception:
+                logger.exception("Failed to process expired votings: %s", due)
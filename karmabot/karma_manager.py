@@ -1,127 +1,870 @@
+import json
 from collections import Counter
-from datetime import datetime, timezone
+from collections.abc import AsyncIterator, Collection, Iterable, Iterator
+from datetime import datetime, timedelta, timezone
 
 import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
 
+from .cache import TTLCache
 from .config import KarmabotConfig
+from .defaults import PURGE_BATCH_SIZE, REBUILD_BATCH_SIZE
 from .logging import logger
-from .orm import Karma, Voting, create_session_maker
+from .orm import (
+    Karma,
+    KarmaLedger,
+    Lease,
+    LedgerKind,
+    OutboxKind,
+    OutboxMessage,
+    Voting,
+    create_async_db_engine,
+    create_session_maker,
+    dialect_insert,
+    upgrade_schema_async,
+)
 
+DIGEST_PAGE_SIZE = 500
+
+
+class KarmaManagerBase:
+    """Karma operations shared by the sync and the async managers.
+
+    The operations work with a sync `Session`, the async manager runs them
+    with `AsyncSession.run_sync`.
+    """
 
-class KarmaManager:
     def __init__(self, config: KarmabotConfig) -> None:
         self._initial_value = config.karma.initial_value
         self._vote_timeout = config.karma.vote_timeout
         self._upvote_emoji = config.karma.upvote_emoji
         self._downvote_emoji = config.karma.downvote_emoji
         self._keep_history = config.karma.keep_history
-        self._session_maker = create_session_maker(config.db)
+        self._live_tally = config.karma.live_tally
+        # Balances by user id, kept up to date by the writes of this process and
+        # expiring after `karma.balance_cache_ttl` for the writes of other processes
+        self.balances: TTLCache[str, int] = TTLCache(
+            maxsize=config.karma.balance_cache_size,
+            ttl=config.karma.balance_cache_ttl.total_seconds(),
+            name="balances",
+        )
 
-    def get(self, user_id: str) -> int:
+    def expires_at(self, voting: Voting) -> datetime | None:
+        "Returns None until the voting's bot message is posted."
+        if voting.bot_message_ts is None:
+            return None
+        return voting.bot_message_ts + self._vote_timeout
+
+    def _get(self, session: Session, user_id: str) -> int:
         stmt = sa.select(Karma).filter_by(user_id=user_id).limit(1)
-        with self._session_maker() as session:
-            karma = session.execute(stmt).scalar_one_or_none()
-            if karma is not None:
-                value = karma.karma
-            else:
-                value = self._initial_value
+        karma = session.execute(stmt).scalar_one_or_none()
+        if karma is not None:
+            value = karma.karma
+        else:
+            value = self._initial_value
         return value
 
-    def set(self, user_id: str, karma: int) -> None:
-        stmt = sa.select(Karma).filter_by(user_id=user_id).limit(1)
-        with self._session_maker.begin() as session:
-            karma_change = session.execute(stmt).scalar_one_or_none()
-            if karma_change is not None:
-                karma_change.karma = karma
-            else:
-                session.add(Karma(user_id=user_id, karma=karma))
+    def _set(self, session: Session, user_id: str, karma: int) -> None:
+        self._ensure_balances(session, [user_id])
+        stmt = sa.select(Karma).filter_by(user_id=user_id).with_for_update()
+        balance = session.execute(stmt).scalar_one()
+        delta = karma - balance.karma
+        balance.karma = karma
+        if delta:
+            session.add(KarmaLedger(user_id=user_id, delta=delta, kind=LedgerKind.SET))
 
-    def digest(self) -> list[Karma]:
-        stmt = sa.select(Karma).filter(Karma.karma != 0).order_by(Karma.karma.desc())
-        with self._session_maker() as session:
-            return session.execute(stmt).scalars().all()
+    def _get_change(self, session: Session, user_id: str, since: datetime) -> int:
+        stmt = sa.select(sa.func.coalesce(sa.func.sum(KarmaLedger.delta), 0)).where(
+            KarmaLedger.user_id == user_id,
+            KarmaLedger.created >= since,
+            KarmaLedger.kind != LedgerKind.INITIAL,
+        )
+        return session.execute(stmt).scalar_one()
 
-    def pending(self) -> list[Voting]:
+    def _digest(
+        self, session: Session, limit: int, after: tuple[int, str] | None = None
+    ) -> list[tuple[str, int]]:
+        return self._top(session, limit, after, skip_zero=True)
+
+    def _top(
+        self,
+        session: Session,
+        limit: int,
+        after: tuple[int, str] | None = None,
+        skip_zero: bool = False,
+    ) -> list[tuple[str, int]]:
+        # Keyset pagination: the next page starts after the last row of the previous one
+        stmt = sa.select(Karma.user_id, Karma.karma)
+        if skip_zero:
+            stmt = stmt.where(Karma.karma != 0)
+        if after is not None:
+            stmt = stmt.where(sa.tuple_(Karma.karma, Karma.user_id) < after)
+        stmt = stmt.order_by(Karma.karma.desc(), Karma.user_id.desc()).limit(limit)
+        return [(u, k) for u, k in session.execute(stmt)]
+
+    def _rank(self, session: Session, user_id: str) -> tuple[int, int] | None:
+        karma = session.execute(
+            sa.select(Karma.karma).filter_by(user_id=user_id)
+        ).scalar_one_or_none()
+        if karma is None:
+            return None
+        # Users with equal karma share a rank
+        higher = session.execute(
+            sa.select(sa.func.count()).select_from(Karma).where(Karma.karma > karma)
+        ).scalar_one()
+        return higher + 1, karma
+
+    def _neighbours(self, session: Session, user_id: str, size: int) -> list[tuple[str, int]]:
+        karma = session.execute(
+            sa.select(Karma.karma).filter_by(user_id=user_id)
+        ).scalar_one_or_none()
+        if karma is None:
+            return []
+        key = sa.tuple_(Karma.karma, Karma.user_id)
+        above_stmt = (
+            sa.select(Karma.user_id, Karma.karma)
+            .where(key > (karma, user_id))
+            .order_by(Karma.karma, Karma.user_id)
+            .limit(size)
+        )
+        above = [(u, k) for u, k in session.execute(above_stmt)]
+        below = self._top(session, size, after=(karma, user_id))
+        return [*reversed(above), (user_id, karma), *below]
+
+    def _pending(self, session: Session) -> list[Voting]:
         stmt = sa.select(Voting).filter(Voting.closed == False)
-        with self._session_maker() as session:
-            return session.execute(stmt).scalars().all()
+        return list(session.execute(stmt).scalars().all())
 
-    def create(
+    def _count_pending(self, session: Session) -> int:
+        stmt = sa.select(sa.func.count()).select_from(Voting).filter(Voting.closed == False)
+        return session.execute(stmt).scalar_one()
+
+    def _create(
         self,
-        *,
+        session: Session,
         initiator_id: str,
-        target_id: str,
+        target_ids: list[str],
         channel: str,
         text: str,
         ts: str,
-        bot_message_ts: str,
+        bot_message_ts: str | None,
         karma: int,
-    ) -> None:
+        reactions: Counter[str] | None = None,
+        message: dict | None = None,
+    ) -> list[Voting]:
         ts_dt = datetime.fromtimestamp(float(ts), tz=timezone.utc)
-        bot_message_ts_dt = datetime.fromtimestamp(float(bot_message_ts), tz=timezone.utc)
-        with self._session_maker.begin() as session:
-            # Check for an already existing voting
-            stmt = sa.select(Voting).filter_by(uuid=(ts_dt, channel))
-            instance = session.execute(stmt).scalar_one_or_none()
-            if instance is not None:
-                logger.fatal("Voting already exists: ts=%s, channel=%s", ts, channel)
-                return
-
-            session.add(
-                Voting(
-                    initiator_id=initiator_id,
-                    target_id=target_id,
-                    channel=channel,
-                    message_ts=ts_dt,
-                    bot_message_ts=bot_message_ts_dt,
-                    message_text=text,
-                    karma=karma,
-                )
+        bot_message_ts_dt = None
+        if bot_message_ts is not None:
+            bot_message_ts_dt = datetime.fromtimestamp(float(bot_message_ts), tz=timezone.utc)
+        upvotes = downvotes = 0
+        if self._live_tally and reactions:
+            upvotes, downvotes = self._count_votes(reactions)
+        votings = [
+            Voting(
+                initiator_id=initiator_id,
+                target_id=target_id,
+                channel=channel,
+                message_ts=ts_dt,
+                bot_message_ts=bot_message_ts_dt,
+                message_text=text,
+                karma=karma,
+                live_tally=self._live_tally,
+                upvotes=upvotes,
+                downvotes=downvotes,
             )
+            for target_id in target_ids
+        ]
+        try:
+            # An already existing voting is caught by the unique index, even one
+            # created concurrently, and the savepoint keeps the transaction usable.
+            # The votings are inserted in one batch.
+            with session.begin_nested():
+                session.add_all(votings)
+                if message is not None:
+                    self._enqueue(session, OutboxKind.NEW_VOTING, channel, ts, message)
+        except IntegrityError:
+            logger.fatal("Voting already exists: ts=%s, channel=%s", ts, channel)
+            return []
+        for voting in votings:
+            session.expunge(voting)
+        return votings
 
-    def get_expired_votings(self) -> list[Voting]:
-        now = datetime.now(tz=timezone.utc)
+    def _tally_reaction(
+        self, session: Session, channel: str, ts: str, reaction: str, count: int
+    ) -> int:
+        # Reactions with a skin tone look like "+1::skin-tone-2"
+        reaction = reaction.split("::")[0]
+        if reaction in self._upvote_emoji:
+            column = Voting.upvotes
+        elif reaction in self._downvote_emoji:
+            column = Voting.downvotes
+        else:
+            return 0
+        ts_dt = datetime.fromtimestamp(float(ts), tz=timezone.utc)
         filter_ = sa.and_(
+            Voting.closed == False,
+            Voting.live_tally == True,
+            Voting.channel == channel,
+            sa.or_(Voting.message_ts == ts_dt, Voting.bot_message_ts == ts_dt),
+        )
+        stmt = (
+            sa.update(Voting)
+            .filter(filter_)
+            # A removal of a reaction made before the voting was created is not
+            # matched by an addition
+            .values({column: sa.case((column + count < 0, 0), else_=column + count)})
+            .execution_options(synchronize_session=False)
+        )
+        return session.execute(stmt).rowcount
+
+    def _claim_expired_votings(
+        self, session: Session, limit: int, lease: timedelta
+    ) -> list[Voting]:
+        now = datetime.now(tz=timezone.utc)
+        claimable = sa.and_(
             Voting.closed == False,
             Voting.bot_message_ts <= now - self._vote_timeout,
+            sa.or_(Voting.claimed_until.is_(None), Voting.claimed_until <= now),
         )
-        stmt = sa.select(Voting).filter(filter_)
-        with self._session_maker() as session:
-            return session.execute(stmt).scalars().all()
+        # Postgres skips the rows being claimed by other replicas instead of waiting
+        # for them, SQLite has no row locks but runs one write transaction at a time.
+        # The condition is checked again by the update against a concurrent claim.
+        batch = (
+            sa.select(Voting.id)
+            .where(claimable)
+            .order_by(Voting.bot_message_ts, Voting.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            sa.update(Voting)
+            .where(Voting.id.in_(batch), claimable)
+            .values(claimed_until=now + lease)
+            .returning(Voting)
+            .execution_options(synchronize_session=False)
+        )
+        votings = sorted(session.execute(stmt).scalars(), key=lambda v: v.id)
+        for voting in votings:
+            session.expunge(voting)
+        return votings
+
+    def _release_votings(self, session: Session, voting_ids: Collection[int]) -> None:
+        stmt = (
+            sa.update(Voting)
+            .where(Voting.id.in_(voting_ids), Voting.closed == False)
+            .values(claimed_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(stmt)
+
+    def _acquire_lease(self, session: Session, name: str, holder: str, ttl: timedelta) -> bool:
+        now = datetime.now(tz=timezone.utc)
+        # Taken over by another holder once it expires
+        available = sa.or_(Lease.holder == holder, Lease.expires <= now)
+        insert_factory = dialect_insert(session.connection())
+        if insert_factory is not None:
+            insert = insert_factory(Lease).values(name=name, holder=holder, expires=now + ttl)
+            stmt = insert.on_conflict_do_update(
+                index_elements=[Lease.name],
+                set_={"holder": insert.excluded.holder, "expires": insert.excluded.expires},
+                where=available,
+            ).returning(Lease.name)
+            return session.execute(stmt).first() is not None
+        update_stmt = (
+            sa.update(Lease)
+            .where(Lease.name == name, available)
+            .values(holder=holder, expires=now + ttl)
+            .execution_options(synchronize_session=False)
+        )
+        if session.execute(update_stmt).rowcount:
+            return True
+        try:
+            with session.begin_nested():
+                session.add(Lease(name=name, holder=holder, expires=now + ttl))
+        except IntegrityError:
+            return False
+        return True
 
-    def remove_old_votings(self) -> None:
+    def _remove_old_votings_batch(self, session: Session, batch_size: int) -> int:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
         now = datetime.now(tz=timezone.utc)
         filter_ = sa.and_(Voting.closed == True, Voting.created <= now - self._keep_history)
-        stmt = sa.select(Voting).filter(filter_)
-        with self._session_maker.begin() as session:
-            old = session.execute(stmt).scalars().all()
-            for o in old:
-                session.delete(o)
+        batch = sa.select(Voting.id).filter(filter_).limit(batch_size).scalar_subquery()
+        stmt = (
+            sa.delete(Voting)
+            .where(Voting.id.in_(batch))
+            .execution_options(synchronize_session=False)
+        )
+        deleted = session.execute(stmt).rowcount
+        logger.info("Removed %s old votings", deleted)
+        return deleted
 
-    def close_voting(self, voting: Voting, reactions: Counter[str] | None = None) -> bool:
-        with self._session_maker.begin() as session:
-            if reactions is None:
+    def _close_votings(
+        self, session: Session, results: Iterable[tuple[Voting, Counter[str] | None]]
+    ) -> tuple[dict[int, bool], dict[str, int]]:
+        """Returns the success of the closed votings by voting id and the changed
+        balances by user id.
+        """
+        failed: list[int] = []
+        outcomes: dict[int, tuple[Voting, bool]] = {}
+        for voting, reactions in results:
+            if voting.live_tally:
+                success = self._is_success(voting.upvotes, voting.downvotes)
+                outcomes[voting.id] = (voting, success)
+            elif reactions is None:
                 logger.error("Failed to get messages for: %s", voting)
-                session.delete(voting)
-                return False
-            success = self._determine_success(reactions)
-            if success:
-                stmt = sa.select(Karma).filter_by(user_id=voting.target_id)
-                karma = session.execute(stmt).scalar_one_or_none()
-                if karma is not None:
-                    karma.karma += voting.karma
-                else:
-                    new_record = Karma(
-                        user_id=voting.target_id, karma=self._initial_value + voting.karma
+                failed.append(voting.id)
+            else:
+                outcomes[voting.id] = (voting, self._determine_success(reactions))
+
+        closed: dict[int, bool] = {}
+        balances: dict[str, int] = {}
+        if failed:
+            delete_stmt = (
+                sa.delete(Voting)
+                .where(Voting.id.in_(failed), Voting.closed == False)
+                .returning(Voting.id)
+                .execution_options(synchronize_session=False)
+            )
+            closed.update((id_, False) for id_ in session.execute(delete_stmt).scalars())
+        if outcomes:
+            update_stmt = (
+                sa.update(Voting)
+                .where(Voting.id.in_(outcomes), Voting.closed == False)
+                .values(closed=True)
+                .returning(Voting.id)
+                .execution_options(synchronize_session=False)
+            )
+            entries = []
+            for id_ in session.execute(update_stmt).scalars():
+                voting, success = outcomes[id_]
+                closed[id_] = success
+                if success:
+                    entries.append(
+                        {
+                            "user_id": voting.target_id,
+                            "delta": voting.karma,
+                            "kind": LedgerKind.VOTING,
+                            "voting_id": id_,
+                        }
                     )
-                    session.add(new_record)
-            update_stmt = sa.update(Voting).where(Voting.id == voting.id).values(closed=True)
+            balances = self._add_karma(session, entries)
+        return closed, balances
+
+    def _add_karma(self, session: Session, entries: list[dict]) -> dict[str, int]:
+        "Records ledger entries, adds their deltas to the balances and returns the new balances."
+        if not entries:
+            return {}
+        deltas: Counter[str] = Counter()
+        for entry in entries:
+            deltas[entry["user_id"]] += entry["delta"]
+        self._ensure_balances(session, deltas)
+        session.execute(sa.insert(KarmaLedger), entries)
+        stmt = (
+            sa.update(Karma)
+            .where(Karma.user_id.in_(deltas))
+            .values(karma=Karma.karma + sa.case(dict(deltas), value=Karma.user_id))
+            .returning(Karma.user_id, Karma.karma)
+            .execution_options(synchronize_session=False)
+        )
+        return {user_id: karma for user_id, karma in session.execute(stmt)}
+
+    def _ensure_balances(self, session: Session, user_ids: Collection[str]) -> None:
+        "Creates missing balances with the initial value and records it in the ledger."
+        insert_factory = dialect_insert(session.connection())
+        if insert_factory is not None:
+            # Only the rows inserted by this statement are returned, so a balance
+            # created concurrently gets a single initial entry
+            stmt = (
+                insert_factory(Karma)
+                .values([{"user_id": u, "karma": self._initial_value} for u in user_ids])
+                .on_conflict_do_nothing(index_elements=[Karma.user_id])
+                .returning(Karma.user_id)
+            )
+            created = list(session.execute(stmt).scalars())
+        else:
+            existing_stmt = sa.select(Karma.user_id).where(Karma.user_id.in_(user_ids))
+            existing = set(session.execute(existing_stmt).scalars())
+            created = [u for u in user_ids if u not in existing]
+            if created:
+                session.execute(
+                    sa.insert(Karma),
+                    [{"user_id": u, "karma": self._initial_value} for u in created],
+                )
+        if created:
+            session.execute(
+                sa.insert(KarmaLedger),
+                [
+                    {"user_id": u, "delta": self._initial_value, "kind": LedgerKind.INITIAL}
+                    for u in created
+                ],
+            )
+
+    def _rebuild_balances_batch(
+        self, session: Session, after: str, batch_size: int
+    ) -> tuple[str | None, int]:
+        """Recomputes balances of the next `batch_size` users after `after` from the ledger.
+
+        Returns the last user of the batch, None if there are no users left, and
+        the number of corrected balances.
+        """
+        totals = (
+            sa.select(KarmaLedger.user_id, sa.func.sum(KarmaLedger.delta).label("total"))
+            .where(KarmaLedger.user_id > after)
+            .group_by(KarmaLedger.user_id)
+            .order_by(KarmaLedger.user_id)
+            .limit(batch_size)
+            .subquery()
+        )
+        stmt = sa.select(totals.c.user_id, totals.c.total, Karma.karma).outerjoin(
+            Karma, Karma.user_id == totals.c.user_id
+        )
+        rows = session.execute(stmt).all()
+        if not rows:
+            return None, 0
+        wrong = {u: total for u, total, karma in rows if karma is not None and karma != total}
+        missing = [{"user_id": u, "karma": total} for u, total, karma in rows if karma is None]
+        if wrong:
+            update_stmt = (
+                sa.update(Karma)
+                .where(Karma.user_id.in_(wrong))
+                .values(karma=sa.case(wrong, value=Karma.user_id))
+                .execution_options(synchronize_session=False)
+            )
             session.execute(update_stmt)
-            return success
+        if missing:
+            session.execute(sa.insert(Karma), missing)
+        return max(u for u, _, _ in rows), len(wrong) + len(missing)
+
+    def _enqueue(self, session: Session, kind: str, channel: str, ts: str, message: dict) -> None:
+        session.add(OutboxMessage(kind=kind, channel=channel, ts=ts, payload=json.dumps(message)))
+
+    def _claim_messages(
+        self, session: Session, limit: int, lease: timedelta
+    ) -> list[OutboxMessage]:
+        now = datetime.now(tz=timezone.utc)
+        due = OutboxMessage.next_attempt <= now
+        batch = (
+            sa.select(OutboxMessage.id)
+            .where(due)
+            .order_by(OutboxMessage.next_attempt, OutboxMessage.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        # A claimed message is due again if it's not completed within the lease
+        stmt = (
+            sa.update(OutboxMessage)
+            .where(OutboxMessage.id.in_(batch), due)
+            .values(next_attempt=now + lease)
+            .returning(OutboxMessage)
+            .execution_options(synchronize_session=False)
+        )
+        messages = sorted(session.execute(stmt).scalars(), key=lambda m: m.id)
+        for message in messages:
+            session.expunge(message)
+        return messages
+
+    def _complete_messages(
+        self,
+        session: Session,
+        delivered: list[tuple[OutboxMessage, str | None]],
+        failed: list[tuple[OutboxMessage, datetime | None]],
+    ) -> list[Voting]:
+        """Removes the delivered messages and the failed ones that are not retried.
+
+        A delivered `new_voting` message sets `bot_message_ts` of its votings, and
+        the votings of a dropped one are removed. Returns the votings that got their
+        `bot_message_ts`.
+        """
+        done = [m.id for m, _ in delivered] + [m.id for m, retry_at in failed if retry_at is None]
+        if done:
+            session.execute(sa.delete(OutboxMessage).where(OutboxMessage.id.in_(done)))
+        votings: list[Voting] = []
+        for message, posted_ts in delivered:
+            if message.kind != OutboxKind.NEW_VOTING or posted_ts is None:
+                continue
+            stmt = (
+                sa.update(Voting)
+                .where(*self._outbox_votings(message))
+                .values(bot_message_ts=datetime.fromtimestamp(float(posted_ts), tz=timezone.utc))
+                .returning(Voting)
+                .execution_options(synchronize_session=False)
+            )
+            votings.extend(session.execute(stmt).scalars())
+        for message, retry_at in failed:
+            if retry_at is not None:
+                session.execute(
+                    sa.update(OutboxMessage)
+                    .where(OutboxMessage.id == message.id)
+                    .values(attempts=OutboxMessage.attempts + 1, next_attempt=retry_at)
+                )
+            elif message.kind == OutboxKind.NEW_VOTING:
+                session.execute(
+                    sa.delete(Voting)
+                    .where(*self._outbox_votings(message))
+                    .execution_options(synchronize_session=False)
+                )
+        for voting in votings:
+            session.expunge(voting)
+        return votings
+
+    @staticmethod
+    def _outbox_votings(message: OutboxMessage) -> list[sa.ColumnElement[bool]]:
+        "Filter of the votings waiting for a `new_voting` message."
+        return [
+            Voting.channel == message.channel,
+            Voting.message_ts == datetime.fromtimestamp(float(message.ts), tz=timezone.utc),
+            Voting.bot_message_ts.is_(None),
+        ]
 
     def _determine_success(self, reactions: Counter[str]) -> bool:
         logger.info("Reactions: %s", reactions)
-        upvotes = [reactions[r] for r in self._upvote_emoji if r in reactions]
-        downvotes = [reactions[r] for r in self._downvote_emoji if r in reactions]
+        upvotes, downvotes = self._count_votes(reactions)
         logger.info("Upvotes: %s\nDownvotes: %s", upvotes, downvotes)
-        return sum(upvotes) - sum(downvotes) > 0
+        return self._is_success(upvotes, downvotes)
+
+    def _count_votes(self, reactions: Counter[str]) -> tuple[int, int]:
+        upvotes = downvotes = 0
+        for name, count in reactions.items():
+            # Reactions with a skin tone look like "+1::skin-tone-2"
+            name = name.split("::")[0]
+            if name in self._upvote_emoji:
+                upvotes += count
+            elif name in self._downvote_emoji:
+                downvotes += count
+        return upvotes, downvotes
+
+    @staticmethod
+    def _is_success(upvotes: int, downvotes: int) -> bool:
+        return upvotes - downvotes > 0
+
+
+class KarmaManager(KarmaManagerBase):
+    def __init__(self, config: KarmabotConfig) -> None:
+        super().__init__(config)
+        self._session_maker = create_session_maker(config.db)
+
+    def get(self, user_id: str) -> int:
+        karma = self.balances.get(user_id)
+        if karma is None:
+            with self._session_maker() as session:
+                karma = self._get(session, user_id)
+            self.balances.set(user_id, karma)
+        return karma
+
+    def set(self, user_id: str, karma: int) -> None:
+        with self._session_maker.begin() as session:
+            self._set(session, user_id, karma)
+        self.balances.set(user_id, karma)
+
+    def digest(self, page_size: int = DIGEST_PAGE_SIZE) -> Iterator[list[tuple[str, int]]]:
+        """Yields pages of users with non-zero karma in the leaderboard order.
+
+        Each page is read in a session of its own, so no connection is held while
+        the caller processes a page.
+        """
+        after = None
+        while True:
+            with self._session_maker() as session:
+                page = self._digest(session, page_size, after)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            user_id, karma = page[-1]
+            after = karma, user_id
+
+    def top(self, limit: int, after: tuple[int, str] | None = None) -> list[tuple[str, int]]:
+        """Returns up to `limit` users with their karma in the leaderboard order.
+
+        The next page starts `after` the `(karma, user_id)` of the last user of a page.
+        """
+        with self._session_maker() as session:
+            return self._top(session, limit, after)
+
+    def rank(self, user_id: str) -> tuple[int, int] | None:
+        "Returns a user's rank and karma, None if the user has no karma yet."
+        with self._session_maker() as session:
+            return self._rank(session, user_id)
+
+    def neighbours(self, user_id: str, size: int) -> list[tuple[str, int]]:
+        "Returns up to `size` users above and below a user, and the user in between."
+        with self._session_maker() as session:
+            return self._neighbours(session, user_id, size)
+
+    def pending(self) -> list[Voting]:
+        with self._session_maker() as session:
+            return self._pending(session)
+
+    def count_pending(self) -> int:
+        with self._session_maker() as session:
+            return self._count_pending(session)
+
+    def create(
+        self,
+        *,
+        initiator_id: str,
+        target_ids: list[str],
+        channel: str,
+        text: str,
+        ts: str,
+        bot_message_ts: str | None = None,
+        karma: int,
+        reactions: Counter[str] | None = None,
+        message: dict | None = None,
+    ) -> list[Voting]:
+        """Creates a voting for each target of a message in one batch.
+
+        Nothing is created if the message already has votings. With `karma.live_tally`
+        the tallies start from `reactions`. The bot `message` is saved to the outbox
+        together with the votings, which get their `bot_message_ts` once it's posted.
+        """
+        with self._session_maker.begin() as session:
+            return self._create(
+                session,
+                initiator_id,
+                target_ids,
+                channel,
+                text,
+                ts,
+                bot_message_ts,
+                karma,
+                reactions,
+                message,
+            )
+
+    def enqueue_messages(self, kind: str, messages: list[tuple[str, str, dict]]) -> None:
+        "Saves `(channel, ts, message)` messages to the outbox in one transaction."
+        with self._session_maker.begin() as session:
+            for channel, ts, message in messages:
+                self._enqueue(session, kind, channel, ts, message)
+
+    def claim_messages(self, limit: int, lease: timedelta) -> list[OutboxMessage]:
+        """Claims up to `limit` due outbox messages to deliver in order.
+
+        Other replicas skip the claimed messages until they are completed or
+        the `lease` runs out.
+        """
+        with self._session_maker.begin() as session:
+            return self._claim_messages(session, limit, lease)
+
+    def complete_messages(
+        self,
+        delivered: list[tuple[OutboxMessage, str | None]],
+        failed: list[tuple[OutboxMessage, datetime | None]],
+    ) -> list[Voting]:
+        """Records the delivered messages with the ts of the posted ones, and the failed
+        ones with the time of their next attempt, None to drop them.
+
+        Returns the votings that got their `bot_message_ts`.
+        """
+        with self._session_maker.begin() as session:
+            return self._complete_messages(session, delivered, failed)
+
+    def tally_reaction(self, channel: str, ts: str, reaction: str, count: int) -> int:
+        """Count a reaction added to (count=1) or removed from (count=-1) a message.
+
+        Returns the number of open votings updated.
+        """
+        with self._session_maker.begin() as session:
+            return self._tally_reaction(session, channel, ts, reaction, count)
+
+    def get_change(self, user_id: str, since: datetime) -> int:
+        "Returns the sum of karma changes of a user since the given time."
+        with self._session_maker() as session:
+            return self._get_change(session, user_id, since)
+
+    def claim_expired_votings(self, limit: int, lease: timedelta) -> list[Voting]:
+        """Claims up to `limit` expired votings for this replica.
+
+        Other replicas skip the claimed votings until they are closed, released
+        or the `lease` runs out.
+        """
+        with self._session_maker.begin() as session:
+            return self._claim_expired_votings(session, limit, lease)
+
+    def release_votings(self, voting_ids: Collection[int]) -> None:
+        "Lets other replicas claim the votings that are still open."
+        with self._session_maker.begin() as session:
+            self._release_votings(session, voting_ids)
+
+    def acquire_lease(self, name: str, holder: str, ttl: timedelta) -> bool:
+        """Takes or renews the lease `name` for `ttl` unless another holder has it.
+
+        A job that must run once for all the replicas runs under a lease.
+        """
+        with self._session_maker.begin() as session:
+            return self._acquire_lease(session, name, holder, ttl)
+
+    def remove_old_votings(self, batch_size: int = PURGE_BATCH_SIZE) -> int:
+        """Delete outdated closed votings in batches, each in its own transaction."""
+        removed = 0
+        while True:
+            with self._session_maker.begin() as session:
+                deleted = self._remove_old_votings_batch(session, batch_size)
+            removed += deleted
+            if deleted < batch_size:
+                return removed
+
+    def rebuild_balances(self, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+        """Recompute balances from the ledger in batches of users, each in its own transaction.
+
+        Returns the number of corrected balances.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+        corrected = 0
+        after: str | None = ""
+        while after is not None:
+            with self._session_maker.begin() as session:
+                after, batch_corrected = self._rebuild_balances_batch(session, after, batch_size)
+            corrected += batch_corrected
+        if corrected:
+            logger.warning("Corrected %s balances from the ledger", corrected)
+            self.balances.clear()
+        return corrected
+
+    def close_voting(self, voting: Voting, reactions: Counter[str] | None = None) -> bool:
+        return self.close_votings([(voting, reactions)]).get(voting.id, False)
+
+    def close_votings(
+        self, results: Iterable[tuple[Voting, Counter[str] | None]]
+    ) -> dict[int, bool]:
+        """Close votings in a single transaction.
+
+        Live tallied votings are decided by their tallies and the reactions are
+        ignored. Other votings without reactions are deleted. Returns voting ids
+        mapped to success of the votings closed by this call: the ones already
+        closed are skipped.
+        """
+        with self._session_maker.begin() as session:
+            closed, balances = self._close_votings(session, results)
+        for user_id, karma in balances.items():
+            self.balances.set(user_id, karma)
+        return closed
+
+
+class AsyncKarmaManager(KarmaManagerBase):
+    """`KarmaManager` counterpart backed by `sqlalchemy.ext.asyncio`.
+
+    The manager owns its engine: call `close` before the event loop ends.
+    """
+
+    def __init__(self, config: KarmabotConfig) -> None:
+        super().__init__(config)
+        self._engine = create_async_db_engine(config.db)
+        # Objects are not expired on commit because they can't be lazy loaded afterwards
+        self._session_maker = async_sessionmaker(bind=self._engine, expire_on_commit=False)
+
+    async def upgrade_schema(self) -> None:
+        await upgrade_schema_async(self._engine)
+
+    async def close(self) -> None:
+        await self._engine.dispose()
+
+    async def get(self, user_id: str) -> int:
+        karma = self.balances.get(user_id)
+        if karma is None:
+            async with self._session_maker() as session:
+                karma = await session.run_sync(self._get, user_id)
+            self.balances.set(user_id, karma)
+        return karma
+
+    async def set(self, user_id: str, karma: int) -> None:
+        async with self._session_maker.begin() as session:
+            await session.run_sync(self._set, user_id, karma)
+        self.balances.set(user_id, karma)
+
+    async def digest(
+        self, page_size: int = DIGEST_PAGE_SIZE
+    ) -> AsyncIterator[list[tuple[str, int]]]:
+        after = None
+        while True:
+            async with self._session_maker() as session:
+                page = await session.run_sync(self._digest, page_size, after)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            user_id, karma = page[-1]
+            after = karma, user_id
+
+    async def top(self, limit: int, after: tuple[int, str] | None = None) -> list[tuple[str, int]]:
+        async with self._session_maker() as session:
+            return await session.run_sync(self._top, limit, after)
+
+    async def rank(self, user_id: str) -> tuple[int, int] | None:
+        async with self._session_maker() as session:
+            return await session.run_sync(self._rank, user_id)
+
+    async def neighbours(self, user_id: str, size: int) -> list[tuple[str, int]]:
+        async with self._session_maker() as session:
+            return await session.run_sync(self._neighbours, user_id, size)
+
+    async def pending(self) -> list[Voting]:
+        async with self._session_maker() as session:
+            return await session.run_sync(self._pending)
+
+    async def count_pending(self) -> int:
+        async with self._session_maker() as session:
+            return await session.run_sync(self._count_pending)
+
+    async def create(
+        self,
+        *,
+        initiator_id: str,
+        target_ids: list[str],
+        channel: str,
+        text: str,
+        ts: str,
+        bot_message_ts: str,
+        karma: int,
+        reactions: Counter[str] | None = None,
+    ) -> list[Voting]:
+        async with self._session_maker.begin() as session:
+            return await session.run_sync(
+                self._create,
+                initiator_id,
+                target_ids,
+                channel,
+                text,
+                ts,
+                bot_message_ts,
+                karma,
+                reactions,
+            )
+
+    async def tally_reaction(self, channel: str, ts: str, reaction: str, count: int) -> int:
+        async with self._session_maker.begin() as session:
+            return await session.run_sync(self._tally_reaction, channel, ts, reaction, count)
+
+    async def claim_expired_votings(self, limit: int, lease: timedelta) -> list[Voting]:
+        async with self._session_maker.begin() as session:
+            return await session.run_sync(self._claim_expired_votings, limit, lease)
+
+    async def release_votings(self, voting_ids: Collection[int]) -> None:
+        async with self._session_maker.begin() as session:
+            await session.run_sync(self._release_votings, voting_ids)
+
+    async def remove_old_votings(self, batch_size: int = PURGE_BATCH_SIZE) -> int:
+        removed = 0
+        while True:
+            async with self._session_maker.begin() as session:
+                deleted = await session.run_sync(self._remove_old_votings_batch, batch_size)
+            removed += deleted
+            if deleted < batch_size:
+                return removed
+
+    async def close_votings(
+        self, results: Iterable[tuple[Voting, Counter[str] | None]]
+    ) -> dict[int, bool]:
+        async with self._session_maker.begin() as session:
+            closed, balances = await session.run_sync(self._close_votings, results)
+        for user_id, karma in balances.items():
+            self.balances.set(user_id, karma)
+        return closed
@@ -1,36 +1,119 @@
+import contextlib
 import functools
-import pathlib
-from collections.abc import Callable
+import json
+import random
+import socket
+import uuid
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-import yaml
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_sdk.errors import SlackApiError
 from slack_sdk.web import WebClient
 
 from .config import KarmabotConfig
+from .expiry import ExpiryTimer
 from .karma_manager import KarmaManager
 from .logging import logger
-from .parse import Parse
+from .metrics import HANDLER_SECONDS, OPEN_VOTINGS
+from .orm import OutboxKind, OutboxMessage, Voting
+from .outbox import OutboxDrainer
+from .parse import Parse, SetArgs, UserArgs
+from .profiling import PROFILER
+from .router import CommandRouter
 from .slack_utils import (
-    lookup_channel_name,
-    lookup_username,
+    RETRY_JITTER,
+    LimitedWebClient,
+    SlackDirectory,
+    SlackDispatcher,
+    api_error,
+    format_ts,
     message_post,
     message_update,
-    post_im,
     reactions_get,
+    retry_after,
 )
 from .words import Color, Format
 
 REQUIRED_MESSAGE_FIELDS = {"user", "text", "ts", "type", "channel"}
+# Expired votings claimed and closed in one batch
+CLAIM_BATCH_SIZE = 100
+# Time a replica has to close the votings it claimed before others may claim them
+CLAIM_LEASE = timedelta(minutes=5)
+# Outbox messages delivered in one batch
+OUTBOX_BATCH_SIZE = 20
+# Time a replica has to deliver the outbox messages it claimed
+OUTBOX_LEASE = timedelta(minutes=5)
+# Attempts to deliver an outbox message before it's dropped
+OUTBOX_ATTEMPTS = 5
+# Max seconds between attempts to deliver an outbox message
+OUTBOX_MAX_BACKOFF = 60
+# Number of name lookups after which the directory is loaded in bulk
+BULK_LOOKUP_THRESHOLD = 20
+# Max number of users shown by `top`
+TOP_MAX = 50
+# Number of users shown above and below a user by `rank`
+RANK_NEIGHBOURS = 2
+# Max length of a digest message, Slack truncates longer attachment texts
+DIGEST_CHUNK_SIZE = 3000
+DIGEST_HEADER = "*username* => *karma*"
+# TODO: add translations
+DIGEST_EMPTY = "Seems like nothing to show. All the karma is zero"
 
 
-class Karmabot:
-    def __init__(self, config_path: pathlib.Path) -> None:
-        with config_path.open("r") as f:
-            config_dict = yaml.safe_load(f)
-        self._config = KarmabotConfig.model_validate(config_dict)
+@contextlib.contextmanager
+def handling(handler: str) -> Iterator[None]:
+    "Measures the handling of an event and profiles its DB queries."
+    with HANDLER_SECONDS.time(handler=handler), PROFILER.operation(handler):
+        yield
+
+
+class TextChunks:
+    """Joins lines into texts of at most `size` characters, each starting with `header`.
+
+    A line longer than `size` makes a text of its own.
+    """
+
+    def __init__(self, size: int, header: str) -> None:
+        self._size = size
+        self._header = header
+        self._lines: list[str] = []
+        self._length = 0
+
+    def add(self, line: str) -> str | None:
+        "Adds a line, returns the complete text if the line starts a new one."
+        text = None
+        if self._lines and self._length + len(line) + 1 > self._size:
+            text = self.flush()
+        if not self._lines:
+            self._lines.append(self._header)
+            self._length = len(self._header)
+        self._lines.append(line)
+        self._length += len(line) + 1
+        return text
+
+    def flush(self) -> str | None:
+        "Returns the text collected so far, None if there's none."
+        if not self._lines:
+            return None
+        text = "\n".join(self._lines)
+        self._lines = []
+        self._length = 0
+        return text
+
+
+class KarmabotBase:
+    """Slack and DB agnostic parts shared by `Karmabot` and `AsyncKarmabot`."""
+
+    def __init__(self, config: KarmabotConfig) -> None:
+        self._config = config
         logger.setLevel(self._config.log_level.upper())
-        self.slack_app = App(token=self._config.slack_bot_token, logger=logger)
+        profiling = self._config.profiling
+        if profiling.enabled:
+            PROFILER.enable(profiling.slow_query.total_seconds(), profiling.repeated_queries)
         self._admins = self._config.admins
         self._format = Format(
             lang=self._config.lang,
@@ -38,17 +121,157 @@ class Karmabot:
             votes_down_emoji=self._config.karma.downvote_emoji,
             timeout=self._config.karma.vote_timeout,
         )
+
+    def _check_app_mention(self, event: dict) -> tuple[list[str], int] | dict | None:
+        """Returns target user ids and karma, an error message to reply with or None."""
+        logger.info("Processing event: %s", event)
+
+        event_fields = set(event.keys())
+        if not REQUIRED_MESSAGE_FIELDS.issubset(event_fields):
+            logger.info("Not enough fields for: %s", event)
+            return None
+
+        # Don't handle requests from private channels (aka groups)
+        if event["channel"].startswith("G"):
+            logger.info("Skip message in group %s", event["channel"])
+            return None
+
+        # Report an error if a request has not been parsed
+        result = Parse.karma_change(event["text"])
+        if not result:
+            return self._format.parsing_error()
+
+        bot_id, user_ids, karma, _ = result
+        for user_id in user_ids:
+            error = self._karma_change_sanity_check(event["user"], user_id, bot_id, karma)
+            if error:
+                return error
+        return user_ids, karma
+
+    def _karma_change_sanity_check(
+        self, initiator_id: str, user_id: str, bot_id: str, karma: int
+    ) -> dict | None:
+        if not self._config.karma.self_karma and initiator_id == user_id:
+            return self._format.strange_error()
+        if user_id == bot_id:
+            return self._format.robo_error()
+        if abs(karma) > self._config.karma.max_diff:
+            return self._format.max_diff_error(self._config.karma.max_diff)
+        return None
+
+    @staticmethod
+    def _join_usernames(usernames: list[str]) -> str:
+        # Messages mention the first user as `@{}`
+        return ", @".join(usernames)
+
+    @staticmethod
+    def _group_by_message(votings: list[Voting]) -> list[list[Voting]]:
+        "Groups votings created by the same message, they share its reactions."
+        groups: dict[tuple[str, datetime | None], list[Voting]] = {}
+        for voting in votings:
+            groups.setdefault((voting.channel, voting.bot_message_ts), []).append(voting)
+        return list(groups.values())
+
+    @staticmethod
+    def _digest_line(username: str, karma: int) -> str:
+        return f"_{username}_ => *{karma}*"
+
+    def _pending_message(self, items: list[tuple[Voting, str, str, str]]) -> str:
+        result = ["*initiator* | *receiver* | *channel* | *karma* | *expired*"]
+        for voting, initiator, target, channel_name in items:
+            dt = self._config.karma.vote_timeout
+            time_left = voting.message_ts + dt
+            item = f"{initiator} | {target} | {channel_name} | {voting.karma} | {time_left.isoformat()}"
+            if voting.live_tally:
+                item += f" | +{voting.upvotes} -{voting.downvotes}"
+            result.append(item)
+        # TODO: add translations
+        if len(result) == 1:
+            return "Seems like nothing to show"
+        return "\n".join(result)
+
+    @staticmethod
+    def _top_message(items: list[tuple[str, int]]) -> str:
+        result = [
+            f"*{i}.* _{username}_ => *{karma}*" for i, (username, karma) in enumerate(items, 1)
+        ]
+        # TODO: add translations
+        if not result:
+            return "Seems like nothing to show"
+        return "\n".join(result)
+
+    @staticmethod
+    def _rank_message(
+        username: str, rank: tuple[int, int] | None, neighbours: list[tuple[str, int]]
+    ) -> str:
+        # TODO: add translations
+        if rank is None:
+            return f"_{username}_ has no karma yet"
+        result = [f"_{username}_ is *#{rank[0]}* with *{rank[1]}* karma"]
+        for name, karma in neighbours:
+            item = f"_{name}_ => *{karma}*"
+            result.append(f"> {item}" if name == username else item)
+        return "\n".join(result)
+
+
+class Karmabot(KarmabotBase):
+    # Built once when the class is defined, handlers register with `@commands.command`
+    commands = CommandRouter()
+
+    def __init__(self, config: KarmabotConfig, client: WebClient | None = None) -> None:
+        super().__init__(config)
+        if client is None:
+            client = LimitedWebClient(
+                token=self._config.slack_bot_token,
+                base_url=self._config.slack.api_url,
+                logger=logger,
+            )
+        self.slack_app = App(client=client, logger=logger)
         self._manager = KarmaManager(config=self._config)
+        # Holder of the leases taken by this instance
+        self.replica_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self._expiry = ExpiryTimer(self._close_expired_votings_from_timer)
+        # Replies that nothing waits for are sent in the background
+        self._dispatcher = SlackDispatcher(self.slack_app.client)
+        self._outbox = OutboxDrainer(
+            self.drain_outbox,
+            OUTBOX_BATCH_SIZE,
+            self._config.slack.outbox_interval.total_seconds(),
+        )
+        self._directory = SlackDirectory(
+            self.slack_app.client,
+            maxsize=self._config.slack.directory_size,
+            ttl=self._config.slack.directory_ttl.total_seconds(),
+        )
 
         @self.slack_app.event("team_join")
         def _team_join_callback(client, event):
             logger.debug("[team_join] %s", event)
-            self._handle_team_join(client, event)
+            with handling("team_join"):
+                self._handle_team_join(client, event)
+
+        @self.slack_app.event("user_change")
+        def _user_change_callback(event):
+            logger.debug("[user_change] %s", event)
+            self._directory.update_user(event["user"])
 
         @self.slack_app.event("app_mention")
         def _app_mention_callback(client, event):
             logger.debug("[app_mention] %s", event)
-            self._handle_app_mention(client, event)
+            with handling("app_mention"):
+                self._handle_app_mention(client, event)
+
+        if self._config.karma.live_tally:
+
+            @self.slack_app.event("reaction_added")
+            def _reaction_added_callback(event):
+                logger.debug("[reaction_added] %s", event)
+                self._handle_reaction(event, 1)
+
+            @self.slack_app.event("reaction_removed")
+            def _reaction_removed_callback(event):
+                logger.debug("[reaction_removed] %s", event)
+                self._handle_reaction(event, -1)
 
         @self.slack_app.command("/karmabot")
         def _command_callback(ack: Callable, respond: Callable, command: dict):
@@ -57,156 +280,308 @@ class Karmabot:
             self._handle_command(respond, command)
 
     def run(self) -> None:
+        self._watch_expiry(self._manager.pending())
+        self._expiry.start()
+        # Delivers the messages left by the previous run first
+        self._outbox.start()
+        OPEN_VOTINGS.set_function(self._manager.count_pending)
         SocketModeHandler(self.slack_app, self._config.slack_app_token).start()
 
     def report_digest(self, reply_callback: Callable | None = None) -> None:
-        result = ["*username* => *karma*"]
-        for r in self._manager.digest():
-            username = lookup_username(self.slack_app.client, r.user_id)
-            item = f"_{username}_ => *{r.karma}*"
-            result.append(item)
-        # TODO: add translations
-        if len(result) == 1:
-            message = "Seems like nothing to show. All the karma is zero"
-        else:
-            message = "\n".join(result)
-        if reply_callback is None:
-            reply_callback = functools.partial(
-                message_post,
-                self.slack_app.client,
-                self._config.digest.channel,
+        """Posts the digest in messages of at most `DIGEST_CHUNK_SIZE` characters.
+
+        Users are read and rendered page by page, so memory use doesn't grow with
+        their number. Without `reply_callback` the messages after the first one are
+        posted to its thread.
+        """
+        thread_ts = None
+
+        def post(text: str) -> None:
+            nonlocal thread_ts
+            message = self._format.message(Color.INFO, text)
+            if reply_callback is not None:
+                reply_callback(message)
+                return
+            response = message_post(
+                self.slack_app.client, self._config.digest.channel, message, ts=thread_ts
             )
-        reply_callback(self._format.message(Color.INFO, message))
+            thread_ts = thread_ts or response["ts"]
+
+        chunks = TextChunks(DIGEST_CHUNK_SIZE, DIGEST_HEADER)
+        for i, page in enumerate(self._manager.digest()):
+            if i == 0 and len(page) > BULK_LOOKUP_THRESHOLD:
+                self._directory.warm_users()
+            for user_id, karma in page:
+                username = self._directory.username(user_id)
+                if (text := chunks.add(self._digest_line(username, karma))) is not None:
+                    post(text)
+        post(chunks.flush() or DIGEST_EMPTY)
 
     def process_expired_votings(self) -> None:
+        self.close_expired_votings()
+        self._manager.remove_old_votings()
+
+    def _close_expired_votings_from_timer(self) -> None:
+        with handling("expiry"):
+            self.close_expired_votings()
+
+    def close_expired_votings(self) -> None:
+        """Closes expired votings in batches claimed by this replica.
+
+        Replicas sharing the DB claim different votings, so that each voting is
+        closed by one of them. The votings that stay open, e.g. because Slack rate
+        limited their reactions, are released for the next sweep of any replica.
+        """
         logger.info("Looking for expired votings.")
-        for voting in self._manager.get_expired_votings():
-            initial_msg_ts = str(voting.message_ts.timestamp())
-            bot_msg_ts = str(voting.bot_message_ts.timestamp())
-            logger.info("Expired voting: %s [%s] [%s]", voting, initial_msg_ts, bot_msg_ts)
+        unresolved: list[int] = []
+        with ThreadPoolExecutor(max_workers=self._config.slack.max_workers) as pool:
+            while True:
+                claimed = self._manager.claim_expired_votings(CLAIM_BATCH_SIZE, CLAIM_LEASE)
+                if claimed:
+                    unresolved.extend(self._close_claimed_votings(pool, claimed))
+                if len(claimed) < CLAIM_BATCH_SIZE:
+                    break
+        if unresolved:
+            self._manager.release_votings(unresolved)
+
+    def _close_claimed_votings(self, pool: ThreadPoolExecutor, claimed: list[Voting]) -> list[int]:
+        "Closes the votings and saves their results to the outbox, returns the open ones."
+        # Slack calls are made concurrently while `LimitedWebClient` keeps
+        # the calls per minute of each method within its rate limit tier.
+        # Reactions are fetched before the DB transaction is opened.
+        # Votings of one message are fetched and reported together.
+        groups = self._group_by_message(claimed)
+        fetched = list(pool.map(self._get_voting_reactions, groups))
+        closed = self._manager.close_votings(r for results in fetched for r in results)
+        results = [[(v, closed[v.id]) for v in group if v.id in closed] for group in groups]
+        messages = list(pool.map(self._voting_result_message, filter(None, results)))
+        self._manager.enqueue_messages(OutboxKind.VOTING_RESULT, list(filter(None, messages)))
+        self._outbox.notify()
+        return [v.id for v in claimed if v.id not in closed]
+
+    def acquire_lease(self, name: str, ttl: timedelta) -> bool:
+        "Returns whether this replica holds the lease `name` for the next `ttl`."
+        return self._manager.acquire_lease(name, self.replica_id, ttl)
+
+    def drain_outbox(self) -> int:
+        """Delivers a batch of due outbox messages, returns the number of messages taken.
+
+        Of several updates of one message in the batch only the latest one is sent.
+        A message rejected by Slack is retried with a backoff, unless the error is
+        permanent or it's out of attempts.
+        """
+        messages = self._manager.claim_messages(OUTBOX_BATCH_SIZE, OUTBOX_LEASE)
+        latest = {(m.channel, m.ts): m.id for m in messages if m.kind == OutboxKind.VOTING_RESULT}
+        delivered: list[tuple[OutboxMessage, str | None]] = []
+        failed: list[tuple[OutboxMessage, datetime | None]] = []
+        for message in messages:
+            if message.kind == OutboxKind.VOTING_RESULT:
+                if latest[message.channel, message.ts] != message.id:
+                    delivered.append((message, None))
+                    continue
+            try:
+                delivered.append((message, self._deliver(message)))
+            except Exception as e:
+                logger.warning("Failed to deliver %s: %s", message, api_error(e))
+                failed.append((message, self._next_attempt(message, e)))
+        self._watch_expiry(self._manager.complete_messages(delivered, failed))
+        return len(messages)
+
+    def _deliver(self, message: OutboxMessage) -> str:
+        "Sends a message, returns its ts."
+        payload = json.loads(message.payload)
+        if message.kind == OutboxKind.NEW_VOTING:
+            response = message_post(self.slack_app.client, message.channel, payload, ts=message.ts)
+        else:
+            response = message_update(
+                self.slack_app.client, message.channel, payload, ts=message.ts
+            )
+        return response["ts"]
+
+    @staticmethod
+    def _next_attempt(message: OutboxMessage, e: Exception) -> datetime | None:
+        "Returns when a failed message is retried, None to drop it."
+        if message.attempts + 1 >= OUTBOX_ATTEMPTS:
+            return None
+        if isinstance(e, SlackApiError) and e.response.status_code == 429:
+            delay = retry_after(e.response)
+        elif isinstance(e, SlackApiError) and e.response.status_code < 500:
+            # Errors like `channel_not_found` don't go away
+            return None
+        else:
+            delay = min(2**message.attempts, OUTBOX_MAX_BACKOFF)
+        delay += random.uniform(0, RETRY_JITTER)
+        return datetime.now(tz=timezone.utc) + timedelta(seconds=delay)
+
+    def _watch_expiry(self, votings: Iterable[Voting]) -> None:
+        for voting in votings:
+            deadline = self._manager.expires_at(voting)
+            if deadline is not None:
+                self._expiry.push(deadline, voting.id)
+
+    def _get_voting_reactions(
+        self, votings: list[Voting]
+    ) -> list[tuple[Voting, Counter[str] | None]]:
+        """Returns the votings of a message with its reactions.
+
+        Returns nothing if Slack failed to respond, such votings stay open until
+        the next sweep.
+        """
+        voting = votings[0]
+        if voting.live_tally:
+            # Decided by the tally, no need to ask Slack
+            return [(v, None) for v in votings]
+        assert voting.bot_message_ts is not None, "expired votings have a bot message"
+        initial_msg_ts = format_ts(voting.message_ts)
+        bot_msg_ts = format_ts(voting.bot_message_ts)
+        logger.info("Expired voting: %s [%s] [%s]", voting, initial_msg_ts, bot_msg_ts)
+        try:
             reactions = reactions_get(
                 client=self.slack_app.client,
                 channel=voting.channel,
                 initial_msg_ts=initial_msg_ts,
                 bot_msg_ts=bot_msg_ts,
             )
-            success = self._manager.close_voting(voting, reactions)
-            username = lookup_username(self.slack_app.client, voting.target_id)
-            result = self._format.voting_result(username, voting.karma, success)
-            message_update(self.slack_app.client, voting.channel, result, ts=bot_msg_ts)
+        except SlackApiError as e:
+            error = e.response.get("error")
+            if error == "message_not_found":
+                # Removed as votings without reactions
+                return [(v, None) for v in votings]
+            logger.warning("Failed to get reactions for %s: %s", voting, error)
+            return []
+        return [(v, reactions) for v in votings]
 
-        self._manager.remove_old_votings()
+    def _voting_result_message(
+        self, results: list[tuple[Voting, bool]]
+    ) -> tuple[str, str, dict] | None:
+        "Returns the update of the bot message of votings of one message, they share the result."
+        voting, success = results[0]
+        assert voting.bot_message_ts is not None, "expired votings have a bot message"
+        try:
+            usernames = [self._directory.username(v.target_id) for v, _ in results]
+        except SlackApiError as e:
+            logger.warning("Failed to report a result of %s: %s", voting, e.response.get("error"))
+            return None
+        msg = self._format.voting_result(self._join_usernames(usernames), voting.karma, success)
+        return voting.channel, format_ts(voting.bot_message_ts), msg
 
     def _handle_team_join(self, client: WebClient, event: dict):
         logger.info("Processing event: %s", event)
         user_id = event["user"]["id"]
-        post_im(self.slack_app.client, user_id, self._format.hello())
+        self._directory.update_user(event["user"])
+        self._dispatcher.post_im(user_id, self._format.hello())
         logger.info("Team joined by user_id=%s", user_id)
 
-    def _handle_app_mention(self, client: WebClient, event: dict) -> None:
-        logger.info("Processing event: %s", event)
-
-        event_fields = set(event.keys())
-        if not REQUIRED_MESSAGE_FIELDS.issubset(event_fields):
-            logger.info("Not enough fields for: %s", event)
+    def _handle_reaction(self, event: dict, count: int) -> None:
+        item = event["item"]
+        if item.get("type") != "message":
             return
+        self._manager.tally_reaction(item["channel"], item["ts"], event["reaction"], count)
 
-        initiator_id = event["user"]
+    def _handle_app_mention(self, client: WebClient, event: dict) -> None:
+        result = self._check_app_mention(event)
+        if result is None:
+            return
         channel = event["channel"]
-        text = event["text"]
         ts = event["ts"]
-
-        # Don't handle requests from private channels (aka groups)
-        if channel.startswith("G"):
-            logger.info("Skip message in group %s", channel)
-            return
-
-        # Report an error if a request has not been parsed
-        result = Parse.karma_change(text)
-        if not result:
-            message_post(self.slack_app.client, channel, self._format.parsing_error(), ts=ts)
-            return
-
-        bot_id, user_id, karma, _ = result
-        error = self._karma_change_sanity_check(initiator_id, user_id, bot_id, karma)
-        if error:
-            message_post(self.slack_app.client, channel, error, ts=ts)
+        if isinstance(result, dict):
+            self._dispatcher.post(channel, result, ts=ts)
             return
 
-        username = lookup_username(self.slack_app.client, user_id)
-        msg = self._format.new_voting(username, karma)
-        response = message_post(self.slack_app.client, channel, msg, ts=ts)
-        bot_message_ts = response["ts"]
-        self._manager.create(
-            initiator_id=initiator_id,
-            target_id=user_id,
+        user_ids, karma = result
+        usernames = [self._directory.username(user_id) for user_id in user_ids]
+        msg = self._format.new_voting(self._join_usernames(usernames), karma)
+        # The bot message is posted from the outbox, the votings expire once it's posted
+        votings = self._manager.create(
+            initiator_id=event["user"],
+            target_ids=user_ids,
             channel=channel,
-            text=text,
+            text=event["text"],
             ts=ts,
-            bot_message_ts=bot_message_ts,
             karma=karma,
+            message=msg,
         )
+        if votings:
+            self._outbox.notify()
 
     def _handle_command(self, respond: Callable, command: dict) -> None:
         respond = functools.partial(respond, response_type="ephemeral")
-        initiator_name = command["user_name"]
-        text = command["text"]
-        is_admin = initiator_name in self._admins
-
-        if get_args := Parse.cmd_get(text):
-            logger.info("Handling command 'get'")
-            user_id, user_name = get_args
-            if not user_name:
-                logger.warning("Failed to parse 'get' command args")
-                return
-            karma = self._manager.get(user_id)
-            respond(self._format.report_karma(user_name, karma))
-        elif set_args := Parse.cmd_set(text):
-            logger.info("Handling command 'set'")
-            if not is_admin:
-                logger.warning("Only admins can set the karma")
-                return
-            user_id, user_name, karma = set_args
-            if not user_name:
-                logger.warning("Failed to parse 'set' command args")
-                return
-            self._manager.set(user_id=user_id, karma=karma)
-            respond(self._format.report_karma(user_name, karma))
-        elif text == "digest":
-            logger.info("Handling command 'digest'")
-            self.report_digest(reply_callback=respond)
-        elif text == "pending":
-            logger.info("Handling command 'pending'")
-            result = ["*initiator* | *receiver* | *channel* | *karma* | *expired*"]
-            for voting in self._manager.pending():
-                dt = self._config.karma.vote_timeout
-                time_left = voting.message_ts + dt
-                initiator = lookup_username(self.slack_app.client, voting.initiator_id)
-                target = lookup_username(self.slack_app.client, voting.target_id)
-                channel_name = lookup_channel_name(self.slack_app.client, voting.channel)
-                item = f"{initiator} | {target} | {channel_name} | {voting.karma} | {time_left.isoformat()}"
-                result.append(item)
-            # TODO: add translations
-            if len(result) == 1:
-                message = "Seems like nothing to show"
-            else:
-                message = "\n".join(result)
-            respond(self._format.message(Color.INFO, message))
-        elif text == "help":
-            logger.info("Handling command 'help'")
-            respond(self._format.hello())
-        else:
+        route = self.commands.resolve(command["text"])
+        if route is None:
             # A default behavior is to error
             logger.info("Unknown command: %s", command["text"])
             respond(self._format.cmd_error())
+            return
+        logger.info("Handling command '%s'", route.name)
+        with handling(f"command:{route.name}"):
+            route.handler(self, respond, command, route.args)
 
-    def _karma_change_sanity_check(
-        self, initiator_id: str, user_id: str, bot_id: str, karma: int
-    ) -> dict | None:
-        if not self._config.karma.self_karma and initiator_id == user_id:
-            return self._format.strange_error()
-        if user_id == bot_id:
-            return self._format.robo_error()
-        if abs(karma) > self._config.karma.max_diff:
-            return self._format.max_diff_error(self._config.karma.max_diff)
-        return None
+    @commands.command("get", Parse.cmd_get)
+    def _cmd_get(self, respond: Callable, command: dict, args: UserArgs) -> None:
+        if not args.user_name:
+            logger.warning("Failed to parse 'get' command args")
+            return
+        karma = self._manager.get(args.user_id)
+        respond(self._format.report_karma(args.user_name, karma))
+
+    @commands.command("set", Parse.cmd_set)
+    def _cmd_set(self, respond: Callable, command: dict, args: SetArgs) -> None:
+        if command["user_name"] not in self._admins:
+            logger.warning("Only admins can set the karma")
+            return
+        if not args.user_name:
+            logger.warning("Failed to parse 'set' command args")
+            return
+        self._manager.set(user_id=args.user_id, karma=args.karma)
+        respond(self._format.report_karma(args.user_name, args.karma))
+
+    @commands.command("top", Parse.cmd_top)
+    def _cmd_top(self, respond: Callable, command: dict, size: int) -> None:
+        top = self._manager.top(min(size, TOP_MAX))
+        if len(top) > BULK_LOOKUP_THRESHOLD:
+            self._directory.warm_users()
+        message = self._top_message([(self._directory.username(u), k) for u, k in top])
+        respond(self._format.message(Color.INFO, message))
+
+    @commands.command("rank", Parse.cmd_rank)
+    def _cmd_rank(self, respond: Callable, command: dict, args: UserArgs) -> None:
+        user_id = args.user_id
+        user_name = args.user_name or self._directory.username(user_id)
+        rank = self._manager.rank(user_id)
+        neighbours = self._manager.neighbours(user_id, RANK_NEIGHBOURS)
+        message = self._rank_message(
+            user_name,
+            rank,
+            [
+                (user_name if u == user_id else self._directory.username(u), k)
+                for u, k in neighbours
+            ],
+        )
+        respond(self._format.message(Color.INFO, message))
+
+    @commands.command("digest")
+    def _cmd_digest(self, respond: Callable, command: dict, args: None) -> None:
+        self.report_digest(reply_callback=respond)
+
+    @commands.command("pending")
+    def _cmd_pending(self, respond: Callable, command: dict, args: None) -> None:
+        pending = self._manager.pending()
+        if len(pending) > BULK_LOOKUP_THRESHOLD:
+            self._directory.warm_users()
+            self._directory.warm_channels()
+        message = self._pending_message(
+            [
+                (
+                    voting,
+                    self._directory.username(voting.initiator_id),
+                    self._directory.username(voting.target_id),
+                    self._directory.channel_name(voting.channel),
+                )
+                for voting in pending
+            ]
+        )
+        respond(self._format.message(Color.INFO, message))
+
+    @commands.command("help")
+    def _cmd_help(self, respond: Callable, command: dict, args: None) -> None:
+        respond(self._format.hello())
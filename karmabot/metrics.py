@@ -0,0 +1,300 @@
+"""Process-wide metrics exposed in the Prometheus text format.
+
+Metrics are registered in `REGISTRY` when they are defined, and `serve` exposes
+them over HTTP at `/metrics`.
+"""
+
+import bisect
+import contextlib
+import math
+import threading
+import time
+from collections.abc import Callable, Iterator, Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TypeVar
+
+import sqlalchemy as sa
+
+from .logging import logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)
+    )
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        "Yields (name suffix, formatted labels, value) of each sample."
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield "_total", _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    A gauge may be computed by a function when the metrics are collected
+    instead of being set. A failing function is logged and the gauge is skipped.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float] | None) -> None:
+        "Computes the (unlabelled) gauge by `function`, replacing the previous one."
+        self._function = function
+
+    def value(self, **labels: str) -> float | None:
+        return self._values.get(self._key(labels))
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        function = self._function
+        if function is not None:
+            try:
+                value = function()
+            except Exception:
+                logger.exception("Failed to collect %s", self.name)
+                return
+            yield "", "", value
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield "", _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per labels: observations by bucket (the last one is +Inf), their sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[i] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        "Observes the duration of the block, also when it raises."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        counts, _ = self._values.get(self._key(labels), ([], [0.0]))
+        return sum(counts)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        with self._lock:
+            values = [
+                (key, list(counts), total[0]) for key, (counts, total) in self._values.items()
+            ]
+        names = (*self.labelnames, "le")
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts, strict=True):
+                cumulative += count
+                yield "_bucket", _format_labels(names, (*key, _format_value(bound))), cumulative
+            yield "_sum", _format_labels(self.labelnames, key), total
+            yield "_count", _format_labels(self.labelnames, key), cumulative
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name!r} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(f"{metric.render()}\n" for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+def _registered(metric: M) -> M:
+    REGISTRY.register(metric)
+    return metric
+
+
+HANDLER_SECONDS = _registered(
+    Histogram("karmabot_handler_seconds", "Time spent handling Slack events", ["handler"])
+)
+SLACK_CALLS = _registered(Counter("karmabot_slack_calls", "Slack Web API calls", ["method"]))
+SLACK_ERRORS = _registered(
+    Counter("karmabot_slack_errors", "Failed Slack Web API calls", ["method", "error"])
+)
+DB_QUERY_SECONDS = _registered(
+    Histogram(
+        "karmabot_db_query_seconds", "Time spent executing DB queries", ["operation"], DB_BUCKETS
+    )
+)
+CACHE_REQUESTS = _registered(
+    Counter("karmabot_cache_requests", "Cache lookups by result", ["cache", "result"])
+)
+OPEN_VOTINGS = _registered(Gauge("karmabot_open_votings", "Votings that are not closed yet"))
+JOB_DURATION_SECONDS = _registered(
+    Gauge("karmabot_job_duration_seconds", "Duration of the last run of a scheduled job", ["job"])
+)
+JOB_LAG_SECONDS = _registered(
+    Gauge(
+        "karmabot_job_lag_seconds",
+        "Delay between the scheduled and the actual start of the last run of a job",
+        ["job"],
+    )
+)
+JOB_FAILURES = _registered(Counter("karmabot_job_failures", "Failed scheduled job runs", ["job"]))
+
+
+def _statement_operation(statement: str) -> str:
+    words = statement.split(maxsplit=1)
+    return words[0].upper() if words else ""
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("karmabot_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    start = conn.info["karmabot_query_start"].pop()
+    DB_QUERY_SECONDS.observe(
+        time.perf_counter() - start, operation=_statement_operation(statement)
+    )
+
+
+def _handle_error(context: sa.engine.ExceptionContext) -> None:
+    # A failed query doesn't reach `after_cursor_execute`
+    if context.connection is not None and context.statement is not None:
+        starts = context.connection.info.get("karmabot_query_start")
+        if starts:
+            starts.pop()
+
+
+def instrument_engine(engine: sa.Engine) -> None:
+    "Times the queries of the engine by their SQL operation."
+    sa.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sa.event.listen(engine, "handle_error", _handle_error)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("metrics: " + format, *args)
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    "Serves the metrics at `/metrics` from a daemon thread."
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics at http://%s:%s/metrics", *server.server_address[:2])
+    return server
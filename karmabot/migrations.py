@@ -0,0 +1,148 @@
+"""Schema migrations.
+
+`create_all` creates missing tables only and never alters the existing ones,
+so every change of an existing table is made by a migration: a function that
+takes a connection and upgrades the schema from version `N - 1` to `N`, where
+`N` is the migration's position in `MIGRATIONS` starting from 1.
+
+Migrations must not rely on ORM models because the models always describe
+the latest schema.
+"""
+
+import datetime
+from collections.abc import Callable
+
+import sqlalchemy as sa
+
+
+def add_voting_indexes(conn: sa.Connection) -> None:
+    # Drop duplicates which violate the unique index keeping the earliest ones
+    conn.execute(
+        sa.text(
+            "DELETE FROM karmabot_voting WHERE id NOT IN "
+            "(SELECT MIN(id) FROM karmabot_voting GROUP BY message_ts, channel)"
+        )
+    )
+    conn.execute(
+        sa.text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_karmabot_voting_uuid "
+            "ON karmabot_voting (message_ts, channel)"
+        )
+    )
+    conn.execute(
+        sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_karmabot_voting_closed_bot_message_ts "
+            "ON karmabot_voting (closed, bot_message_ts)"
+        )
+    )
+    conn.execute(
+        sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_karmabot_voting_closed_created "
+            "ON karmabot_voting (closed, created)"
+        )
+    )
+
+
+def add_voting_tallies(conn: sa.Connection) -> None:
+    for column in (
+        "upvotes INTEGER NOT NULL DEFAULT 0",
+        "downvotes INTEGER NOT NULL DEFAULT 0",
+        "live_tally BOOLEAN NOT NULL DEFAULT FALSE",
+    ):
+        conn.execute(sa.text(f"ALTER TABLE karmabot_voting ADD COLUMN {column}"))
+
+
+def add_karma_ledger(conn: sa.Connection) -> None:
+    # The table is created by `create_all` before the migrations run
+    # Existing balances become the initial entries of their users
+    stmt = sa.text(
+        "INSERT INTO karmabot_karma_ledger (created, user_id, delta, kind) "
+        "SELECT :created, user_id, karma, 'initial' FROM karmabot_karma"
+    ).bindparams(sa.bindparam("created", type_=sa.TIMESTAMP))
+    conn.execute(stmt, {"created": datetime.datetime.now(tz=datetime.timezone.utc)})
+
+
+def add_karma_rank_index(conn: sa.Connection) -> None:
+    conn.execute(
+        sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_karmabot_karma_karma_user_id "
+            "ON karmabot_karma (karma, user_id)"
+        )
+    )
+
+
+def add_target_to_voting_uuid(conn: sa.Connection) -> None:
+    # A message may create votings for several targets
+    conn.execute(
+        sa.text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_karmabot_voting_uuid_target "
+            "ON karmabot_voting (message_ts, channel, target_id)"
+        )
+    )
+    conn.execute(sa.text("DROP INDEX IF EXISTS ix_karmabot_voting_uuid"))
+
+
+VOTING_COLUMNS = (
+    "id, created, closed, initiator_id, target_id, channel, message_ts, bot_message_ts, "
+    "message_text, karma, live_tally, upvotes, downvotes"
+)
+
+
+def make_bot_message_ts_nullable(conn: sa.Connection) -> None:
+    # Votings are created before their bot message is posted from the outbox
+    if conn.dialect.name != "sqlite":
+        conn.execute(
+            sa.text("ALTER TABLE karmabot_voting ALTER COLUMN bot_message_ts DROP NOT NULL")
+        )
+        return
+    # SQLite can't change a column, so the table is rebuilt
+    conn.execute(
+        sa.text(
+            "CREATE TABLE karmabot_voting_new ("
+            "id INTEGER NOT NULL PRIMARY KEY, "
+            "created TIMESTAMP NOT NULL, "
+            "closed BOOLEAN NOT NULL, "
+            "initiator_id VARCHAR(256) NOT NULL, "
+            "target_id VARCHAR(256) NOT NULL, "
+            "channel VARCHAR(256) NOT NULL, "
+            "message_ts TIMESTAMP NOT NULL, "
+            "bot_message_ts TIMESTAMP, "
+            "message_text TEXT NOT NULL, "
+            "karma INTEGER NOT NULL, "
+            "live_tally BOOLEAN DEFAULT (0) NOT NULL, "
+            "upvotes INTEGER DEFAULT '0' NOT NULL, "
+            "downvotes INTEGER DEFAULT '0' NOT NULL)"
+        )
+    )
+    conn.execute(
+        sa.text(
+            f"INSERT INTO karmabot_voting_new ({VOTING_COLUMNS}) "
+            f"SELECT {VOTING_COLUMNS} FROM karmabot_voting"
+        )
+    )
+    conn.execute(sa.text("DROP TABLE karmabot_voting"))
+    conn.execute(sa.text("ALTER TABLE karmabot_voting_new RENAME TO karmabot_voting"))
+    for index in (
+        "UNIQUE INDEX ix_karmabot_voting_uuid_target ON karmabot_voting "
+        "(message_ts, channel, target_id)",
+        "INDEX ix_karmabot_voting_closed_bot_message_ts ON karmabot_voting "
+        "(closed, bot_message_ts)",
+        "INDEX ix_karmabot_voting_closed_created ON karmabot_voting (closed, created)",
+    ):
+        conn.execute(sa.text(f"CREATE {index}"))
+
+
+def add_voting_claims(conn: sa.Connection) -> None:
+    # The lease table is created by `create_all` before the migrations run
+    conn.execute(sa.text("ALTER TABLE karmabot_voting ADD COLUMN claimed_until TIMESTAMP"))
+
+
+MIGRATIONS: list[Callable[[sa.Connection], None]] = [
+    add_voting_indexes,
+    add_voting_tallies,
+    add_karma_ledger,
+    add_karma_rank_index,
+    add_target_to_voting_uuid,
+    make_bot_message_ts_nullable,
+    add_voting_claims,
+]
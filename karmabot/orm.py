@@ -1,22 +1,206 @@
 import datetime
+import functools
+import os
+import threading
 from typing import Any
 
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
 
+from .config import KarmabotDbConfig
+from .logging import logger
+from .metrics import instrument_engine
+from .migrations import MIGRATIONS
+from .profiling import PROFILER
+
 
 class OrmBase(DeclarativeBase):
     pass
 
 
-def create_session_maker(db_uri: str):
-    engine = sa.create_engine(db_uri, connect_args={"options": "-c timezone=utc"})
-    OrmBase.metadata.create_all(engine, checkfirst=True)
-    Session = sessionmaker(bind=engine)
+# Engines of the current process and the settings they were created with by DB URL
+_engines: dict[str, tuple[KarmabotDbConfig, sa.Engine]] = {}
+_engines_lock = threading.Lock()
+
+
+def create_session_maker(db: KarmabotDbConfig):
+    Session = sessionmaker(bind=get_engine(db))
     return Session
 
 
+def get_engine(db: KarmabotDbConfig) -> sa.Engine:
+    """Returns a process-wide engine for the DB URL. The schema is upgraded once on creation.
+
+    The engine is recreated when the DB settings differ from the ones it was created with.
+    """
+    with _engines_lock:
+        cached = _engines.get(db.url)
+        if cached is not None:
+            cached_db, engine = cached
+            if cached_db == db:
+                return engine
+            logger.warning("DB settings changed, recreating the engine for %s", engine.url)
+            engine.dispose()
+        engine = _create_engine(db)
+        upgrade_schema(engine)
+        _engines[db.url] = (db, engine)
+        return engine
+
+
+# Async drivers by supported backend
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def create_async_db_engine(db: KarmabotDbConfig) -> AsyncEngine:
+    """Returns a new async engine.
+
+    Pooled connections belong to the event loop they were opened in, so the
+    engine is not shared and must be disposed by its owner before the loop ends.
+    """
+    url = sa.make_url(db.url)
+    kwargs: dict[str, Any] = dict(
+        pool_recycle=int(db.pool_recycle.total_seconds()) if db.pool_recycle else -1,
+        pool_pre_ping=db.pool_pre_ping,
+    )
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"Async mode is not supported for {backend}")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == "postgresql":
+        engine = create_async_engine(
+            url,
+            connect_args={"server_settings": {"timezone": "utc"}},
+            pool_size=db.pool_size,
+            max_overflow=db.max_overflow,
+            pool_timeout=db.pool_timeout.total_seconds(),
+            **kwargs,
+        )
+    else:
+        if _is_sqlite_in_memory(url):
+            kwargs.update(poolclass=sa.StaticPool)
+        else:
+            kwargs.update(
+                poolclass=sa.AsyncAdaptedQueuePool,
+                pool_size=db.pool_size,
+                max_overflow=db.max_overflow,
+                pool_timeout=db.pool_timeout.total_seconds(),
+            )
+        busy_timeout = db.sqlite_busy_timeout.total_seconds()
+        engine = create_async_engine(
+            url,
+            connect_args={"timeout": busy_timeout},
+            **kwargs,
+        )
+        sa.event.listen(engine.sync_engine, "connect", functools.partial(_set_sqlite_pragmas, db))
+    instrument_engine(engine.sync_engine)
+    PROFILER.instrument(engine.sync_engine)
+    return engine
+
+
+def _create_engine(db: KarmabotDbConfig) -> sa.Engine:
+    url = sa.make_url(db.url)
+    pool_kwargs = dict(
+        pool_size=db.pool_size,
+        max_overflow=db.max_overflow,
+        pool_timeout=db.pool_timeout.total_seconds(),
+    )
+    kwargs: dict[str, Any] = dict(
+        pool_recycle=int(db.pool_recycle.total_seconds()) if db.pool_recycle else -1,
+        pool_pre_ping=db.pool_pre_ping,
+    )
+    backend = url.get_backend_name()
+    if backend == "postgresql":
+        engine = sa.create_engine(
+            url, connect_args={"options": "-c timezone=utc"}, **pool_kwargs, **kwargs
+        )
+    elif backend == "sqlite":
+        connect_args: dict[str, Any] = {"timeout": db.sqlite_busy_timeout.total_seconds()}
+        if _is_sqlite_in_memory(url):
+            # An in-memory DB lives in its connection, so all the threads share one
+            kwargs.update(poolclass=sa.StaticPool)
+            connect_args.update(check_same_thread=False)
+        else:
+            kwargs.update(pool_kwargs)
+        engine = sa.create_engine(url, connect_args=connect_args, **kwargs)
+        sa.event.listen(engine, "connect", functools.partial(_set_sqlite_pragmas, db))
+    else:
+        engine = sa.create_engine(url, **pool_kwargs, **kwargs)
+    instrument_engine(engine)
+    PROFILER.instrument(engine)
+    return engine
+
+
+def _is_sqlite_in_memory(url: sa.URL) -> bool:
+    return url.database in (None, "", ":memory:")
+
+
+def _set_sqlite_pragmas(db: KarmabotDbConfig, dbapi_connection, connection_record) -> None:
+    # WAL lets readers (Bolt listener threads, the scheduler) work while a writer
+    # holds the lock, and makes `synchronous=NORMAL` safe against a DB corruption
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(db.sqlite_busy_timeout.total_seconds() * 1000)}")
+    cursor.execute(f"PRAGMA mmap_size={db.sqlite_mmap_size}")
+    cursor.close()
+
+
+def _reset_engines_after_fork() -> None:
+    # Connections inherited from a parent process must not be used by a child,
+    # the child opens its own ones (e.g. scheduler's process pool workers)
+    for _, engine in _engines.values():
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_engines_after_fork)
+
+
+def upgrade_schema(engine: sa.Engine) -> None:
+    "Creates missing tables and applies pending migrations."
+    with engine.begin() as conn:
+        _upgrade_schema(conn)
+
+
+async def upgrade_schema_async(engine: AsyncEngine) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(_upgrade_schema)
+
+
+def _upgrade_schema(conn: sa.Connection) -> None:
+    inspector = sa.inspect(conn)
+    versioned = inspector.has_table(SchemaVersion.__tablename__)
+    if versioned:
+        version = conn.execute(sa.select(SchemaVersion.version)).scalar_one()
+    elif inspector.has_table(Voting.__tablename__):
+        # A DB created before the schema versioning was introduced
+        version = 0
+    else:
+        # A new DB gets the latest schema from `create_all`
+        version = len(MIGRATIONS)
+    OrmBase.metadata.create_all(conn, checkfirst=True)
+    if not versioned:
+        conn.execute(sa.insert(SchemaVersion).values(version=version))
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Upgrading DB schema to version %s: %s", i, migration.__name__)
+        migration(conn)
+        conn.execute(sa.update(SchemaVersion).values(version=i))
+
+
+def dialect_insert(bind: sa.Engine | sa.Connection):
+    """Returns a dialect specific `insert` that supports `on_conflict_do_*` clauses.
+
+    Returns None for dialects without upserts.
+    """
+    if bind.dialect.name == "postgresql":
+        return postgresql.insert
+    if bind.dialect.name == "sqlite":
+        return sqlite.insert
+    return None
+
+
 class TimezoneAwereTimestamp(sa.TypeDecorator):
     "Returns a timezone aware datetime objecto from UTC timestamp."
 
@@ -41,10 +225,47 @@ class Karma(OrmBase):
     user_id: Mapped[str] = mapped_column(sa.String(256), unique=True, nullable=False)
     karma: Mapped[int] = mapped_column(sa.Integer, nullable=False)
 
+    __table_args__ = (
+        # The leaderboard order, `user_id` breaks ties
+        sa.Index("ix_karmabot_karma_karma_user_id", "karma", "user_id"),
+    )
+
     def __repr__(self):
         return f"<Karma(user_id={self.user_id}, karma={self.karma})>"
 
 
+class LedgerKind:
+    INITIAL = "initial"
+    VOTING = "voting"
+    SET = "set"
+
+
+class KarmaLedger(OrmBase):
+    "Append-only log of karma changes: a `Karma` balance is the sum of its user's deltas."
+
+    __tablename__ = "karmabot_karma_ledger"
+
+    id: Mapped[int] = mapped_column(sa.Integer, primary_key=True)
+    created: Mapped[datetime.datetime] = mapped_column(
+        TimezoneAwereTimestamp,
+        nullable=False,
+        default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+    user_id: Mapped[str] = mapped_column(sa.String(256), nullable=False)
+    delta: Mapped[int] = mapped_column(sa.Integer, nullable=False)
+    kind: Mapped[str] = mapped_column(sa.String(16), nullable=False)
+    # Votings are purged after `karma.keep_history`, so it's not a foreign key
+    voting_id: Mapped[int | None] = mapped_column(sa.Integer, nullable=True)
+
+    __table_args__ = (
+        # Sums by user and changes of a user over a period
+        sa.Index("ix_karmabot_karma_ledger_user_id_created", "user_id", "created"),
+    )
+
+    def __repr__(self):
+        return f"<KarmaLedger(user_id={self.user_id}, delta={self.delta}, kind={self.kind})>"
+
+
 class Voting(OrmBase):
     __tablename__ = "karmabot_voting"
 
@@ -59,12 +280,97 @@ class Voting(OrmBase):
     target_id: Mapped[str] = mapped_column(sa.String(256), nullable=False)
     channel: Mapped[str] = mapped_column(sa.String(256), nullable=False)
     message_ts: Mapped[datetime.datetime] = mapped_column(TimezoneAwereTimestamp, nullable=False)
-    bot_message_ts: Mapped[datetime.datetime] = mapped_column(
-        TimezoneAwereTimestamp, nullable=False
+    # Set once the bot message is posted from the outbox
+    bot_message_ts: Mapped[datetime.datetime | None] = mapped_column(
+        TimezoneAwereTimestamp, nullable=True
     )
     message_text: Mapped[str] = mapped_column(sa.Text, nullable=False)
     karma: Mapped[int] = mapped_column(sa.Integer, nullable=False)
+    # Reactions counted from events when `karma.live_tally` is on
+    live_tally: Mapped[bool] = mapped_column(
+        sa.Boolean, nullable=False, default=False, server_default=sa.false()
+    )
+    upvotes: Mapped[int] = mapped_column(sa.Integer, nullable=False, default=0, server_default="0")
+    downvotes: Mapped[int] = mapped_column(
+        sa.Integer, nullable=False, default=0, server_default="0"
+    )
+    # An expired voting is closed by the replica that claimed it until then
+    claimed_until: Mapped[datetime.datetime | None] = mapped_column(
+        TimezoneAwereTimestamp, nullable=True
+    )
+
+    __table_args__ = (
+        # A message votes for one or more targets
+        sa.Index(
+            "ix_karmabot_voting_uuid_target", "message_ts", "channel", "target_id", unique=True
+        ),
+        # Open votings by expiration time
+        sa.Index("ix_karmabot_voting_closed_bot_message_ts", "closed", "bot_message_ts"),
+        # Closed votings by age
+        sa.Index("ix_karmabot_voting_closed_created", "closed", "created"),
+    )
 
     @hybrid_property
     def uuid(self) -> tuple[datetime.datetime, str]:
         return self.message_ts, self.channel
+
+
+class OutboxKind:
+    NEW_VOTING = "new_voting"
+    VOTING_RESULT = "voting_result"
+
+
+class OutboxMessage(OrmBase):
+    """A Slack message to post or update, saved in the transaction that needs it.
+
+    A `new_voting` message is posted to the thread `ts` and its ts is set as
+    `bot_message_ts` of the votings of the thread. A `voting_result` updates
+    the message `ts`.
+    """
+
+    __tablename__ = "karmabot_outbox"
+
+    id: Mapped[int] = mapped_column(sa.Integer, primary_key=True)
+    created: Mapped[datetime.datetime] = mapped_column(
+        TimezoneAwereTimestamp,
+        nullable=False,
+        default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+    kind: Mapped[str] = mapped_column(sa.String(16), nullable=False)
+    channel: Mapped[str] = mapped_column(sa.String(256), nullable=False)
+    ts: Mapped[str] = mapped_column(sa.String(32), nullable=False)
+    # JSON of the message's `chat.postMessage` / `chat.update` arguments
+    payload: Mapped[str] = mapped_column(sa.Text, nullable=False)
+    attempts: Mapped[int] = mapped_column(sa.Integer, nullable=False, default=0)
+    next_attempt: Mapped[datetime.datetime] = mapped_column(
+        TimezoneAwereTimestamp,
+        nullable=False,
+        default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+
+    __table_args__ = (
+        # Due messages in order
+        sa.Index("ix_karmabot_outbox_next_attempt_id", "next_attempt", "id"),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, kind={self.kind}, channel={self.channel})>"
+
+
+class Lease(OrmBase):
+    "A named lease held by one replica until it expires, e.g. to run a job once."
+
+    __tablename__ = "karmabot_lease"
+
+    name: Mapped[str] = mapped_column(sa.String(64), primary_key=True)
+    holder: Mapped[str] = mapped_column(sa.String(256), nullable=False)
+    expires: Mapped[datetime.datetime] = mapped_column(TimezoneAwereTimestamp, nullable=False)
+
+    def __repr__(self):
+        return f"<Lease(name={self.name}, holder={self.holder}, expires={self.expires})>"
+
+
+class SchemaVersion(OrmBase):
+    __tablename__ = "karmabot_schema_version"
+
+    version: Mapped[int] = mapped_column(sa.Integer, primary_key=True, autoincrement=False)
@@ -0,0 +1,41 @@
+import threading
+from collections.abc import Callable
+
+from .logging import logger
+
+
+class OutboxDrainer:
+    """Delivers the outbox messages from a background thread.
+
+    The thread calls `drain`, which delivers a batch and returns its size, until
+    a batch is not full. It's woken up by `notify` once a message is saved, and
+    checks the outbox every `interval` seconds for the messages saved by other
+    processes or waiting for a retry.
+    """
+
+    def __init__(self, drain: Callable[[], int], batch_size: int, interval: float) -> None:
+        self._drain = drain
+        self._batch_size = batch_size
+        self._interval = interval
+        self._notified = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def notify(self) -> None:
+        with self._condition:
+            self._notified = True
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._notified, self._interval)
+                self._notified = False
+            try:
+                while self._drain() >= self._batch_size:
+                    pass
+            except Exception:
+                logger.exception("Failed to drain the outbox")
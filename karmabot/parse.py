@@ -1,38 +1,88 @@
 import re
+from typing import NamedTuple
 
 REGEX_USER = r"<@(\w+)(\|\w+)?>"
 REGEX_KARMA = r"([+]{1,}|[-]{1,})"
-REGEX_KARMA_CHANGE = rf"<@(\w+)>\s+<@(\w+)>\s+{REGEX_KARMA}+(\s+\w+)?"
+REGEX_KARMA_CHANGE = rf"<@(\w+)>((?:\s+<@\w+>)+)\s+{REGEX_KARMA}+(\s+\w+)?"
+# Number of users shown by `top` without an argument
+DEFAULT_TOP = 10
+
+# Patterns are compiled once instead of being looked up in the `re` cache per call
+_KARMA_CHANGE = re.compile(REGEX_KARMA_CHANGE)
+_MENTION = re.compile(r"<@(\w+)>")
+_CMD_GET = re.compile(rf"get\s+{REGEX_USER}")
+_CMD_SET = re.compile(rf"set\s+{REGEX_USER}\s([-+]?[0-9]+)$")
+_CMD_TOP = re.compile(r"top(?:\s+([0-9]+))?$")
+_CMD_RANK = re.compile(rf"rank\s+{REGEX_USER}")
+
+
+class KarmaChange(NamedTuple):
+    bot_id: str
+    user_ids: list[str]
+    karma: int
+    reason: str | None
+
+
+class UserArgs(NamedTuple):
+    user_id: str
+    user_name: str | None
+
+
+class SetArgs(NamedTuple):
+    user_id: str
+    user_name: str | None
+    karma: int
 
 
 class Parse:
     @staticmethod
-    def karma_change(text: str) -> tuple[str, str, int, str | None] | None:
-        r = re.match(REGEX_KARMA_CHANGE, text)
+    def karma_change(text: str) -> KarmaChange | None:
+        """Parses `<@bot> <@user1> <@user2> ++ reason` into the bot id, the user ids,
+        the karma and the reason. A user mentioned several times is voted for once.
+        """
+        r = _KARMA_CHANGE.match(text)
         if not r:
             return None
 
-        bot_id, user_id, vote, reason = r.groups()
+        bot_id, users, vote, reason = r.groups()
+        user_ids = list(dict.fromkeys(_MENTION.findall(users)))
         plus = vote.count("+")
         minus = vote.count("-")
         if reason:
             reason = reason.strip()
-        return bot_id, user_id, plus or -minus, reason
+        return KarmaChange(bot_id, user_ids, plus or -minus, reason)
 
     @staticmethod
-    def cmd_get(text: str) -> tuple[str, str | None] | None:
-        r = re.match(rf"get\s+{REGEX_USER}", text)
+    def cmd_get(text: str) -> UserArgs | None:
+        r = _CMD_GET.match(text)
         if not r:
             return None
         user_id, user_name = r.groups()
         user_name = user_name.removeprefix("|") if user_name else None
-        return user_id, user_name
+        return UserArgs(user_id, user_name)
 
     @staticmethod
-    def cmd_set(text: str) -> tuple[str, str | None, int] | None:
-        r = re.match(rf"set\s+{REGEX_USER}\s([-+]?[0-9]+)$", text)
+    def cmd_set(text: str) -> SetArgs | None:
+        r = _CMD_SET.match(text)
         if not r:
             return None
         user_id, user_name, karma = r.groups()
         user_name = user_name.removeprefix("|") if user_name else None
-        return user_id, user_name, int(karma)
+        return SetArgs(user_id, user_name, int(karma))
+
+    @staticmethod
+    def cmd_top(text: str) -> int | None:
+        r = _CMD_TOP.match(text)
+        if not r:
+            return None
+        size = r.group(1)
+        return int(size) if size else DEFAULT_TOP
+
+    @staticmethod
+    def cmd_rank(text: str) -> UserArgs | None:
+        r = _CMD_RANK.match(text)
+        if not r:
+            return None
+        user_id, user_name = r.groups()
+        user_name = user_name.removeprefix("|") if user_name else None
+        return UserArgs(user_id, user_name)
@@ -0,0 +1,154 @@
+"""Opt-in profiling of DB queries by logical operation.
+
+Queries are attributed to the innermost `PROFILER.operation`, e.g. a Slack event
+handler. Slow queries are logged with their parameters, and a statement repeated
+within one operation, which is usually a query per row in a loop, is flagged.
+"""
+
+import contextlib
+import contextvars
+import re
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+
+from .logging import logger
+
+# Statements that are not executed inside an operation
+NO_OPERATION = "-"
+# Max length of the parameters in a log line
+PARAMS_LOG_SIZE = 300
+# Number of statements in the summary
+SUMMARY_SIZE = 20
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+@dataclass
+class _Invocation:
+    name: str
+    statements: Counter[str] = field(default_factory=Counter)
+
+
+@dataclass
+class StatementStats:
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    # Invocations of the operation that repeated the statement
+    repeated: int = 0
+
+
+_invocation: contextvars.ContextVar[_Invocation | None] = contextvars.ContextVar(
+    "karmabot_profiled_operation", default=None
+)
+
+
+class QueryProfiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.slow_query = 0.0
+        self.repeated_queries = 0
+        self._stats: dict[tuple[str, str], StatementStats] = {}
+        self._lock = threading.Lock()
+
+    def enable(self, slow_query: float, repeated_queries: int) -> None:
+        "Starts profiling, see `KarmabotProfilingConfig`."
+        self.slow_query = slow_query
+        self.repeated_queries = repeated_queries
+        self.enabled = True
+
+    def instrument(self, engine: sa.Engine) -> None:
+        sa.event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        sa.event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        sa.event.listen(engine, "handle_error", self._handle_error)
+
+    @contextlib.contextmanager
+    def operation(self, name: str) -> Iterator[None]:
+        "Attributes the queries executed in the block to the `name` operation."
+        if not self.enabled:
+            yield
+            return
+        token = _invocation.set(_Invocation(name))
+        try:
+            yield
+        finally:
+            _invocation.reset(token)
+
+    def stats(self) -> dict[tuple[str, str], StatementStats]:
+        "Statement stats by operation and statement."
+        with self._lock:
+            return {key: StatementStats(**vars(s)) for key, s in self._stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self) -> str:
+        "Statements that took the most time in total."
+        stats = sorted(self.stats().items(), key=lambda item: item[1].seconds, reverse=True)
+        lines = [f"Query profile, top {SUMMARY_SIZE} statements by total time:"]
+        for (operation, statement), s in stats[:SUMMARY_SIZE]:
+            lines.append(
+                f"{s.seconds * 1e3:10.1f} ms {s.count:>7} calls"
+                f" {s.max_seconds * 1e3:8.1f} ms max {s.repeated:>5} repeated"
+                f"  [{operation}] {statement}"
+            )
+        return "\n".join(lines)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        if self.enabled:
+            conn.info.setdefault("karmabot_profile_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        starts = conn.info.get("karmabot_profile_start")
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        statement = _WHITESPACE.sub(" ", statement).strip()
+        invocation = _invocation.get()
+        operation = invocation.name if invocation is not None else NO_OPERATION
+        if seconds >= self.slow_query:
+            logger.warning(
+                "Slow query (%.1f ms) in %s: %s %.*s",
+                seconds * 1e3,
+                operation,
+                statement,
+                PARAMS_LOG_SIZE,
+                repr(parameters),
+            )
+        repeated = False
+        if invocation is not None:
+            invocation.statements[statement] += 1
+            repeated = invocation.statements[statement] == self.repeated_queries
+            if repeated:
+                logger.warning(
+                    "Statement repeated %d times in one %s, consider batching: %s",
+                    self.repeated_queries,
+                    operation,
+                    statement,
+                )
+        with self._lock:
+            s = self._stats.setdefault((operation, statement), StatementStats())
+            s.count += 1
+            s.seconds += seconds
+            s.max_seconds = max(s.max_seconds, seconds)
+            s.repeated += repeated
+
+    def _handle_error(self, context: sa.engine.ExceptionContext) -> None:
+        # A failed query doesn't reach `after_cursor_execute`
+        if context.connection is not None and context.statement is not None:
+            starts = context.connection.info.get("karmabot_profile_start")
+            if starts:
+                starts.pop()
+
+
+PROFILER = QueryProfiler()
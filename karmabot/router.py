@@ -0,0 +1,51 @@
+from collections.abc import Callable
+from typing import Any, NamedTuple
+
+Handler = Callable[..., Any]
+Parser = Callable[[str], Any]
+
+
+class Route(NamedTuple):
+    name: str
+    handler: Handler
+    args: Any
+
+
+class CommandRouter:
+    """Dispatches `/karmabot` commands to handlers by their first word.
+
+    A handler is registered together with a parser of the command text, which
+    returns the arguments or None if the text doesn't match. A command without
+    a parser takes no arguments.
+    """
+
+    def __init__(self) -> None:
+        self._routes: dict[str, tuple[Parser | None, Handler]] = {}
+
+    def command(self, name: str, parser: Parser | None = None) -> Callable[[Handler], Handler]:
+        "Registers the decorated function as the handler of the `name` command."
+
+        def register(handler: Handler) -> Handler:
+            if name in self._routes:
+                raise ValueError(f"Command {name!r} is already registered")
+            self._routes[name] = (parser, handler)
+            return handler
+
+        return register
+
+    def resolve(self, text: str) -> Route | None:
+        "Returns the handler of a command with its arguments, None for an unknown command."
+        words = text.split(maxsplit=1)
+        if not words:
+            return None
+        name = words[0]
+        route = self._routes.get(name)
+        if route is None:
+            return None
+        parser, handler = route
+        if parser is None:
+            return Route(name, handler, None) if text == name else None
+        args = parser(text)
+        if args is None:
+            return None
+        return Route(name, handler, args)
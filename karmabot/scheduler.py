@@ -7,36 +7,79 @@ Notes
 2. For security's and flexibility's sake the only argument passed
 is a config path. This way we avoid re-creating jobs in case if config
 was modified.
+3. Replicas sharing a DB all run the jobs. Votings are claimed by one of
+them, and the jobs that must run once, like the digest, take a lease.
+4. Jobs run in a dedicated single-process pool. The worker process is
+long-lived and keeps one warm `Karmabot` (Slack client, DB engine,
+translations) between runs, rebuilding it only when the config file
+modification time changes.
 """
 
+import datetime
 import pathlib
-
-import yaml
+import time
+
+import sqlalchemy as sa
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_SUBMITTED,
+    JobEvent,
+    JobExecutionEvent,
+    JobSubmissionEvent,
+)
 from apscheduler.executors.pool import ProcessPoolExecutor
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 from slack_bolt import App
 
-from .config import KarmabotConfig
+from .config import KarmabotConfig, load_config
 from .karmabot import Karmabot
 from .logging import logger
+from .metrics import JOB_DURATION_SECONDS, JOB_FAILURES, JOB_LAG_SECONDS
+from .orm import get_engine
+from .profiling import PROFILER
 from .slack_utils import (
     channel_exists,
 )
 
+MAINTENANCE_EXECUTOR = "maintenance"
+# The digest is posted by the replica that takes the lease, the others skip it
+DIGEST_LEASE = datetime.timedelta(days=1)
+
+# Warm bots of the current (worker) process: config path -> (config mtime, bot)
+_karmabots: dict[pathlib.Path, tuple[float, Karmabot]] = {}
+
 
 class KarmabotScheduler:
-    def __init__(self, config_path: pathlib.Path):
-        with config_path.open("r") as f:
-            config_dict = yaml.safe_load(f)
-        self._config = KarmabotConfig.model_validate(config_dict)
-        self._scheduler = create_scheduler(self._config.db)
+    def __init__(self, config_path: pathlib.Path, config: KarmabotConfig):
+        self._config = config
+        self._scheduler = create_scheduler(get_engine(self._config.db))
+        # Submission times of the running jobs by job id
+        self._submitted: dict[str, float] = {}
+        self._scheduler.add_listener(
+            self._on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR
+        )
         self._init_monthly_digest(config_path)
         self._init_voting_maintenance(config_path)
 
     def start(self) -> None:
         self._scheduler.start()
 
+    def _on_job_event(self, event: JobEvent) -> None:
+        # Jobs run in the worker process, so they are measured from the scheduler's events
+        if isinstance(event, JobSubmissionEvent):
+            self._submitted[event.job_id] = time.monotonic()
+            scheduled = min(event.scheduled_run_times)
+            lag = datetime.datetime.now(tz=scheduled.tzinfo) - scheduled
+            JOB_LAG_SECONDS.set(lag.total_seconds(), job=event.job_id)
+        elif isinstance(event, JobExecutionEvent):
+            submitted = self._submitted.pop(event.job_id, None)
+            if submitted is not None:
+                JOB_DURATION_SECONDS.set(time.monotonic() - submitted, job=event.job_id)
+            if event.exception is not None:
+                JOB_FAILURES.inc(job=event.job_id)
+
     def _init_monthly_digest(self, config_path: pathlib.Path) -> None:
         if self._config.digest.day <= 0:
             logger.warning("Failed to configure the montly digest: a day is less than 0")
@@ -58,36 +101,63 @@ class KarmabotScheduler:
             day=self._config.digest.day,
             hour=self._config.digest.hour,
             minute=self._config.digest.minute,
+            executor=MAINTENANCE_EXECUTOR,
             replace_existing=True,
         )
 
     def _init_voting_maintenance(self, config_path: pathlib.Path) -> None:
+        # Votings are closed on time by the bot's expiry timer, the job is a safety net
+        # for the votings it missed (e.g. the ones expired while the bot was down)
         self._scheduler.add_job(
             voting_maintenance_job,
             kwargs=dict(config_path=config_path),
             id="voting_maintenance",
-            trigger="cron",
-            minute="*",
+            trigger="interval",
+            seconds=self._config.karma.sweep_interval.total_seconds(),
+            executor=MAINTENANCE_EXECUTOR,
             replace_existing=True,
         )
 
 
+def get_karmabot(config_path: pathlib.Path) -> Karmabot:
+    """Return a warm `Karmabot` for the config, re-creating it if the config was modified."""
+    mtime = config_path.stat().st_mtime
+    cached = _karmabots.get(config_path)
+    if cached is not None:
+        cached_mtime, karmabot = cached
+        if cached_mtime == mtime:
+            return karmabot
+        logger.info("Config [%s] was modified, reloading", config_path)
+    karmabot = Karmabot(load_config(config_path))
+    _karmabots[config_path] = (mtime, karmabot)
+    return karmabot
+
+
 def monthly_digest_job(config_path: pathlib.Path) -> None:
     """Montly digest job entry point."""
-    karmabot = Karmabot(config_path)
-    karmabot.report_digest()
+    karmabot = get_karmabot(config_path)
+    with PROFILER.operation("monthly_digest"):
+        if not karmabot.acquire_lease("monthly_digest", DIGEST_LEASE):
+            logger.info("The monthly digest is posted by another replica")
+            return
+        karmabot.report_digest()
 
 
 def voting_maintenance_job(config_path: pathlib.Path) -> None:
     """Close expired and delete outdated votings job entry point."""
-    karmabot = Karmabot(config_path)
-    karmabot.process_expired_votings()
+    karmabot = get_karmabot(config_path)
+    with PROFILER.operation("voting_maintenance"):
+        karmabot.process_expired_votings()
 
 
-def create_scheduler(url: str):
+def create_scheduler(engine: sa.Engine):
     """Create a scheduler that saves the state in DB."""
-    jobstores = {"default": SQLAlchemyJobStore(url=url)}
-    executors = {"default": ProcessPoolExecutor()}
+    jobstores = {"default": SQLAlchemyJobStore(engine=engine)}
+    executors = {
+        "default": ProcessPoolExecutor(),
+        # A single long-lived worker so that the warm `Karmabot` is reused between runs
+        MAINTENANCE_EXECUTOR: ProcessPoolExecutor(max_workers=1),
+    }
     job_defaults = {
         "coalesce": True,  # run only once if turns out we need to run > 1 time
         "max_instances": 1,  # max number of job of one type running simultaneously
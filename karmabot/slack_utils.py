@@ -1,18 +1,132 @@
-from collections import Counter
+import datetime
+import itertools
+import random
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Hashable, Iterator
 
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 from slack_sdk.web import SlackResponse, WebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
 
+from .cache import TTLCache
 from .logging import logger
+from .metrics import SLACK_CALLS, SLACK_ERRORS
+
+# Max page size recommended by Slack for paginated `*.list` methods
+PAGE_SIZE = 200
+
+# Calls per minute by Web API method following the method's rate limit tier
+# (https://api.slack.com/apis/rate-limits)
+METHOD_RATE_LIMITS = {
+    "conversations.list": 20,  # Tier 2
+    "users.list": 20,  # Tier 2
+    "chat.update": 50,  # Tier 3
+    "conversations.info": 50,  # Tier 3
+    "reactions.get": 50,  # Tier 3
+    "users.info": 100,  # Tier 4
+    "chat.postMessage": 60,  # Special: 1 per second per channel
+}
+DEFAULT_RATE_LIMIT = 50
+# Retries of calls rejected with HTTP 429 after their `Retry-After`
+RATE_LIMIT_RETRIES = 2
+# Threads sending the messages queued by `SlackDispatcher`
+DISPATCHER_WORKERS = 2
+# Attempts to send a queued message still rejected with HTTP 429 after the client's retries
+DISPATCH_ATTEMPTS = 3
+# Max random seconds added to `Retry-After`, so that the rejected calls don't retry at once
+RETRY_JITTER = 1.0
+
+
+class RateLimiter:
+    """Token buckets by Web API method sized to `METHOD_RATE_LIMITS`.
+
+    A bucket holds a tenth of the method's per minute limit, so short bursts
+    go through while the sustained rate stays within the tier.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        # When the next call of a method is due if its bucket is empty
+        self._due: dict[str, float] = {}
+
+    def reserve(self, api_method: str) -> float:
+        "Reserves a call and returns the number of seconds to wait before making it."
+        rate = METHOD_RATE_LIMITS.get(api_method, DEFAULT_RATE_LIMIT)
+        interval = 60 / rate
+        burst = max(1, rate // 10)
+        with self._lock:
+            now = self._clock()
+            due = max(self._due.get(api_method, now), now)
+            self._due[api_method] = due + interval
+            return max(0.0, due - now - (burst - 1) * interval)
+
+
+class LimitedWebClient(WebClient):
+    """A WebClient that keeps calls of each API method within its rate limit tier.
+
+    Calls wait for `RateLimiter`, and the ones rejected with HTTP 429 anyway are
+    retried after `Retry-After`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=RATE_LIMIT_RETRIES))
+        self._limiter = RateLimiter()
+
+    def api_call(self, api_method: str, **kwargs) -> SlackResponse:
+        delay = self._limiter.reserve(api_method)
+        if delay > 0:
+            time.sleep(delay)
+        SLACK_CALLS.inc(method=api_method)
+        try:
+            return super().api_call(api_method, **kwargs)
+        except Exception as e:
+            SLACK_ERRORS.inc(method=api_method, error=api_error(e))
+            raise
+
+
+def api_error(e: Exception) -> str:
+    "The Slack error code of a failed API call, or the exception type if there's none."
+    if isinstance(e, SlackApiError):
+        return e.response.get("error") or "unknown"
+    return type(e).__name__
+
+
+def paginate(method: Callable[..., SlackResponse], key: str, **kwargs) -> Iterator[dict]:
+    """Yields the items of a paginated `*.list` method.
+
+    Unlike iterating over a `SlackResponse`, each page is requested with
+    `api_call` and so is rate limited.
+    """
+    cursor = None
+    while True:
+        page = method(limit=PAGE_SIZE, cursor=cursor, **kwargs)
+        yield from page.get(key) or []
+        cursor = next_cursor(page)
+        if not cursor:
+            return
+
+
+def next_cursor(page: SlackResponse | AsyncSlackResponse) -> str | None:
+    return (page.get("response_metadata") or {}).get("next_cursor") or None
 
 
 def lookup_username(client: WebClient, user_id: str) -> str:
     user = user_id.strip("<>@")
     userinfo = client.users_info(user=user)
-    profile = userinfo["user"]["profile"]
+    return user_display_name(userinfo["user"])
+
+
+def user_display_name(user: dict) -> str:
+    profile = user["profile"]
     # A user may have some names set or may have no names at all.
     # The only name the user always have is userinfo.user.name.
     # `display_name` is preffered.
-    return profile.get("display_name") or profile.get("real_name") or userinfo["user"]["name"]
+    return profile.get("display_name") or profile.get("real_name") or user["name"]
 
 
 def lookup_channel_name(client: WebClient, channel_id: str) -> str:
@@ -31,12 +145,21 @@ def reactions_get(
         message = result.get("message")
         if message is None:
             return None
-        reactions = message.get("reactions") or []
-        for c in reactions:
-            r[c["name"]] += c["count"]
+        add_reactions(r, message)
     return r
 
 
+def add_reactions(counter: Counter[str], message: dict) -> None:
+    "Adds reactions of a `reactions.get` message to the counter."
+    for c in message.get("reactions") or []:
+        counter[c["name"]] += c["count"]
+
+
+def format_ts(dt: datetime.datetime) -> str:
+    "Formats a message timestamp as Slack does, with all 6 digits of microseconds."
+    return f"{dt.timestamp():.6f}"
+
+
 def message_post(
     client: WebClient, channel: str, msg: dict, ts: str | None = None
 ) -> SlackResponse:
@@ -60,3 +183,205 @@ def channel_exists(client: WebClient, channel: str) -> bool:
 def post_im(client: WebClient, user_id: str, msg: dict) -> SlackResponse:
     new_dm = client.im_open(user=user_id)
     return message_post(client, new_dm["channel"]["id"], msg)
+
+
+class SlackDispatcher:
+    """Sends messages from background threads, so that handlers don't wait for Slack.
+
+    Each call is still kept within its rate limit tier by `LimitedWebClient`. A
+    call rejected with HTTP 429 anyway is retried after `Retry-After` with a random
+    jitter. An update of a message replaces the queued update of that message, and
+    updates of one message are never sent concurrently. Threads are started on the
+    first message.
+    """
+
+    def __init__(self, client: WebClient, workers: int = DISPATCHER_WORKERS) -> None:
+        self._client = client
+        self._workers = workers
+        self._threads: list[threading.Thread] = []
+        self._condition = threading.Condition()
+        # Keys of the queued calls in order and the calls by key
+        self._queue: deque[Hashable] = deque()
+        self._calls: dict[Hashable, tuple[str, Callable[[], object]]] = {}
+        self._in_flight: set[Hashable] = set()
+        self._ids = itertools.count()
+
+    def post(self, channel: str, msg: dict, ts: str | None = None) -> None:
+        self._put(
+            next(self._ids),
+            "chat.postMessage",
+            lambda: message_post(self._client, channel, msg, ts),
+        )
+
+    def update(self, channel: str, msg: dict, ts: str) -> None:
+        self._put(
+            ("chat.update", channel, ts),
+            "chat.update",
+            lambda: message_update(self._client, channel, msg, ts),
+        )
+
+    def post_im(self, user_id: str, msg: dict) -> None:
+        self._put(next(self._ids), "chat.postMessage", lambda: post_im(self._client, user_id, msg))
+
+    def join(self, timeout: float | None = None) -> bool:
+        "Waits until all the queued messages are sent, returns False on timeout."
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queue and not self._in_flight, timeout
+            )
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _put(self, key: Hashable, api_method: str, call: Callable[[], object]) -> None:
+        with self._condition:
+            if not self._threads:
+                for i in range(self._workers):
+                    thread = threading.Thread(
+                        target=self._run, name=f"dispatcher-{i}", daemon=True
+                    )
+                    thread.start()
+                    self._threads.append(thread)
+            if key in self._calls:
+                logger.debug("Coalesced %s %s", api_method, key)
+            else:
+                self._queue.append(key)
+            self._calls[key] = (api_method, call)
+            self._condition.notify()
+
+    def _next(self) -> Hashable | None:
+        for key in self._queue:
+            if key not in self._in_flight:
+                self._queue.remove(key)
+                return key
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while (key := self._next()) is None:
+                    self._condition.wait()
+                api_method, call = self._calls.pop(key)
+                self._in_flight.add(key)
+            try:
+                self._send(api_method, call)
+            finally:
+                with self._condition:
+                    self._in_flight.discard(key)
+                    self._condition.notify_all()
+
+    def _send(self, api_method: str, call: Callable[[], object]) -> None:
+        for attempt in range(1, DISPATCH_ATTEMPTS + 1):
+            try:
+                call()
+                return
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == DISPATCH_ATTEMPTS:
+                    logger.warning("Failed to send %s: %s", api_method, e.response.get("error"))
+                    return
+                time.sleep(retry_after(e.response) + random.uniform(0, RETRY_JITTER))
+            except Exception:
+                logger.exception("Failed to send %s", api_method)
+                return
+
+
+def retry_after(response: SlackResponse) -> float:
+    "Seconds to wait before retrying a call rejected with HTTP 429."
+    for name, value in response.headers.items():
+        if name.lower() == "retry-after":
+            # Header values are lists with urllib and strings with other HTTP clients
+            return float(value[0] if isinstance(value, list) else value)
+    return 1.0
+
+
+class DirectoryCache:
+    """Cached names and warm-up bookkeeping shared by the sync and the async directories.
+
+    Subclasses make the Slack calls.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._users: TTLCache[str, str] = TTLCache(maxsize, ttl, name="users")
+        self._channels: TTLCache[str, str] = TTLCache(maxsize, ttl, name="channels")
+        # Monotonic time of the last bulk load by kind: "users" or "channels"
+        self._warmed: dict[str, float] = {}
+
+    def update_user(self, user: dict) -> None:
+        """Refresh a user from a `team_join` / `user_change` event payload."""
+        if user.get("profile"):
+            self._store_user(user)
+        else:
+            self._users.pop(user["id"])
+
+    def _store_user(self, user: dict) -> None:
+        self._users.set(user["id"], user_display_name(user))
+
+    def _store_channel(self, channel: dict) -> None:
+        self._channels.set(channel["id"], channel["name"])
+
+    def _is_warm(self, kind: str) -> bool:
+        warmed = self._warmed.get(kind)
+        return warmed is not None and time.monotonic() - warmed < self._ttl
+
+    def _set_warm(self, kind: str, loaded: int) -> None:
+        if loaded > self._maxsize:
+            # Some of the loaded entries were evicted, so the next bulk lookup loads them again
+            logger.warning(
+                "Loaded %s %s but slack.directory_size is %s", loaded, kind, self._maxsize
+            )
+            return
+        self._warmed[kind] = time.monotonic()
+
+
+class SlackDirectory(DirectoryCache):
+    """A shared cache of user and channel names.
+
+    Misses fall back to `users.info` / `conversations.info`, while `warm_users`
+    and `warm_channels` fill the cache in bulk from paginated `*.list` methods.
+    """
+
+    def __init__(self, client: WebClient, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self._client = client
+        self._lock = threading.Lock()
+
+    def username(self, user_id: str) -> str:
+        user_id = user_id.strip("<>@")
+        name = self._users.get(user_id)
+        if name is None:
+            name = lookup_username(self._client, user_id)
+            self._users.set(user_id, name)
+        return name
+
+    def channel_name(self, channel_id: str) -> str:
+        channel_id = channel_id.strip("<>@")
+        name = self._channels.get(channel_id)
+        if name is None:
+            name = lookup_channel_name(self._client, channel_id)
+            self._channels.set(channel_id, name)
+        return name
+
+    def warm_users(self) -> None:
+        """Load all the users unless it was done during the last TTL period."""
+        with self._lock:
+            if self._is_warm("users"):
+                return
+            loaded = 0
+            for user in paginate(self._client.users_list, "members"):
+                self._store_user(user)
+                loaded += 1
+            self._set_warm("users", loaded)
+
+    def warm_channels(self) -> None:
+        """Load all the channels unless it was done during the last TTL period."""
+        with self._lock:
+            if self._is_warm("channels"):
+                return
+            loaded = 0
+            channels = paginate(self._client.conversations_list, "channels", exclude_archived=True)
+            for channel in channels:
+                self._store_channel(channel)
+                loaded += 1
+            self._set_warm("channels", loaded)
@@ -1,9 +1,20 @@
+import pathlib
+import time
+
 import pytest
 import sqlalchemy as sa
+import yaml
 
 from karmabot.config import KarmabotConfig
 from karmabot.karma_manager import KarmaManager
-from karmabot.orm import Karma, Voting, create_session_maker
+from karmabot.orm import (
+    Karma,
+    KarmaLedger,
+    Lease,
+    OutboxMessage,
+    Voting,
+    create_session_maker,
+)
 
 
 @pytest.fixture(scope="session")
@@ -50,7 +61,7 @@ def config(test_channel: str) -> KarmabotConfig:
         "slack_bot_token": "xobx-123",
         "slack_app_token": "xapp-123",
         "admins": ["omni"],
-        "digest": {"day": 1, "channel": test_channel},
+        "digest": {"day": 1, "hour": 1, "minute": 1, "channel": test_channel},
         "log_level": "debug",
     }
     return KarmabotConfig.model_validate(config_dict)
@@ -65,6 +76,7 @@ def seed_sample_karma(config: KarmabotConfig, sample_karma: dict):
     yield
     with session_class.begin() as s:
         s.execute(sa.delete(Karma))
+        s.execute(sa.delete(KarmaLedger))
 
 
 @pytest.fixture(scope="function")
@@ -73,8 +85,34 @@ def cleanup_voting_table(config: KarmabotConfig):
     session_class = create_session_maker(config.db)
     with session_class.begin() as s:
         s.execute(sa.delete(Voting))
+        s.execute(sa.delete(OutboxMessage))
+        s.execute(sa.delete(Lease))
+
+
+@pytest.fixture(scope="function")
+def cleanup_karma_table(config: KarmabotConfig):
+    yield
+    session_class = create_session_maker(config.db)
+    with session_class.begin() as s:
+        s.execute(sa.delete(Karma))
+        s.execute(sa.delete(KarmaLedger))
 
 
 @pytest.fixture
 def km(config: KarmabotConfig) -> KarmaManager:
     return KarmaManager(config)
+
+
+@pytest.fixture
+def config_path(config: KarmabotConfig, tmp_path: pathlib.Path) -> pathlib.Path:
+    path = tmp_path / "config.yml"
+    path.write_text(yaml.safe_dump(config.model_dump(mode="json")))
+    return path
+
+
+@pytest.fixture
+def sleeps(monkeypatch: pytest.MonkeyPatch) -> list[float]:
+    "Records `time.sleep` calls instead of sleeping."
+    sleeps: list[float] = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return sleeps
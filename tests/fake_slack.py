@@ -0,0 +1,82 @@
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections.abc import Callable
+from typing import Any
+
+from karmabot.slack_utils import LimitedWebClient, RateLimiter
+
+Handler = Callable[[dict], dict | tuple[int, dict, dict]]
+
+
+class FakeWebClient(LimitedWebClient):
+    """A `LimitedWebClient` answered by handlers instead of Slack.
+
+    A handler gets the call's arguments and returns the response data or a
+    `(status, headers, data)` tuple. Only the HTTP round trip is replaced, so
+    rate limiting, retries and pagination work as with Slack.
+
+    Every call takes `latency` seconds, and the `ratelimited_share` of the calls
+    is rejected with HTTP 429. `rate_limits=False` turns `RateLimiter` off.
+    """
+
+    def __init__(
+        self,
+        handlers: dict[str, Handler] | None = None,
+        *,
+        latency: float = 0.0,
+        ratelimited_share: float = 0.0,
+        rate_limits: bool = True,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(token="xoxb-fake")
+        self.handlers: dict[str, Handler] = {
+            "auth.test": lambda args: {"user_id": "UBOT", "bot_id": "BBOT", "team_id": "T1"},
+            **(handlers or {}),
+        }
+        self.calls: list[tuple[str, dict]] = []
+        self._calls_lock = threading.Lock()
+        self._latency = latency
+        self._ratelimited_share = ratelimited_share
+        self._random = random.Random(seed)
+        if not rate_limits:
+            self._limiter = Unlimited()
+
+    def count(self, api_method: str) -> int:
+        return sum(1 for method, _ in self.calls if method == api_method)
+
+    def _perform_urllib_http_request_internal(self, url: str, req: Any) -> dict:
+        api_method = url.rsplit("/", 1)[-1]
+        args = _request_args(req)
+        with self._calls_lock:
+            self.calls.append((api_method, args))
+            rejected = self._random.random() < self._ratelimited_share
+        if self._latency:
+            time.sleep(self._latency)
+        result = ratelimited() if rejected else self.handlers[api_method](args)
+        if isinstance(result, tuple):
+            status, headers, data = result
+        else:
+            status, headers, data = 200, {}, result
+        data = {"ok": 200 <= status < 300, **data}
+        return {"status": status, "headers": headers, "body": json.dumps(data)}
+
+
+class Unlimited(RateLimiter):
+    def reserve(self, api_method: str) -> float:
+        return 0.0
+
+
+def _request_args(req: Any) -> dict:
+    if not req.data:
+        return {}
+    body = req.data.decode()
+    if req.get_header("Content-type", "").startswith("application/json"):
+        return json.loads(body)
+    return {k: v[-1] for k, v in urllib.parse.parse_qs(body).items()}
+
+
+def ratelimited(retry_after: int = 0) -> tuple[int, dict, dict]:
+    return 429, {"Retry-After": [str(retry_after)]}, {"error": "ratelimited"}
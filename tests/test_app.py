@@ -0,0 +1,28 @@
+import pathlib
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from karmabot import app
+
+
+def test_help_is_lazy():
+    # A fresh interpreter, the modules of this one are already loaded
+    code = (
+        "import sys\n"
+        "from karmabot.app import cli_app\n"
+        "heavy = {'sqlalchemy', 'slack_bolt', 'apscheduler', 'pydantic', 'yaml'}\n"
+        "print(sorted(heavy & sys.modules.keys()))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.stdout.strip() == "[]", result.stderr
+
+
+def test_import_profile(config_path: pathlib.Path):
+    result = CliRunner().invoke(app.cli_app, ["-c", str(config_path), "--import-profile"])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert [line.split()[-1] for line in lines[: len(app.BOT_MODULES)]] == list(app.BOT_MODULES)
+    assert lines[-2].endswith(f"load {config_path}")
+    assert "total" in lines[-1]
@@ -0,0 +1,20 @@
+from karmabot.cache import TTLCache
+
+
+def test_lru_eviction():
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_expiration():
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=-1)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
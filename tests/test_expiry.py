@@ -0,0 +1,17 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+from karmabot.expiry import ExpiryTimer
+
+
+def test_expiry_timer():
+    called = threading.Event()
+    timer = ExpiryTimer(called.set)
+    now = datetime.now(tz=timezone.utc)
+    timer.push(now + timedelta(hours=1), 1)
+    timer.start()
+    assert not called.wait(0.1)
+    # An earlier deadline wakes the timer up
+    timer.push(now + timedelta(seconds=0.2), 2)
+    assert called.wait(1)
+    assert len(timer) == 1
@@ -1,10 +1,14 @@
+import asyncio
+from collections import Counter
 from datetime import datetime, timedelta, timezone
 
 import pytest
+import sqlalchemy as sa
 
+from karmabot import karma_manager
 from karmabot.config import KarmabotConfig
-from karmabot.karma_manager import KarmaManager
-from karmabot.orm import Voting
+from karmabot.karma_manager import AsyncKarmaManager, KarmaManager
+from karmabot.orm import Karma, KarmaLedger, Voting
 
 
 @pytest.mark.usefixtures("seed_sample_karma")
@@ -34,12 +38,65 @@ def test_set_non_existing(km: KarmaManager):
     assert km.get(user_id) == karma
 
 
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_balance_cache(km: KarmaManager, test_user: str, test_channel: str):
+    assert km.get(test_user) == 0
+    assert km.get(test_user) == 0
+    assert (km.balances.hits, km.balances.misses) == (1, 1)
+    # Writes of this process go through the cache
+    km.set(test_user, 3)
+    [voting] = _add_votings(km, [_voting(test_user, 2, test_channel, 1.0)])
+    assert km.close_voting(voting, Counter({"+1": 1}))
+    assert km.balances.get(test_user) == 5
+    # Writes of other processes are seen once the cached balance expires
+    with km._session_maker.begin() as session:
+        session.execute(sa.update(Karma).filter_by(user_id=test_user).values(karma=7))
+    assert km.get(test_user) == 5
+    km.balances.pop(test_user)
+    assert km.get(test_user) == 7
+
+
 @pytest.mark.usefixtures("seed_sample_karma")
 def test_digest(km: KarmaManager, sample_karma: dict[str, int]):
-    digest = km.digest()
+    digest = [item for page in km.digest() for item in page]
     assert len(digest) == sum(1 for v in sample_karma.values() if v != 0)
-    for karma_record in digest:
-        assert karma_record.karma == sample_karma.get(karma_record.user_id)
+    for user_id, karma in digest:
+        assert karma == sample_karma.get(user_id)
+
+
+@pytest.mark.usefixtures("cleanup_karma_table")
+def test_digest_pages(km: KarmaManager):
+    for i in range(5):
+        km.set(f"uid{i}", i)
+    pages = list(km.digest(page_size=2))
+    assert pages == [[("uid4", 4), ("uid3", 3)], [("uid2", 2), ("uid1", 1)]]
+
+
+@pytest.mark.usefixtures("seed_sample_karma")
+def test_top(km: KarmaManager, sample_karma: dict[str, int]):
+    expected = sorted(sample_karma.items(), key=lambda i: (i[1], i[0]), reverse=True)
+    assert km.top(10) == expected
+    first_page = km.top(2)
+    assert first_page == expected[:2]
+    user_id, karma = first_page[-1]
+    assert km.top(2, after=(karma, user_id)) == expected[2:]
+
+
+@pytest.mark.usefixtures("seed_sample_karma")
+def test_rank(km: KarmaManager, test_user: str):
+    assert km.rank("uid789") == (1, 101)
+    assert km.rank(test_user) == (2, 0)
+    km.set("uid000", 0)
+    assert km.rank("uid000") == (2, 0), "equal karma must share a rank"
+    assert km.rank("uid456") == (4, -1)
+    assert km.rank("non_existing_user") is None
+
+
+@pytest.mark.usefixtures("seed_sample_karma")
+def test_neighbours(km: KarmaManager, test_user: str):
+    assert km.neighbours(test_user, 1) == [("uid789", 101), (test_user, 0), ("uid456", -1)]
+    assert km.neighbours("uid789", 2) == [("uid789", 101), (test_user, 0), ("uid456", -1)]
+    assert km.neighbours("non_existing_user", 2) == []
 
 
 @pytest.mark.usefixtures("cleanup_voting_table")
@@ -73,7 +130,7 @@ def test_create(km: KarmaManager, test_channel: str):
     bot_message_ts = "102.0"
     km.create(
         initiator_id=initiator_id,
-        target_id=target_id,
+        target_ids=[target_id],
         channel=test_channel,
         text=text,
         ts=ts,
@@ -92,6 +149,46 @@ def test_create(km: KarmaManager, test_channel: str):
     assert obj.karma == 2
 
 
+@pytest.mark.usefixtures("cleanup_voting_table", "cleanup_karma_table")
+def test_create_many(km: KarmaManager, test_channel: str):
+    votings = km.create(
+        initiator_id="init_id",
+        target_ids=["uid1", "uid2", "uid3"],
+        channel=test_channel,
+        text="@karmabot @uid1 @uid2 @uid3 ++",
+        ts="101.0",
+        bot_message_ts="102.0",
+        karma=2,
+    )
+    assert [v.target_id for v in votings] == ["uid1", "uid2", "uid3"]
+    assert len({v.id for v in votings}) == 3
+    assert len({v.uuid for v in votings}) == 1
+    # The votings of a message share its reactions
+    reactions = Counter({"+1": 1})
+    closed = km.close_votings([(v, reactions) for v in votings])
+    assert closed == {v.id: True for v in votings}
+    assert [km.get(user_id) for user_id in ("uid1", "uid2", "uid3")] == [2, 2, 2]
+
+
+@pytest.mark.usefixtures("cleanup_voting_table", "cleanup_karma_table")
+def test_create_existing(km: KarmaManager, test_channel: str):
+    kwargs = dict(
+        initiator_id="init_id",
+        target_ids=["target_id"],
+        channel=test_channel,
+        text="@karmabot @target_id ++",
+        ts="101.0",
+        bot_message_ts="102.0",
+        karma=2,
+    )
+    assert len(km.create(**kwargs)) == 1
+    with km._session_maker.begin() as session:
+        assert km._create(session, *kwargs.values()) == []
+        # The transaction is still usable
+        session.add(Karma(user_id="after_duplicate", karma=1))
+    assert km.get("after_duplicate") == 1
+
+
 @pytest.mark.usefixtures("cleanup_voting_table")
 @pytest.mark.parametrize(
     "votes, result_karma",
@@ -101,7 +198,7 @@ def test_create(km: KarmaManager, test_channel: str):
     ),
     ids=("skipped", "up"),
 )
-def test_get_expired_votings(
+def test_claim_expired_votings(
     km: KarmaManager,
     votes: dict[str, int],
     result_karma: int,
@@ -126,7 +223,8 @@ def test_get_expired_votings(
         session.add(
             Voting(
                 closed=True,
-                message_ts=message_ts,
+                # (message_ts, channel) is unique
+                message_ts=message_ts - timedelta(seconds=1),
                 bot_message_ts=bot_message_ts,
                 channel=test_channel,
                 target_id=test_user,
@@ -135,14 +233,261 @@ def test_get_expired_votings(
                 message_text=f"@karmabot @{test_user} +",
             )
         )
-    expired = km.get_expired_votings()
+    expired = km.claim_expired_votings(10, timedelta(minutes=5))
     assert len(expired) == 1
     assert expired[0].message_ts == message_ts
+    # Claimed until released or the lease runs out
+    assert km.claim_expired_votings(10, timedelta(minutes=5)) == []
+    km.release_votings([expired[0].id])
+    assert [v.id for v in km.claim_expired_votings(10, timedelta(0))] == [expired[0].id]
+    assert [v.id for v in km.claim_expired_votings(10, timedelta(minutes=5))] == [expired[0].id]
+
+
+@pytest.mark.usefixtures("cleanup_voting_table")
+def test_claims_are_disjoint(km: KarmaManager, config: KarmabotConfig, test_channel: str):
+    _add_votings(km, [_voting(f"u{i}", 1, test_channel, 1000.0 + i) for i in range(5)])
+    replicas = [KarmaManager(config), KarmaManager(config)]
+    claims = [r.claim_expired_votings(3, timedelta(minutes=5)) for r in replicas]
+    assert [len(claim) for claim in claims] == [3, 2]
+    assert not {v.id for v in claims[0]} & {v.id for v in claims[1]}
+
+
+@pytest.mark.usefixtures("cleanup_voting_table")
+def test_acquire_lease(km: KarmaManager):
+    ttl = timedelta(minutes=5)
+    assert km.acquire_lease("job", "a", ttl)
+    assert not km.acquire_lease("job", "b", ttl)
+    # Renewed by its holder
+    assert km.acquire_lease("job", "a", ttl)
+    assert km.acquire_lease("other", "b", ttl)
+    # Taken over once it expires
+    assert km.acquire_lease("job", "a", timedelta(0))
+    assert km.acquire_lease("job", "b", ttl)
+
+
+def _add_votings(km: KarmaManager, votings: list[Voting]) -> list[Voting]:
+    with km._session_maker.begin() as session:
+        session.add_all(votings)
+        session.flush()
+        session.expunge_all()
+    return votings
+
+
+def _voting(target_id: str, karma: int, channel: str, message_ts: float) -> Voting:
+    ts = datetime.fromtimestamp(message_ts, tz=timezone.utc)
+    return Voting(
+        message_ts=ts,
+        bot_message_ts=ts + timedelta(seconds=1),
+        channel=channel,
+        target_id=target_id,
+        initiator_id="init_id",
+        karma=karma,
+        message_text=f"@karmabot @{target_id} +",
+    )
+
+
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_close_voting(km: KarmaManager, test_user: str, test_channel: str):
+    (voting,) = _add_votings(km, [_voting(test_user, 2, test_channel, 1.0)])
+    assert km.close_voting(voting, Counter({"+1": 1}))
+    assert km.get(test_user) == 2
+    # Already closed votings are not applied twice
+    assert not km.close_voting(voting, Counter({"+1": 1}))
+    assert km.get(test_user) == 2
 
 
-def test_close_voting():
-    pass
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_close_votings(km: KarmaManager, sample_karma: dict[str, int], test_channel: str):
+    votings = _add_votings(
+        km,
+        [
+            _voting("uid456", 2, test_channel, 1.0),
+            _voting("uid456", 3, test_channel, 2.0),
+            _voting("uid789", -1, test_channel, 3.0),
+            _voting("new_user", 4, test_channel, 4.0),
+            _voting("uid789", 5, test_channel, 5.0),
+            _voting("uid789", 5, test_channel, 6.0),
+        ],
+    )
+    reactions: list[Counter[str] | None] = [
+        Counter({"+1": 2}),
+        Counter({"+1": 1}),
+        Counter({"+1": 1, "-1": 0}),
+        Counter({"+1": 1}),
+        Counter({"-1": 1}),
+        None,
+    ]
+    closed = km.close_votings(zip(votings, reactions, strict=True))
+    assert closed == dict(zip([v.id for v in votings], [True] * 4 + [False] * 2, strict=True))
+    assert km.get("uid456") == sample_karma["uid456"] + 5
+    assert km.get("uid789") == sample_karma["uid789"] - 1
+    assert km.get("new_user") == 4
+    with km._session_maker() as session:
+        assert session.scalar(sa.select(sa.func.count()).select_from(Voting)) == 5
+        assert session.scalar(sa.select(sa.func.count()).where(Voting.closed == False)) == 0
+        assert session.scalar(sa.select(sa.func.count()).select_from(Karma)) == 4
+
+
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_close_votings_without_upserts(
+    km: KarmaManager,
+    sample_karma: dict[str, int],
+    test_channel: str,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    # Dialects without upserts update and insert the balances separately
+    monkeypatch.setattr(karma_manager, "dialect_insert", lambda bind: None)
+    votings = _add_votings(
+        km,
+        [
+            _voting("uid456", 2, test_channel, 1.0),
+            _voting("new_user", 4, test_channel, 2.0),
+            _voting("uid456", 3, test_channel, 3.0),
+        ],
+    )
+    reactions = [Counter({"+1": 1})] * 3
+    assert km.close_votings(zip(votings, reactions, strict=True)) == {v.id: True for v in votings}
+    assert km.get("uid456") == sample_karma["uid456"] + 5
+    assert km.get("new_user") == 4
+
+
+@pytest.mark.usefixtures("cleanup_voting_table")
+def test_remove_old_votings(km: KarmaManager, config: KarmabotConfig, test_channel: str):
+    votings = [_voting("target_id", 1, test_channel, float(i)) for i in range(5)]
+    old = datetime.now(tz=timezone.utc) - config.karma.keep_history * 2
+    for voting in votings[:3]:
+        voting.closed = True
+        voting.created = old
+    # Outdated but still open
+    votings[3].created = old
+    _add_votings(km, votings)
+
+    assert km.remove_old_votings(batch_size=2) == 3
+    with km._session_maker() as session:
+        left = session.execute(sa.select(Voting.id).order_by(Voting.id)).scalars().all()
+    assert left == [v.id for v in votings[3:]]
+
+
+@pytest.mark.usefixtures("cleanup_voting_table", "cleanup_karma_table")
+def test_ledger(km: KarmaManager, test_channel: str):
+    start = datetime.now(tz=timezone.utc)
+    km.set("uid1", 5)
+    km.set("uid1", 5)
+    votings = _add_votings(
+        km, [_voting("uid1", 2, test_channel, 1.0), _voting("uid2", 3, test_channel, 2.0)]
+    )
+    km.close_votings((v, Counter({"+1": 1})) for v in votings)
+
+    with km._session_maker() as session:
+        stmt = sa.select(KarmaLedger.user_id, KarmaLedger.kind, KarmaLedger.delta).order_by(
+            KarmaLedger.id
+        )
+        entries = session.execute(stmt).all()
+    assert sorted(entries) == [
+        ("uid1", "initial", 0),
+        ("uid1", "set", 5),
+        ("uid1", "voting", 2),
+        ("uid2", "initial", 0),
+        ("uid2", "voting", 3),
+    ]
+    assert (km.get("uid1"), km.get("uid2")) == (7, 3)
+    assert km.get_change("uid1", since=start) == 7
+    assert km.get_change("uid1", since=datetime.now(tz=timezone.utc)) == 0
+    assert km.rebuild_balances() == 0
+
+    with km._session_maker.begin() as session:
+        session.execute(sa.update(Karma).filter_by(user_id="uid1").values(karma=100))
+        session.execute(sa.delete(Karma).filter_by(user_id="uid2"))
+    assert km.rebuild_balances(batch_size=1) == 2
+    assert (km.get("uid1"), km.get("uid2")) == (7, 3)
+
+
+@pytest.mark.parametrize("batch_size", [0, -1])
+def test_remove_old_votings_invalid_batch_size(km: KarmaManager, batch_size: int):
+    with pytest.raises(ValueError):
+        km.remove_old_votings(batch_size)
+
+
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_live_tally(config: KarmabotConfig, test_user: str, test_channel: str):
+    karma_config = config.karma.model_copy(update={"live_tally": True})
+    km = KarmaManager(config.model_copy(update={"karma": karma_config}))
+    km.create(
+        initiator_id="init_id",
+        target_ids=[test_user],
+        channel=test_channel,
+        text="@karmabot @target_id ++",
+        ts="101.0",
+        bot_message_ts="102.0",
+        karma=2,
+    )
+    assert km.tally_reaction(test_channel, "101.0", "+1", 1) == 1
+    assert km.tally_reaction(test_channel, "102.0", "+1::skin-tone-2", 1) == 1
+    assert km.tally_reaction(test_channel, "102.0", "-1", 1) == 1
+    assert km.tally_reaction(test_channel, "102.0", "smile", 1) == 0
+    assert km.tally_reaction("C000", "102.0", "+1", 1) == 0
+
+    (voting,) = km.pending()
+    assert (voting.upvotes, voting.downvotes) == (2, 1)
+    assert km.close_votings([(voting, None)]) == {voting.id: True}
+    assert km.get(test_user) == 2
+
+
+@pytest.mark.usefixtures("cleanup_voting_table")
+def test_live_tally_initial_reactions(config: KarmabotConfig, test_user: str, test_channel: str):
+    karma_config = config.karma.model_copy(update={"live_tally": True})
+    km = KarmaManager(config.model_copy(update={"karma": karma_config}))
+    km.create(
+        initiator_id="init_id",
+        target_ids=[test_user],
+        channel=test_channel,
+        text="@karmabot @target_id ++",
+        ts="101.0",
+        bot_message_ts="102.0",
+        karma=2,
+        reactions=Counter({"+1::skin-tone-3": 1, "smile": 2}),
+    )
+    # A reaction made before the voting was created is removed
+    assert km.tally_reaction(test_channel, "101.0", "+1", -1) == 1
+    # A removal without a matching addition doesn't make tallies negative
+    assert km.tally_reaction(test_channel, "101.0", "-1", -1) == 1
+    (voting,) = km.pending()
+    assert (voting.upvotes, voting.downvotes) == (0, 0)
+
+
+@pytest.mark.usefixtures("seed_sample_karma", "cleanup_voting_table")
+def test_async_manager(config: KarmabotConfig, sample_karma: dict[str, int], test_channel: str):
+    pytest.importorskip("aiosqlite")
+
+    async def scenario():
+        km = AsyncKarmaManager(config)
+        try:
+            await km.upgrade_schema()
+            assert await km.get("uid789") == sample_karma["uid789"]
+            await km.set("uid789", 5)
+            assert await km.get("uid789") == 5
+            (voting,) = await km.create(
+                initiator_id="init_id",
+                target_ids=["uid789"],
+                channel=test_channel,
+                text="@karmabot @uid789 ++",
+                ts="101.0",
+                bot_message_ts="102.0",
+                karma=2,
+            )
+            assert [v.id for v in await km.pending()] == [voting.id]
+            assert await km.close_votings([(voting, Counter({"+1": 1}))]) == {voting.id: True}
+            assert await km.get("uid789") == 7
+            assert [page async for page in km.digest()] == [[("uid789", 7), ("uid456", -1)]]
+        finally:
+            await km.close()
 
+    async def another_loop():
+        km = AsyncKarmaManager(config)
+        try:
+            assert await km.get("uid789") == 7
+        finally:
+            await km.close()
 
-def test_remove_old_votings():
-    pass
+    asyncio.run(scenario())
+    asyncio.run(another_loop())
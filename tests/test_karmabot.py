@@ -0,0 +1,223 @@
+import itertools
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sa
+
+from karmabot import karmabot
+from karmabot.config import KarmabotConfig
+from karmabot.karma_manager import KarmaManager
+from karmabot.orm import OutboxKind, OutboxMessage, Voting
+
+from .fake_slack import FakeWebClient, ratelimited
+
+
+def _ts(value: float) -> datetime:
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+@pytest.mark.usefixtures("cleanup_voting_table", "cleanup_karma_table", "sleeps")
+def test_close_expired_votings(
+    config: KarmabotConfig,
+    monkeypatch: pytest.MonkeyPatch,
+    km: KarmaManager,
+    test_user: str,
+    test_channel: str,
+):
+    reactions = {
+        "10.000000": {"message": {"reactions": [{"name": "+1", "count": 2}]}},
+        "11.000000": {"message": {}},
+        "20.000000": ratelimited(),
+        "30.000000": {"ok": False, "error": "message_not_found"},
+    }
+    client = FakeWebClient(
+        {
+            "reactions.get": lambda args: reactions[args["timestamp"]],
+            "users.info": lambda args: {
+                "user": {"id": args["user"], "name": "user", "profile": {}}
+            },
+            "chat.update": lambda args: {"ts": args["ts"]},
+        }
+    )
+    monkeypatch.setattr(karmabot, "LimitedWebClient", lambda **kwargs: client)
+    bot = karmabot.Karmabot(config)
+    with km._session_maker.begin() as session:
+        for ts in (10.0, 20.0, 30.0):
+            session.add(
+                Voting(
+                    initiator_id="init_id",
+                    target_id=test_user,
+                    channel=test_channel,
+                    message_ts=_ts(ts),
+                    bot_message_ts=_ts(ts + 1),
+                    message_text="text",
+                    karma=2,
+                )
+            )
+
+    bot.close_expired_votings()
+
+    with km._session_maker() as session:
+        votings = session.execute(sa.select(Voting.message_ts, Voting.closed)).all()
+    # The rate limited voting stays open for the next sweep and the one with
+    # a deleted message is removed
+    assert sorted(votings) == [(_ts(10.0), True), (_ts(20.0), False)]
+    # and is released, so that any replica may claim it
+    with km._session_maker() as session:
+        stmt = sa.select(Voting.claimed_until).filter_by(closed=False)
+        assert session.scalars(stmt).all() == [None]
+    assert km.get(test_user) == 2
+    # Results are saved to the outbox
+    assert client.count("chat.update") == 0
+    assert bot.drain_outbox() == 2
+    assert sorted(args["ts"] for method, args in client.calls if method == "chat.update") == [
+        "11.000000",
+        "31.000000",
+    ]
+
+
+@pytest.mark.usefixtures("cleanup_voting_table", "sleeps")
+def test_drain_outbox(config: KarmabotConfig, monkeypatch: pytest.MonkeyPatch, km: KarmaManager):
+    responses = {
+        "1.000000": itertools.chain(
+            [(500, {}, {"ok": False, "error": "fatal_error"})],
+            itertools.repeat({"ts": "1.000000"}),
+        ),
+        "2.000000": iter([(404, {}, {"ok": False, "error": "channel_not_found"})]),
+    }
+    client = FakeWebClient(
+        {"chat.update": lambda args: next(responses[args["ts"]])}, rate_limits=False
+    )
+    monkeypatch.setattr(karmabot, "LimitedWebClient", lambda **kwargs: client)
+    bot = karmabot.Karmabot(config)
+    km.enqueue_messages(
+        OutboxKind.VOTING_RESULT,
+        [
+            ("C1", "1.000000", {"text": "old"}),
+            ("C1", "2.000000", {"text": "gone"}),
+            ("C1", "1.000000", {"text": "new"}),
+        ],
+    )
+
+    assert bot.drain_outbox() == 3
+    # Only the latest update of a message is sent, the failed one is retried later
+    updates = [args["text"] for method, args in client.calls if method == "chat.update"]
+    assert updates == ["gone", "new"]
+    with km._session_maker() as session:
+        (message,) = session.scalars(sa.select(OutboxMessage)).all()
+    assert (message.ts, message.attempts) == ("1.000000", 1)
+    assert message.next_attempt > datetime.now(tz=timezone.utc)
+    assert bot.drain_outbox() == 0
+
+    with km._session_maker.begin() as session:
+        session.execute(sa.update(OutboxMessage).values(next_attempt=message.created))
+    assert bot.drain_outbox() == 1
+    updates = [args["text"] for method, args in client.calls if method == "chat.update"]
+    assert updates == ["gone", "new", "new"]
+    assert km.claim_messages(10, karmabot.OUTBOX_LEASE) == []
+
+
+def test_text_chunks():
+    chunks = karmabot.TextChunks(12, "head")
+    texts = [chunks.add(line) for line in ("a", "bb", "ccc", "a line too long")]
+    assert texts == [None, None, "head\na\nbb", "head\nccc"]
+    assert chunks.flush() == "head\na line too long"
+    assert chunks.flush() is None
+
+
+@pytest.mark.usefixtures("cleanup_karma_table", "sleeps")
+def test_report_digest(
+    config: KarmabotConfig,
+    monkeypatch: pytest.MonkeyPatch,
+    km: KarmaManager,
+    test_channel: str,
+):
+    post_ts = itertools.count(1)
+    client = FakeWebClient(
+        {
+            "users.info": lambda args: {
+                "user": {"id": args["user"], "name": args["user"], "profile": {}}
+            },
+            "chat.postMessage": lambda args: {"ts": f"{next(post_ts)}.0"},
+        }
+    )
+    monkeypatch.setattr(karmabot, "LimitedWebClient", lambda **kwargs: client)
+    monkeypatch.setattr(karmabot, "DIGEST_CHUNK_SIZE", 60)
+    bot = karmabot.Karmabot(config)
+    for i in range(1, 6):
+        km.set(f"uid{i}", i)
+
+    bot.report_digest()
+
+    posts = [args for method, args in client.calls if method == "chat.postMessage"]
+    texts = [args["attachments"][0]["text"] for args in posts]
+    assert len(texts) > 1
+    assert all(len(text) <= 60 for text in texts)
+    lines = [line for text in texts for line in text.splitlines()[1:]]
+    assert lines == [f"_uid{i}_ => *{i}*" for i in range(5, 0, -1)]
+    # The rest of the digest goes to the thread of its first message
+    assert [args.get("thread_ts") for args in posts] == [None] + ["1.0"] * (len(posts) - 1)
+    assert all(args["channel"] == test_channel for args in posts)
+
+
+@pytest.mark.usefixtures("cleanup_karma_table", "sleeps")
+def test_report_digest_empty(config: KarmabotConfig, monkeypatch: pytest.MonkeyPatch):
+    client = FakeWebClient()
+    monkeypatch.setattr(karmabot, "LimitedWebClient", lambda **kwargs: client)
+    bot = karmabot.Karmabot(config)
+    replies: list[dict] = []
+
+    bot.report_digest(reply_callback=replies.append)
+
+    assert [r["attachments"][0]["text"] for r in replies] == [karmabot.DIGEST_EMPTY]
+
+
+@pytest.mark.usefixtures("cleanup_voting_table", "cleanup_karma_table", "sleeps")
+def test_multiple_targets(
+    config: KarmabotConfig,
+    monkeypatch: pytest.MonkeyPatch,
+    km: KarmaManager,
+    test_channel: str,
+):
+    client = FakeWebClient(
+        {
+            "users.info": lambda args: {
+                "user": {"id": args["user"], "name": args["user"], "profile": {}}
+            },
+            "chat.postMessage": lambda args: {"ts": "11.0"},
+            "reactions.get": lambda args: {"message": {"reactions": [{"name": "+1", "count": 1}]}},
+            "chat.update": lambda args: {"ts": args["ts"]},
+        }
+    )
+    monkeypatch.setattr(karmabot, "LimitedWebClient", lambda **kwargs: client)
+    bot = karmabot.Karmabot(config)
+    event = {
+        "type": "app_mention",
+        "user": "init_id",
+        "channel": test_channel,
+        "ts": "10.0",
+        "text": "<@UBOT> <@u1> <@u2> <@u1> ++ release",
+    }
+
+    bot._handle_app_mention(client, event)
+
+    # The votings wait for the bot message in the outbox
+    assert client.count("chat.postMessage") == 0
+    assert sorted(v.target_id for v in km.pending()) == ["u1", "u2"]
+    bot.close_expired_votings()
+    assert len(km.pending()) == 2
+    assert bot.drain_outbox() == 1
+    assert client.count("chat.postMessage") == 1
+    assert {v.bot_message_ts for v in km.pending()} == {_ts(11.0)}
+
+    # Timestamps of the fake messages are long expired
+    bot.close_expired_votings()
+
+    assert km.pending() == []
+    assert (km.get("u1"), km.get("u2")) == (2, 2)
+    # The reactions of the message and its result are handled once for both users
+    assert client.count("reactions.get") == 2
+    assert bot.drain_outbox() == 1
+    assert client.count("chat.update") == 1
+    ((_, update),) = [c for c in client.calls if c[0] == "chat.update"]
+    assert "u1, @u2" in update["attachments"][0]["text"]
@@ -0,0 +1,98 @@
+import urllib.error
+import urllib.request
+
+import pytest
+import sqlalchemy as sa
+from slack_sdk.errors import SlackApiError
+
+from karmabot import metrics
+from karmabot.metrics import Counter, Gauge, Histogram, Registry
+
+from .fake_slack import FakeWebClient
+
+
+def test_render():
+    registry = Registry()
+    calls = Counter("calls", "Calls", ["method"])
+    votings = Gauge("votings", "Votings")
+    latency = Histogram("latency_seconds", "Latency", ["handler"], buckets=[0.1, 1])
+    for metric in (calls, votings, latency):
+        registry.register(metric)
+    calls.inc(method='a"b')
+    calls.inc(2, method='a"b')
+    votings.set(3)
+    latency.observe(0.05, handler="x")
+    latency.observe(0.5, handler="x")
+    latency.observe(5, handler="x")
+    assert registry.render().splitlines() == [
+        "# HELP calls Calls",
+        "# TYPE calls counter",
+        'calls_total{method="a\\"b"} 3.0',
+        "# HELP votings Votings",
+        "# TYPE votings gauge",
+        "votings 3.0",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{handler="x",le="0.1"} 1.0',
+        'latency_seconds_bucket{handler="x",le="1.0"} 2.0',
+        'latency_seconds_bucket{handler="x",le="+Inf"} 3.0',
+        'latency_seconds_sum{handler="x"} 5.55',
+        'latency_seconds_count{handler="x"} 3.0',
+    ]
+    with pytest.raises(ValueError):
+        registry.register(Counter("calls", "Calls"))
+    with pytest.raises(ValueError):
+        calls.inc(handler="x")
+
+
+def test_gauge_function():
+    gauge = Gauge("votings", "Votings")
+    gauge.set_function(lambda: 7)
+    assert list(gauge.samples()) == [("", "", 7)]
+    gauge.set_function(lambda: 1 / 0)
+    assert list(gauge.samples()) == []
+
+
+def test_slack_calls(sleeps: list[float]):
+    client = FakeWebClient(
+        {
+            "users.info": lambda args: {"user": {"id": args["user"]}},
+            "reactions.get": lambda args: (200, {}, {"ok": False, "error": "message_not_found"}),
+        }
+    )
+    calls = metrics.SLACK_CALLS.value(method="users.info")
+    errors = metrics.SLACK_ERRORS.value(method="reactions.get", error="message_not_found")
+    client.users_info(user="U1")
+    with pytest.raises(SlackApiError):
+        client.reactions_get(channel="C1", timestamp="1.0")
+    assert metrics.SLACK_CALLS.value(method="users.info") == calls + 1
+    assert (
+        metrics.SLACK_ERRORS.value(method="reactions.get", error="message_not_found") == errors + 1
+    )
+
+
+def test_db_queries():
+    engine = sa.create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    selects = metrics.DB_QUERY_SECONDS.count(operation="SELECT")
+    with engine.connect() as conn:
+        conn.execute(sa.text("SELECT 1"))
+        with pytest.raises(sa.exc.OperationalError):
+            conn.execute(sa.text("SELECT * FROM missing"))
+        conn.execute(sa.text("select 2"))
+        assert conn.info["karmabot_query_start"] == []
+    assert metrics.DB_QUERY_SECONDS.count(operation="SELECT") == selects + 2
+
+
+def test_serve():
+    server = metrics.serve("127.0.0.1", 0)
+    try:
+        url = "http://{}:{}".format(*server.server_address[:2])
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert "# TYPE karmabot_handler_seconds histogram" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,110 @@
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as sa
+
+from karmabot.config import KarmabotConfig, KarmabotDbConfig
+from karmabot.migrations import MIGRATIONS
+from karmabot.orm import Karma, KarmaLedger, SchemaVersion, get_engine, upgrade_schema
+
+LEGACY_VOTING_TABLE = """
+CREATE TABLE karmabot_voting (
+    id INTEGER NOT NULL PRIMARY KEY,
+    created TIMESTAMP NOT NULL,
+    closed BOOLEAN NOT NULL,
+    initiator_id VARCHAR(256) NOT NULL,
+    target_id VARCHAR(256) NOT NULL,
+    channel VARCHAR(256) NOT NULL,
+    message_ts TIMESTAMP NOT NULL,
+    bot_message_ts TIMESTAMP NOT NULL,
+    message_text TEXT NOT NULL,
+    karma INTEGER NOT NULL
+)
+"""
+LEGACY_VOTING = (
+    "INSERT INTO karmabot_voting VALUES "
+    "({id}, '2024-01-01', 0, 'u1', 'u2', 'C1', '2024-01-01', '2024-01-01', 'text', 1)"
+)
+
+
+def _schema_version(engine: sa.Engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(sa.select(SchemaVersion.version)).scalar_one()
+
+
+def test_new_db(tmp_path: pathlib.Path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    upgrade_schema(engine)
+    upgrade_schema(engine)
+    assert _schema_version(engine) == len(MIGRATIONS)
+
+
+def test_legacy_db(tmp_path: pathlib.Path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(sa.text(LEGACY_VOTING_TABLE))
+        conn.execute(sa.text(LEGACY_VOTING.format(id=1)))
+        conn.execute(sa.text(LEGACY_VOTING.format(id=2)))
+
+    upgrade_schema(engine)
+
+    assert _schema_version(engine) == len(MIGRATIONS)
+    indexes = {i["name"] for i in sa.inspect(engine).get_indexes("karmabot_voting")}
+    assert "ix_karmabot_voting_uuid_target" in indexes
+    assert "ix_karmabot_voting_uuid" not in indexes
+    assert "ix_karmabot_voting_closed_bot_message_ts" in indexes
+    columns = {c["name"]: c for c in sa.inspect(engine).get_columns("karmabot_voting")}
+    assert columns["bot_message_ts"]["nullable"]
+    with engine.connect() as conn:
+        ids = conn.execute(sa.text("SELECT id FROM karmabot_voting")).scalars().all()
+    assert ids == [1]
+
+
+def test_karma_ledger_migration(tmp_path: pathlib.Path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'ledger.db'}")
+    upgrade_schema(engine)
+    # The DB as it was before the ledger
+    with engine.begin() as conn:
+        conn.execute(sa.text("DROP TABLE karmabot_karma_ledger"))
+        conn.execute(sa.update(SchemaVersion).values(version=2))
+        conn.execute(
+            sa.insert(Karma), [{"user_id": "u1", "karma": 3}, {"user_id": "u2", "karma": 0}]
+        )
+
+    upgrade_schema(engine)
+
+    assert _schema_version(engine) == len(MIGRATIONS)
+    with engine.connect() as conn:
+        stmt = sa.select(KarmaLedger.user_id, KarmaLedger.kind, KarmaLedger.delta)
+        assert sorted(conn.execute(stmt).all()) == [("u1", "initial", 3), ("u2", "initial", 0)]
+
+
+def test_engine_registry(config: KarmabotConfig):
+    assert isinstance(config.db, KarmabotDbConfig)
+    engine = get_engine(config.db)
+    assert get_engine(config.db.model_copy()) is engine
+    # Changed settings replace the engine
+    resized = get_engine(config.db.model_copy(update={"pool_size": 10}))
+    assert resized is not engine
+    assert resized.pool.size() == 10  # type: ignore[attr-defined]
+    assert get_engine(config.db) is not resized
+
+
+def test_sqlite_pragmas(config: KarmabotConfig):
+    with get_engine(config.db).connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_sqlite_in_memory():
+    engine = get_engine(KarmabotDbConfig(url="sqlite://"))
+
+    def schema_version() -> int:
+        with engine.connect() as conn:
+            return conn.execute(sa.select(SchemaVersion.version)).scalar_one()
+
+    assert schema_version() == len(MIGRATIONS)
+    # Other threads see the same DB
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert pool.submit(schema_version).result() == len(MIGRATIONS)
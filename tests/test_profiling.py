@@ -0,0 +1,48 @@
+import logging
+
+import pytest
+import sqlalchemy as sa
+
+from karmabot.profiling import NO_OPERATION, QueryProfiler
+
+
+@pytest.fixture
+def engine() -> sa.Engine:
+    return sa.create_engine("sqlite://")
+
+
+def test_repeated_statements(engine: sa.Engine, caplog: pytest.LogCaptureFixture):
+    profiler = QueryProfiler()
+    profiler.instrument(engine)
+    profiler.enable(slow_query=60, repeated_queries=3)
+    with engine.connect() as conn:
+        with profiler.operation("app_mention"):
+            for i in range(4):
+                conn.execute(sa.text("SELECT :i"), {"i": i})
+        with profiler.operation("app_mention"):
+            conn.execute(sa.text("SELECT :i"), {"i": 0})
+        conn.execute(sa.text("SELECT 1"))
+    stats = profiler.stats()
+    assert stats[("app_mention", "SELECT ?")].count == 5
+    assert stats[("app_mention", "SELECT ?")].repeated == 1
+    assert stats[(NO_OPERATION, "SELECT 1")].count == 1
+    assert caplog.text.count("Statement repeated 3 times in one app_mention") == 1
+    assert "[app_mention] SELECT ?" in profiler.summary()
+    profiler.reset()
+    assert profiler.stats() == {}
+
+
+def test_slow_queries(engine: sa.Engine, caplog: pytest.LogCaptureFixture):
+    profiler = QueryProfiler()
+    profiler.instrument(engine)
+    with engine.connect() as conn:
+        conn.execute(sa.text("SELECT 1"))
+        assert profiler.stats() == {}
+        profiler.enable(slow_query=0, repeated_queries=3)
+        with caplog.at_level(logging.WARNING, logger="karmabot"):
+            conn.execute(sa.text("SELECT :value"), {"value": "param"})
+            with pytest.raises(sa.exc.OperationalError):
+                conn.execute(sa.text("SELECT * FROM missing"))
+        assert conn.info["karmabot_profile_start"] == []
+    assert "Slow query" in caplog.text
+    assert "'param'" in caplog.text
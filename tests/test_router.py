@@ -0,0 +1,48 @@
+import pytest
+
+from karmabot.parse import DEFAULT_TOP, KarmaChange, Parse, SetArgs, UserArgs
+from karmabot.router import CommandRouter
+
+
+def test_parse():
+    assert Parse.karma_change("<@BOT> <@U1> <@U2> <@U1> +++ thanks") == KarmaChange(
+        "BOT", ["U1", "U2"], 3, "thanks"
+    )
+    assert Parse.karma_change("<@BOT> -- <@U1>") is None
+    assert Parse.cmd_get("get <@U1|alice>") == UserArgs("U1", "alice")
+    assert Parse.cmd_set("set <@U1> -5") == SetArgs("U1", None, -5)
+    assert Parse.cmd_top("top") == DEFAULT_TOP
+    assert Parse.cmd_top("top 0") == 0
+    assert Parse.cmd_rank("rank me") is None
+
+
+def test_router():
+    router = CommandRouter()
+
+    @router.command("get", Parse.cmd_get)
+    def get(args: UserArgs) -> str:
+        return args.user_id
+
+    @router.command("top", Parse.cmd_top)
+    def top(size: int) -> int:
+        return size
+
+    @router.command("help")
+    def help_(args: None) -> str:
+        return "help"
+
+    route = router.resolve("get <@U1|alice>")
+    assert route is not None
+    assert route.name == "get"
+    assert route.handler(route.args) == "U1"
+    # Falsy arguments still match
+    route = router.resolve("top 0")
+    assert route is not None and route.handler(route.args) == 0
+    assert router.resolve("help") == ("help", help_, None)
+    assert router.resolve("help me") is None
+    assert router.resolve("get alice") is None
+    assert router.resolve("unknown") is None
+    assert router.resolve("") is None
+
+    with pytest.raises(ValueError):
+        router.command("help")(help_)
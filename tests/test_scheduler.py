@@ -0,0 +1,62 @@
+import datetime
+import os
+import pathlib
+
+import pytest
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_SUBMITTED,
+    JobExecutionEvent,
+    JobSubmissionEvent,
+)
+
+from karmabot import metrics, scheduler
+
+
+@pytest.fixture
+def fake_karmabot(monkeypatch: pytest.MonkeyPatch) -> list[pathlib.Path]:
+    created = []
+
+    class FakeKarmabot:
+        def __init__(self, config: pathlib.Path) -> None:
+            created.append(config)
+
+    monkeypatch.setattr(scheduler, "Karmabot", FakeKarmabot)
+    # The configs are empty files
+    monkeypatch.setattr(scheduler, "load_config", lambda config_path: config_path)
+    monkeypatch.setattr(scheduler, "_karmabots", {})
+    return created
+
+
+def test_get_karmabot_reuses_instance(tmp_path: pathlib.Path, fake_karmabot: list):
+    config_path = tmp_path / "config.yml"
+    config_path.write_text("")
+    first = scheduler.get_karmabot(config_path)
+    assert scheduler.get_karmabot(config_path) is first
+    assert len(fake_karmabot) == 1
+
+
+def test_get_karmabot_reloads_modified_config(tmp_path: pathlib.Path, fake_karmabot: list):
+    config_path = tmp_path / "config.yml"
+    config_path.write_text("")
+    first = scheduler.get_karmabot(config_path)
+    mtime = config_path.stat().st_mtime
+    os.utime(config_path, (mtime + 1, mtime + 1))
+    assert scheduler.get_karmabot(config_path) is not first
+    assert len(fake_karmabot) == 2
+
+
+def test_job_metrics():
+    karmabot_scheduler = object.__new__(scheduler.KarmabotScheduler)
+    karmabot_scheduler._submitted = {}
+    scheduled = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(seconds=30)
+    karmabot_scheduler._on_job_event(
+        JobSubmissionEvent(EVENT_JOB_SUBMITTED, "job", "default", [scheduled])
+    )
+    assert metrics.JOB_LAG_SECONDS.value(job="job") == pytest.approx(30, abs=5)
+    failures = metrics.JOB_FAILURES.value(job="job")
+    karmabot_scheduler._on_job_event(
+        JobExecutionEvent(EVENT_JOB_ERROR, "job", "default", scheduled, exception=ValueError())
+    )
+    assert metrics.JOB_DURATION_SECONDS.value(job="job") is not None
+    assert metrics.JOB_FAILURES.value(job="job") == failures + 1
@@ -0,0 +1,73 @@
+import datetime
+import threading
+
+import pytest
+from slack_sdk.errors import SlackApiError
+from slack_sdk.socket_mode import SocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+from slack_sdk.web import WebClient
+
+from benchmarks.slack_standin import StandinServer, Workspace
+from karmabot.slack_utils import format_ts, paginate
+
+
+@pytest.fixture
+def server():
+    server = StandinServer(("127.0.0.1", 0), Workspace(users=250, channels=3), rate_limits=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_web_api(server: StandinServer):
+    client = WebClient(token="xoxb-standin", base_url=f"{server.base_url}/api/")
+    assert client.auth_test()["user_id"] == "UBOT"
+    assert len(list(paginate(client.users_list, "members"))) == 251
+    assert client.users_info(user="U00001")["user"]["name"] == "user1"
+
+    ts = client.chat_postMessage(channel="C00000", text="voting")["ts"]
+    assert format_ts(datetime.datetime.fromtimestamp(float(ts))) == ts
+    client.chat_update(channel="C00000", ts=ts, text="closed")
+    assert client.reactions_get(channel="C00000", timestamp=ts)["message"]["text"] == "closed"
+    with pytest.raises(SlackApiError, match="message_not_found"):
+        client.reactions_get(channel="C00000", timestamp="1.000000")
+
+    # Tier 2: 20 calls per minute
+    for _ in range(20):
+        client.conversations_list()
+    with pytest.raises(SlackApiError) as e:
+        client.conversations_list()
+    assert e.value.response.status_code == 429
+    assert int(e.value.response.headers["Retry-After"]) > 0
+
+
+def test_socket_mode(server: StandinServer):
+    web_client = WebClient(token="xoxb-standin", base_url=f"{server.base_url}/api/")
+    client = SocketModeClient(app_token="xapp-standin", web_client=web_client)
+    received = threading.Event()
+    events: list[dict] = []
+
+    def listener(client: SocketModeClient, req: SocketModeRequest) -> None:
+        client.send_socket_mode_response(SocketModeResponse(envelope_id=req.envelope_id))
+        events.append(req.payload["event"])
+        received.set()
+
+    client.socket_mode_request_listeners.append(listener)
+    client.connect()
+    try:
+        for _ in range(100):
+            if server.hub.send_event({"type": "app_mention", "text": "hi"}):
+                break
+            threading.Event().wait(0.05)
+        assert received.wait(5)
+        assert events == [{"type": "app_mention", "text": "hi"}]
+        for _ in range(100):
+            if server.stats.acks:
+                break
+            threading.Event().wait(0.05)
+        assert server.stats.acks == 1
+    finally:
+        client.close()
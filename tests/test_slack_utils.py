@@ -0,0 +1,175 @@
+import threading
+
+import pytest
+from slack_sdk.errors import SlackApiError
+
+from karmabot.slack_utils import (
+    DISPATCH_ATTEMPTS,
+    RETRY_JITTER,
+    RateLimiter,
+    SlackDirectory,
+    SlackDispatcher,
+    paginate,
+)
+
+from .fake_slack import FakeWebClient, ratelimited
+
+
+def test_rate_limiter():
+    now = 0.0
+    limiter = RateLimiter(clock=lambda: now)
+    # 50 calls per minute: bursts of 5 calls, then a call per 1.2 seconds
+    delays = [limiter.reserve("reactions.get") for _ in range(7)]
+    assert delays == pytest.approx([0, 0, 0, 0, 0, 1.2, 2.4])
+    # Methods have separate buckets
+    assert limiter.reserve("users.info") == 0
+    now = 60.0
+    assert limiter.reserve("reactions.get") == 0
+
+
+def test_limited_client_waits(sleeps: list[float]):
+    client = FakeWebClient({"users.info": lambda args: {"user": {"id": args["user"]}}})
+    for i in range(12):
+        client.users_info(user=f"U{i}")
+    # 100 calls per minute: bursts of 10 calls, then a call per 0.6 seconds
+    assert len(sleeps) == 2
+    assert all(0 < s <= 1.2 for s in sleeps)
+
+
+def test_limited_client_retries_ratelimited(sleeps: list[float]):
+    responses = iter([ratelimited(), {"message": {}}])
+    client = FakeWebClient({"reactions.get": lambda args: next(responses)})
+    assert client.reactions_get(channel="C1", timestamp="1.0")["ok"]
+    assert client.count("reactions.get") == 2
+
+    client = FakeWebClient({"reactions.get": lambda args: ratelimited()})
+    with pytest.raises(SlackApiError):
+        client.reactions_get(channel="C1", timestamp="1.0")
+    # The first call and 2 retries
+    assert client.count("reactions.get") == 3
+
+
+def test_fake_client_faults(sleeps: list[float]):
+    client = FakeWebClient({"users.info": lambda args: {}}, latency=0.5, ratelimited_share=1.0)
+    with pytest.raises(SlackApiError):
+        client.users_info(user="U1")
+    assert client.count("users.info") == 3
+    assert sleeps.count(0.5) == 3
+
+
+def test_dispatcher_coalesces_updates():
+    sending = threading.Event()
+    release = threading.Event()
+
+    def update(args: dict) -> dict:
+        sending.set()
+        release.wait(5)
+        return {"ts": args["ts"]}
+
+    client = FakeWebClient({"chat.update": update})
+    dispatcher = SlackDispatcher(client, workers=2)
+    dispatcher.update("C1", {"text": "first"}, ts="1.0")
+    assert sending.wait(5)
+    # The message is being updated, so the next updates wait and replace each other
+    for text in ("second", "third"):
+        dispatcher.update("C1", {"text": text}, ts="1.0")
+    dispatcher.update("C1", {"text": "other"}, ts="2.0")
+    release.set()
+    assert dispatcher.join(timeout=5)
+    updates = [(args["ts"], args["text"]) for method, args in client.calls]
+    assert sorted(updates) == [("1.0", "first"), ("1.0", "third"), ("2.0", "other")]
+    assert updates.index(("1.0", "first")) < updates.index(("1.0", "third"))
+
+
+def test_dispatcher_retries_ratelimited(sleeps: list[float]):
+    client = FakeWebClient(
+        {
+            "im.open": lambda args: {"channel": {"id": "D1"}},
+            "chat.postMessage": lambda args: ratelimited(retry_after=3),
+        },
+        rate_limits=False,
+    )
+    dispatcher = SlackDispatcher(client)
+    dispatcher.post_im("U1", {"text": "hello"})
+    assert dispatcher.join(timeout=5)
+    # Every attempt of the dispatcher is retried by the client itself
+    assert client.count("chat.postMessage") == DISPATCH_ATTEMPTS * 3
+    assert len(sleeps) == DISPATCH_ATTEMPTS * 2 + DISPATCH_ATTEMPTS - 1
+    assert all(3 <= s <= 3 + RETRY_JITTER for s in sleeps)
+
+
+def test_paginate():
+    pages = {
+        None: {"members": [{"id": "U1"}], "response_metadata": {"next_cursor": "c2"}},
+        "c2": {"members": [{"id": "U2"}], "response_metadata": {"next_cursor": ""}},
+    }
+    client = FakeWebClient({"users.list": lambda args: pages[args.get("cursor")]})
+    assert [u["id"] for u in paginate(client.users_list, "members")] == ["U1", "U2"]
+    assert client.count("users.list") == 2
+
+
+def _user(user_id: str, display_name: str = "") -> dict:
+    return {"id": user_id, "name": user_id.lower(), "profile": {"display_name": display_name}}
+
+
+@pytest.fixture
+def directory_client(sleeps: list[float]) -> FakeWebClient:
+    users = [_user("U1", "one"), _user("U2"), _user("U3", "three")]
+    pages = {
+        None: {"members": users[:2], "response_metadata": {"next_cursor": "c2"}},
+        "c2": {"members": users[2:], "response_metadata": {"next_cursor": ""}},
+    }
+    return FakeWebClient(
+        {
+            "users.info": lambda args: {"user": _user(args["user"], "info")},
+            "users.list": lambda args: pages[args.get("cursor")],
+            "conversations.info": lambda args: {"channel": {"id": args["channel"], "name": "ch"}},
+            "conversations.list": lambda args: {"channels": [{"id": "C1", "name": "general"}]},
+        }
+    )
+
+
+def test_directory_username(directory_client: FakeWebClient):
+    directory = SlackDirectory(directory_client, maxsize=10, ttl=60)
+    assert directory.username("<@U1>") == "info"
+    assert directory.username("U1") == "info"
+    assert directory_client.count("users.info") == 1
+
+
+def test_directory_channel_name(directory_client: FakeWebClient):
+    directory = SlackDirectory(directory_client, maxsize=10, ttl=60)
+    assert directory.channel_name("C9") == "ch"
+    assert directory.channel_name("C9") == "ch"
+    assert directory_client.count("conversations.info") == 1
+    directory.warm_channels()
+    assert directory.channel_name("C1") == "general"
+    assert directory_client.count("conversations.info") == 1
+
+
+def test_directory_update_user(directory_client: FakeWebClient):
+    directory = SlackDirectory(directory_client, maxsize=10, ttl=60)
+    directory.update_user(_user("U1", "renamed"))
+    assert directory.username("U1") == "renamed"
+    # A deleted user comes without a profile
+    directory.update_user({"id": "U1", "deleted": True})
+    assert directory.username("U1") == "info"
+    assert directory_client.count("users.info") == 1
+
+
+def test_directory_warm_users(directory_client: FakeWebClient):
+    directory = SlackDirectory(directory_client, maxsize=10, ttl=60)
+    directory.warm_users()
+    assert [directory.username(u) for u in ("U1", "U2", "U3")] == ["one", "u2", "three"]
+    assert directory_client.count("users.list") == 2
+    assert directory_client.count("users.info") == 0
+    # Skipped within the TTL
+    directory.warm_users()
+    assert directory_client.count("users.list") == 2
+
+
+def test_directory_warm_users_evicted(directory_client: FakeWebClient):
+    directory = SlackDirectory(directory_client, maxsize=2, ttl=60)
+    directory.warm_users()
+    # Not all the users fit, so the next bulk lookup loads them again
+    directory.warm_users()
+    assert directory_client.count("users.list") == 4